@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the Instacart pipeline.
+
+Every case runs in a fresh interpreter (multiprocessing 'spawn'), so the
+peak RSS that it reports belongs to that case alone.
+
+    python benchmark.py load --source ./input
+    python benchmark.py join --source ./synthetic
+    python benchmark.py uxp --source ./synthetic
+    python benchmark.py fit --features ./features
+"""
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import shutil
+import sys
+import time
+
+from data_loader import load_tables
+from dense_join import dense_merge
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0 ** 2 if sys.platform == 'darwin' else rss / 1024.0
+
+
+def _run_case(func, args, queue):
+    start = time.perf_counter()
+    seconds = func(*args)
+    if seconds is None:
+        seconds = time.perf_counter() - start
+    queue.put((seconds, _peak_rss_mb()))
+
+
+def measure(func, *args):
+    """Run `func(*args)` in a fresh process and return (seconds, peak RSS in MB).
+
+    If `func` returns a number, that is the time reported, e.g. when the
+    preparation of the case should not be timed.
+    """
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_case, args=(func, args, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def report(name, seconds, rss_mb):
+    print('%-40s %9.2f s %10.1f MB' % (name, seconds, rss_mb))
+
+
+########################################
+## LOAD: CSV PARSE VS FEATHER CACHE
+########################################
+def _load_csv(source, engine='arrow', workers=None):
+    load_tables(source, cache_dir=None, engine=engine, workers=workers)
+
+
+def _load_cached(source, cache_dir):
+    load_tables(source, cache_dir=cache_dir)
+
+
+def bench_load(opts):
+    # Start from an empty cache so the second case really builds it
+    shutil.rmtree(opts.cache_dir, ignore_errors=True)
+    report('csv parse (pandas, sequential)', *measure(_load_csv, opts.source, 'pandas', 1))
+    report('csv parse (arrow, parallel)', *measure(_load_csv, opts.source))
+    report('cache build (first run)', *measure(_load_cached, opts.source, opts.cache_dir))
+    report('cache load (memory-mapped)', *measure(_load_cached, opts.source, opts.cache_dir))
+
+
+########################################
+## JOINS: PD.MERGE VS DENSE LOOKUP ARRAYS
+########################################
+def _join_inputs(source):
+    from features import build_features
+    tables = load_tables(source, cache_dir=None)
+    orders = tables['orders']
+    user, prd, uxp = build_features(orders, tables['order_products__prior'])
+    orders_future = orders.loc[orders.eval_set != 'prior', ['user_id', 'eval_set', 'order_id']]
+    return orders, tables['order_products__prior'], user, prd, uxp, orders_future
+
+
+def _join_chain(merge, orders, prior, user, prd, uxp, orders_future):
+    # The id joins of the notebook, from op to the data DataFrame of chapter 3
+    op = merge(orders, prior, 'order_id', 'inner')
+    data = merge(uxp, user, 'user_id', 'left')
+    data = merge(data, prd, 'product_id', 'left')
+    data = merge(data, orders_future, 'user_id', 'left')
+    return op, data
+
+
+def _pandas_merge(left, right, on, how):
+    return left.merge(right, on=on, how=how)
+
+
+def _join_case(source, engine):
+    inputs = _join_inputs(source)
+    start = time.perf_counter()
+    _join_chain(dense_merge if engine == 'dense' else _pandas_merge, *inputs)
+    return time.perf_counter() - start
+
+
+def bench_join(opts):
+    # Check once that both chains give the same DataFrames
+    inputs = _join_inputs(opts.source)
+    for a, b in zip(_join_chain(_pandas_merge, *inputs), _join_chain(dense_merge, *inputs)):
+        if not a.equals(b) or len(a) != len(b):
+            raise AssertionError('dense_merge differs from pd.merge')
+    del inputs
+    report('pd.merge chain', *measure(_join_case, opts.source, 'pandas'))
+    report('dense_merge chain', *measure(_join_case, opts.source, 'dense'))
+
+
+########################################
+## UXP: GROUPBYS VS ONE SORTED SCAN
+########################################
+def _op(source):
+    tables = load_tables(source, cache_dir=None)
+    return dense_merge(tables['orders'], tables['order_products__prior'], on='order_id', how='inner')
+
+
+def _uxp_case(source, engine):
+    import features
+    import order_store
+    import registry
+    op = _op(source)
+    start = time.perf_counter()
+    if engine == 'groupby':
+        features.uxp_features(features.add_order_number_back(op))
+    else:
+        registry.Plan(registry.features_of('uxp')).run(order_store.OrderStore.from_op(op))
+    return time.perf_counter() - start
+
+
+def bench_uxp(opts):
+    # Both include what they need from op: order_number_back for the groupbys, the sorted store for the scan
+    report('uxp: pandas groupbys', *measure(_uxp_case, opts.source, 'groupby'))
+    report('uxp: store + single scan', *measure(_uxp_case, opts.source, 'scan'))
+
+
+########################################
+## FIT: DATAFRAMES VS FLOAT32 MATRIX
+########################################
+def _model():
+    import xgboost as xgb
+    # The booster of section 4.1
+    return xgb.XGBClassifier(objective='binary:logistic', eval_metric='logloss', max_depth=5,
+                             colsample_bytree=0.4, subsample=0.75, n_estimators=10)
+
+
+def _report_loaded():
+    # The peak so far, once the inputs are in memory: what fit and predict_proba add comes on top of it
+    print('%-40s %22.1f MB' % ('  peak RSS before fit', _peak_rss_mb()))
+
+
+def _fit_case(features_dir, key, matrix_dir, engine):
+    # Chapters 4 and 5: split data_train, fit on 20% of it and score data_test
+    start = time.perf_counter()
+    if engine == 'frame':
+        from sklearn.model_selection import train_test_split
+        from feature_store import FeatureStore
+        tables = FeatureStore(features_dir).load(key, ['data_train', 'data_test'])
+        data_train, data_test = tables['data_train'], tables['data_test']
+        del tables
+        X_train, X_val, y_train, y_val = train_test_split(data_train.drop('reordered', axis=1), data_train.reordered,
+                                                          test_size=0.8, random_state=42)
+        _report_loaded()
+        model = _model().fit(X_train, y_train)
+        model.predict_proba(data_test)
+    else:
+        from matrix import FeatureMatrix
+        train = FeatureMatrix.load(os.path.join(matrix_dir, 'train'))
+        test = FeatureMatrix.load(os.path.join(matrix_dir, 'test'))
+        rows, _ = train.split_rows(test_size=0.8, random_state=42)
+        _report_loaded()
+        model = _model().fit(train.X[rows], train.label[rows])
+        model.predict_proba(test.X)
+    return time.perf_counter() - start
+
+
+def bench_fit(opts):
+    from feature_store import FeatureStore
+    from matrix import FeatureMatrix
+    store = FeatureStore(opts.features)
+    versions = store.versions('data_train')
+    if not versions:
+        raise SystemExit('no data_train in %s: run the notebook up to section 3.4 first' % opts.features)
+    key = versions[0]['key']
+    # The matrices are built once, as the notebook does at the end of chapter 3
+    tables = store.load(key, ['data_train', 'data_test'])
+    shutil.rmtree(opts.scratch, ignore_errors=True)
+    FeatureMatrix.from_frame(tables['data_train'], label='reordered').save(os.path.join(opts.scratch, 'train'))
+    FeatureMatrix.from_frame(tables['data_test']).save(os.path.join(opts.scratch, 'test'))
+    del tables
+    # Both cases include reading their inputs from disk
+    report('fit + predict: DataFrames', *measure(_fit_case, opts.features, key, opts.scratch, 'frame'))
+    report('fit + predict: float32 matrix', *measure(_fit_case, opts.features, key, opts.scratch, 'matrix'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    load = sub.add_parser('load', help='sequential vs parallel CSV parse vs cached load, time and peak RSS')
+    load.add_argument('--source', default='./input', help='directory of CSV files or the Kaggle zip')
+    load.add_argument('--cache-dir', default='./bench-cache', help='scratch cache, emptied first')
+    load.set_defaults(func=bench_load)
+
+    join = sub.add_parser('join', help='pd.merge vs dense_merge on the id joins of the pipeline')
+    join.add_argument('--source', default='./input', help='directory of CSV files or the Kaggle zip')
+    join.set_defaults(func=bench_join)
+
+    uxp = sub.add_parser('uxp', help='the groupbys of the uxp predictors vs the single scan of the registry plan')
+    uxp.add_argument('--source', default='./input', help='directory of CSV files or the Kaggle zip')
+    uxp.set_defaults(func=bench_uxp)
+
+    fit = sub.add_parser('fit', help='peak RSS of fit and predict_proba on the DataFrames vs on FeatureMatrix')
+    fit.add_argument('--features', default='./features', help='feature store with data_train and data_test')
+    fit.add_argument('--scratch', default='./bench-cache/matrix', help='scratch directory for the matrices')
+    fit.set_defaults(func=bench_fit)
+
+    opts = parser.parse_args(argv)
+    opts.func(opts)
+
+
+if __name__ == '__main__':
+    main()
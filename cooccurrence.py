@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""Basket affinity: how often a product is bought with the recent products of the user.
+
+The co-occurrence of two products is the number of prior orders that have
+both. It comes from the order X product matrix B of the store (one row per
+order, a 1 for every product of the order): C = B.T @ B, a product X product
+matrix with the number of orders of every product on its diagonal. With
+scipy.sparse:
+
+* basket_matrix(): B as a CSR matrix, straight from the order offsets of the
+  OrderStore (the items of an order are already contiguous),
+* cooccurrence(): C, computed in blocks of products so that only the counts
+  of one block exist unpruned; the diagonal and the counts below min_count
+  are dropped from every block before the next one,
+* ProductAffinity: C divided by the orders of its row product, i.e. the share
+  of the orders of q that also have p, P(p | q). Its scores() give every
+  user X product pair the mean of P(p | q) over the other products q that
+  the user bought in the last 5 orders, by looking up every (q, p) of the
+  pairs of a user in the sorted (row, column) keys of the CSR matrix.
+
+A block of BLOCK_PRODUCTS rows of C holds at most BLOCK_PRODUCTS x 50k
+counts before pruning, whatever the number of orders, and min_count bounds
+what is kept. The lookups of scores() go user by user and, for every
+recent product q, over the pairs of the user in product_id order, so the
+keys searched come in sorted runs. Every pair costs one lookup per recent
+product of its user, not one per neighbour of q: the recent products are
+the popular ones, with thousands of neighbours each.
+
+    python cooccurrence.py --source ./input
+
+times fit() and scores() and shows the size of the matrix.
+
+registry.py registers the score as uxp_affinity_last5, with a fitted
+ProductAffinity as a parameter:
+
+    affinity = ProductAffinity().fit(store)
+    Plan(['uxp_affinity_last5']).run(store, affinity=affinity)
+"""
+import argparse
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+# Co-occurrences in fewer orders than this are dropped
+MIN_COUNT = 5
+
+# Products per block of cooccurrence()
+BLOCK_PRODUCTS = 256
+
+# (recent product, pair) lookups per block of ProductAffinity.scores()
+BLOCK_LOOKUPS = 1 << 24
+
+
+def basket_matrix(store):
+    """The order X product matrix of `store` (CSR, int32): a 1 for every product of every order."""
+    size = int(store.product_id.max()) + 1 if store.n_items else 0
+    ones = np.ones(store.n_items, dtype='int32')
+    baskets = sp.csr_matrix((ones, store.product_id.astype('int32'), store.order_offsets),
+                            shape=(store.n_orders, size))
+    # A product twice in an order counts once
+    baskets.sum_duplicates()
+    baskets.data[:] = 1
+    return baskets
+
+
+def cooccurrence(baskets, min_count=MIN_COUNT, block=BLOCK_PRODUCTS):
+    """The product X product CSR matrix of the orders with both products, without the diagonal and
+    the counts below `min_count`; also returns the number of orders of every product."""
+    # product X order, in CSR: rows a:b of C = B.T @ B are by_product[a:b] @ B, with no copy of B per block
+    by_product = baskets.tocsc().T.tocsr()
+    n_orders = np.diff(by_product.indptr)
+    blocks = []
+    for a in range(0, by_product.shape[0], block):
+        counts = by_product[a:a + block] @ baskets
+        # The diagonal of rows a:b is the diagonal k=a of the block
+        counts.setdiag(0, k=a)
+        counts.data[counts.data < min_count] = 0
+        counts.eliminate_zeros()
+        blocks.append(counts)
+    matrix = sp.vstack(blocks, format='csr') if blocks else sp.csr_matrix((0, 0), dtype='int32')
+    matrix.sort_indices()
+    return matrix, n_orders
+
+
+class ProductAffinity(object):
+    """P(p | q), the share of the orders of product q that also have product p, from the prior orders."""
+
+    def __init__(self, min_count=MIN_COUNT):
+        self.min_count = min_count
+        self.matrix = None
+
+    def fit(self, store):
+        """Count the co-occurrences of the orders of `store`; return self."""
+        counts, n_orders = cooccurrence(basket_matrix(store), self.min_count)
+        share = counts.astype('float32')
+        share.data /= np.repeat(n_orders, np.diff(counts.indptr)).astype('float32')
+        self.matrix = share
+        # (row, column) of every stored value, as one sorted int64 key, for lookup()
+        rows = np.repeat(np.arange(share.shape[0], dtype='int64'), np.diff(share.indptr))
+        self._keys = rows * share.shape[1] + share.indices
+        return self
+
+    @property
+    def nnz(self):
+        return 0 if self.matrix is None else self.matrix.nnz
+
+    def lookup(self, q, p):
+        """P(p | q) for the arrays of product ids `q` and `p`; 0 where the pair was pruned."""
+        if self.matrix is None:
+            raise ValueError('call fit(store) first')
+        size = self.matrix.shape[1]
+        q = np.asarray(q, dtype='int64')
+        p = np.asarray(p, dtype='int64')
+        out = np.zeros(len(q), dtype='float32')
+        if not len(self._keys):
+            return out
+        known = (q < size) & (p < size)
+        key = q * size + p if known.all() else np.where(known, q * size + p, -1)
+        at = np.searchsorted(self._keys, key)
+        np.minimum(at, len(self._keys) - 1, out=at)
+        found = self._keys[at] == key
+        out[found] = self.matrix.data[at[found]]
+        return out
+
+    def scores(self, pair_user, product_id, recent):
+        """Mean P(p | q) of every pair over the other `recent` products q of its user; NaN if there are none.
+
+        `pair_user` must be sorted, as UxpPairs.user is; `recent` marks the
+        pairs bought in the window (e.g. the last 5 orders).
+        """
+        n = len(pair_user)
+        n_users = int(pair_user[-1]) + 1 if n else 0
+        pair_offsets = np.searchsorted(pair_user, np.arange(n_users + 1))
+        # The recent products of every user, contiguous per user
+        recent_products = product_id[recent].astype('int64')
+        recent_offsets = np.concatenate([[0], np.cumsum(np.bincount(pair_user[recent], minlength=n_users))])
+        n_pairs = np.diff(pair_offsets)
+        n_recent = np.diff(recent_offsets)
+        total = np.zeros(n)
+
+        # Every user looks up (q, p) for its n_recent x n_pairs combinations, recent product after recent
+        # product: the keys of a user then come in sorted order, which keeps np.searchsorted in cache
+        combos = np.concatenate([[0], np.cumsum(n_recent * n_pairs)])
+        cuts = np.searchsorted(combos, np.arange(BLOCK_LOOKUPS, combos[-1], BLOCK_LOOKUPS))
+        bounds = np.unique(np.concatenate([[0], cuts, [n_users]]))
+        recent_user = pair_user[recent]
+        for ua, ub in zip(bounds[:-1], bounds[1:]):
+            # One segment per recent product of the block, with the pairs of its user
+            ra, rb = recent_offsets[ua], recent_offsets[ub]
+            first = pair_offsets[recent_user[ra:rb]]
+            lengths = n_pairs[recent_user[ra:rb]]
+            starts = np.cumsum(lengths) - lengths
+            pair = np.arange(lengths.sum()) + np.repeat(first - starts, lengths)
+            q = np.repeat(recent_products[ra:rb], lengths)
+            lo, hi = pair_offsets[ua], pair_offsets[ub]
+            total[lo:hi] = np.bincount(pair - lo, weights=self.lookup(q, product_id[pair]), minlength=hi - lo)
+        # The product itself is not one of the others (its own share is 0 on the diagonal)
+        others = n_recent[pair_user] - recent.astype('int64')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(others > 0, total / np.maximum(others, 1), np.nan)
+
+    def __repr__(self):
+        # The settings only: the orders that it is fitted on are part of the key of the input data
+        return 'ProductAffinity(min_count=%d)' % self.min_count
+
+
+def main(argv=None):
+    from data_loader import load_tables
+    from order_store import OrderStore
+    from registry import Plan
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--source', default='./input', help='directory of CSV files or the Kaggle zip')
+    parser.add_argument('--min-count', type=int, default=MIN_COUNT)
+    opts = parser.parse_args(argv)
+    tables = load_tables(opts.source, cache_dir=None, tables=['orders', 'order_products__prior'])
+    store = OrderStore.from_tables(tables['orders'], tables['order_products__prior'])
+    del tables
+    start = time.perf_counter()
+    affinity = ProductAffinity(opts.min_count).fit(store)
+    matrix = affinity.matrix
+    size = (matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes + affinity._keys.nbytes) / 1e6
+    print('fit: %.1f s, %d products, %d co-occurrences kept (%.0f MB)'
+          % (time.perf_counter() - start, matrix.shape[0], matrix.nnz, size))
+    start = time.perf_counter()
+    uxp = Plan(['uxp_affinity_last5']).run(store, affinity=affinity)['uxp']
+    print('uxp_affinity_last5: %.1f s for %d pairs' % (time.perf_counter() - start, len(uxp)))
+
+
+if __name__ == '__main__':
+    main()
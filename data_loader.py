@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""Load the six Instacart CSV files, with an on-disk columnar cache.
+
+The CSV files are read either from a directory or straight out of the Kaggle
+archive, which holds one zip per table (orders.csv.zip, ...). Nothing is
+extracted to disk: the inner archives are opened inside the outer one and the
+CSV is decompressed on the fly while it is parsed.
+
+The tables are parsed concurrently, each by the multithreaded Arrow CSV
+reader, which splits a file in blocks of bytes and parses the blocks in
+parallel. This way the big order_products__prior file uses all the cores too.
+
+Every table is parsed with the column types declared in schema.py. The first
+time a CSV is loaded it is parsed by the Arrow reader (or by pandas, with
+engine='pandas') and written to the cache directory as an uncompressed Arrow
+IPC (Feather) file. The cache file name contains a hash of the CSV content
+and of the schema, so later runs memory-map the Feather file instead of
+parsing the CSV again, and an edited CSV or schema gets a new entry. It also
+contains a hash of the path of the source: a new entry only replaces the
+older ones of the same source, so several sources (e.g. the Kaggle archive
+and a synthetic directory) can share one cache directory.
+"""
+import contextlib
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+from pyarrow import feather
+
+from schema import DTYPES, schema_key
+
+# The six tables that Instacart provides, in the order the notebook loads them
+TABLES = ['orders', 'order_products__train', 'order_products__prior',
+          'products', 'aisles', 'departments']
+
+# Bump this when the way we parse or store a table changes, so old cache files are ignored
+CACHE_VERSION = 1
+
+INDEX_FILE = 'index.json'
+
+# Size of the blocks of a CSV file that the Arrow reader parses in parallel
+BLOCK_SIZE = 16 << 20
+
+# The tables are loaded in parallel threads, which share the cache index
+_index_lock = threading.Lock()
+
+
+def file_digest(path, block_size=1 << 20):
+    """Return the SHA-1 hex digest of a file, read in blocks of `block_size` bytes."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _read_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, INDEX_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_index(cache_dir, index):
+    tmp = os.path.join(cache_dir, INDEX_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(cache_dir, INDEX_FILE))
+
+
+def _find_member(zf, name):
+    # Kaggle archives may also contain __MACOSX/ resource forks with the same file names
+    for info in zf.infolist():
+        if os.path.basename(info.filename) == name and not info.filename.startswith('__MACOSX'):
+            return info
+    return None
+
+
+def is_archive(source):
+    """Return True if `source` is a zip archive rather than a directory of CSV files."""
+    return os.path.isfile(source) and zipfile.is_zipfile(source)
+
+
+@contextlib.contextmanager
+def open_csv(source, table):
+    """Open `table`.csv for reading in binary mode, from a directory or from the Kaggle archive.
+
+    In the archive the CSV may sit directly in the outer zip or in an inner
+    `table`.csv.zip. An inner zip needs random access to read its central
+    directory: when it is stored uncompressed we seek in the outer archive
+    directly, otherwise the compressed inner archive (not the CSV) is held in
+    memory.
+    """
+    if not is_archive(source):
+        with open(os.path.join(source, table + '.csv'), 'rb') as f:
+            yield f
+        return
+
+    with zipfile.ZipFile(source) as outer:
+        info = _find_member(outer, table + '.csv')
+        if info is not None:
+            with outer.open(info) as f:
+                yield f
+            return
+
+        info = _find_member(outer, table + '.csv.zip')
+        if info is None:
+            raise FileNotFoundError('%s.csv not found in %s' % (table, source))
+        with outer.open(info) as raw:
+            inner_file = raw if info.compress_type == zipfile.ZIP_STORED else io.BytesIO(raw.read())
+            with zipfile.ZipFile(inner_file) as inner:
+                csv_info = _find_member(inner, table + '.csv')
+                if csv_info is None:
+                    raise FileNotFoundError('%s.csv not found in %s/%s' % (table, source, info.filename))
+                with inner.open(csv_info) as f:
+                    yield f
+
+
+class CountingReader(io.RawIOBase):
+    """Wrap a binary stream and count the bytes read from it."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.raw.readinto(b)
+        self.bytes_read += n or 0
+        return n
+
+
+def archive_key(archive_path, table):
+    """Return a content key for `table` inside the Kaggle archive.
+
+    Zip files store the CRC-32 and the size of every member in their central
+    directory, so the key is available without decompressing anything.
+    """
+    with zipfile.ZipFile(archive_path) as outer:
+        info = _find_member(outer, table + '.csv') or _find_member(outer, table + '.csv.zip')
+        if info is None:
+            raise FileNotFoundError('%s.csv not found in %s' % (table, archive_path))
+        return 'zip:%s:%08x:%d' % (info.filename, info.CRC, info.file_size)
+
+
+def content_key(csv_path, cache_dir):
+    """Return the content hash of `csv_path`.
+
+    Hashing a 500 MB CSV still takes a second, so the digest is remembered in
+    the cache index together with the file size and modification time, and is
+    only recomputed when one of them changes.
+    """
+    st = os.stat(csv_path)
+    with _index_lock:
+        entry = _read_index(cache_dir).get(os.path.abspath(csv_path))
+    if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+        return entry['digest']
+    digest = file_digest(csv_path)
+    with _index_lock:
+        index = _read_index(cache_dir)
+        index[os.path.abspath(csv_path)] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'digest': digest}
+        _write_index(cache_dir, index)
+    return digest
+
+
+def source_key(source):
+    """Return a short hash of the path of `source`, so that several sources can share a cache directory."""
+    return hashlib.sha1(os.path.abspath(source).encode()).hexdigest()[:8]
+
+
+def cache_path(cache_dir, table, digest, source):
+    """Return the Feather file that caches `table` of `source` for CSV content `digest` and the current schema."""
+    key = hashlib.sha1((digest + schema_key(table)).encode()).hexdigest()
+    return os.path.join(cache_dir, '%s-%s-v%d-%s.feather' % (table, source_key(source), CACHE_VERSION, key[:16]))
+
+
+def _arrow_type(dtype):
+    if dtype == 'category':
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.from_numpy_dtype(dtype)
+
+
+def parse_csv(f, table, engine='arrow'):
+    """Parse one CSV (a path or a binary file object) with the column types of `table` from schema.py.
+
+    engine='arrow' parses blocks of the file in parallel on all cores,
+    engine='pandas' uses pd.read_csv on one core. Both return the same DataFrame.
+    """
+    if engine == 'pandas':
+        return pd.read_csv(f, dtype=DTYPES[table])
+
+    types = {col: _arrow_type(dtype) for col, dtype in DTYPES[table].items()}
+    df = pa_csv.read_csv(f, read_options=pa_csv.ReadOptions(block_size=BLOCK_SIZE, use_threads=True),
+                         convert_options=pa_csv.ConvertOptions(column_types=types)).to_pandas()
+    # Arrow keeps the categories in order of appearance, pandas sorts them
+    for col, dtype in DTYPES[table].items():
+        if dtype == 'category':
+            df[col] = df[col].cat.reorder_categories(sorted(df[col].cat.categories))
+    return df
+
+
+def _drop_stale(cache_dir, table, source, keep):
+    # Remove the cache files of older versions of the same table from the same source; other sources keep theirs
+    prefix = '%s-%s-v' % (table, source_key(source))
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(prefix) and name.endswith('.feather') and path != keep:
+            os.remove(path)
+
+
+def _record(stats, table, origin, nbytes, start):
+    if stats is not None:
+        stats[table] = {'origin': origin, 'MB_read': nbytes / 1e6, 'seconds': time.perf_counter() - start}
+
+
+def read_table(source, table, cache_dir=None, stats=None, engine='arrow'):
+    """Load one table from `source` (a directory or the Kaggle archive).
+
+    The table goes through the Feather cache when `cache_dir` is set. If
+    `stats` is a dict, the origin of the table (csv, zip or cache), the
+    megabytes read and the wall time are stored in stats[table]. `engine` is
+    passed to parse_csv().
+    """
+    start = time.perf_counter()
+    origin = 'zip' if is_archive(source) else 'csv'
+    path = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        if origin == 'zip':
+            key = archive_key(source, table)
+        else:
+            key = content_key(os.path.join(source, table + '.csv'), cache_dir)
+        path = cache_path(cache_dir, table, key, source)
+        if os.path.exists(path):
+            df = feather.read_feather(path, memory_map=True)
+            _record(stats, table, 'cache', os.path.getsize(path), start)
+            return df
+
+    with open_csv(source, table) as f:
+        reader = CountingReader(f)
+        df = parse_csv(reader, table, engine)
+
+    if path is not None:
+        # Write to a temporary name first, so an interrupted run never leaves a half-written cache file
+        feather.write_feather(df, path + '.tmp', compression='uncompressed')
+        os.replace(path + '.tmp', path)
+        _drop_stale(cache_dir, table, source, keep=path)
+    _record(stats, table, origin, reader.bytes_read, start)
+    return df
+
+
+def load_tables(source='../input', cache_dir='../cache', tables=TABLES, stats=None,
+                engine='arrow', workers=None):
+    """Load the Instacart tables and return them in a dict keyed by table name.
+
+    `source` is either a directory with the CSV files or the Kaggle archive
+    (Instacart-Market-Basket-Analysis.zip). Pass `cache_dir=None` to always
+    parse the CSV files, and a dict as `stats` to get the bytes read and the
+    wall time per table.
+
+    The tables are loaded by `workers` threads (default: one per table).
+    Use workers=1 and engine='pandas' to parse them one after the other on a
+    single core, as pd.read_csv does.
+    """
+    with ThreadPoolExecutor(max_workers=workers or len(tables)) as pool:
+        futures = {table: pool.submit(read_table, source, table, cache_dir, stats, engine)
+                   for table in tables}
+        return {table: future.result() for table, future in futures.items()}
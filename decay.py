@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Reorder ratios where recent orders weigh more, for several half-lives at once.
+
+u_reordered_ratio and uxp_reorder_ratio weigh every prior order the same.
+Here an order of age a weighs 2 ** (-a / h), for a half-life h, with the age
+counted in orders (order_number_back - 1) or in days (the days from the order
+to the last order of its user, from the cumulative days_since_prior_order):
+
+* u_reordered_ratio: the weighted share of reordered products in the user's baskets,
+* uxp_reorder_ratio: the weight of the orders with the product over the
+  weight of the orders since the first purchase of the product (Order_Range_D).
+
+The weights of all the half-lives are the columns of one (orders x
+half-lives) matrix, and every ratio is a segmented sum of it over the sorted
+arrays of the store: per user with np.add.reduceat over the orders, and per
+pair with running sums over the orders (the denominators) and np.add.reduceat
+over the items of the pairs (the numerators). With an infinite half-life they
+are the unweighted ratios.
+"""
+import numpy as np
+
+# Items per block of the per-pair sums, to bound the (items x half-lives) matrix
+BLOCK_ITEMS = 1 << 22
+
+
+def order_age(store, by):
+    """Age of every order of the store, in orders ('orders') or in days ('days'), 0 for the last order."""
+    if by == 'orders':
+        return (store.order_number_back() - 1).astype('float64')
+    if by == 'days':
+        days = np.nan_to_num(store.days_since_prior_order.astype('float64'))
+        running = np.cumsum(days)
+        last = np.repeat(running[store.user_offsets[1:] - 1], np.diff(store.user_offsets))
+        return last - running
+    raise ValueError("by must be 'orders' or 'days'")
+
+
+def weights(store, by, half_lives):
+    """The (orders x half-lives) matrix of the weights 2 ** (-age / half-life)."""
+    return np.exp2(-order_age(store, by)[:, None] / np.asarray(half_lives, dtype='float64')[None, :])
+
+
+def user_ratios(store, by, half_lives):
+    """Decayed u_reordered_ratio of every user, one column per half-life."""
+    w = weights(store, by, half_lives)
+    basket = np.diff(store.order_offsets)
+    reordered = np.add.reduceat(store.reordered.astype('int64'), store.order_offsets[:-1])
+    starts = store.user_offsets[:-1]
+    return np.add.reduceat(w * reordered[:, None], starts) / np.add.reduceat(w * basket[:, None], starts)
+
+
+def pair_ratios(store, pairs, by, half_lives):
+    """Decayed uxp_reorder_ratio of every pair of `pairs` (UxpPairs of `store`), one column per half-life."""
+    w = weights(store, by, half_lives)
+    item_order = store.item_order()[pairs.sort]
+    first_order = item_order[pairs.starts]
+    last_order = store.user_offsets[1:][pairs.user] - 1
+
+    # Order_Range_D: the weight of the orders from the first purchase to the last order of the user
+    running = np.concatenate([np.zeros((1, w.shape[1])), np.cumsum(w, axis=0)])
+    order_range = running[last_order + 1] - running[first_order]
+
+    # Times_Bought_N: the weight of the orders with the product, in blocks of whole pairs
+    bought = np.empty((len(pairs), w.shape[1]))
+    cuts = np.unique(np.append(np.searchsorted(pairs.starts, np.arange(0, len(item_order), BLOCK_ITEMS)),
+                               len(pairs)))
+    for a, b in zip(cuts[:-1], cuts[1:]):
+        lo, hi = pairs.starts[a], pairs.ends[b - 1]
+        bought[a:b] = np.add.reduceat(w[item_order[lo:hi]], pairs.starts[a:b] - lo, axis=0)
+    return bought / order_range
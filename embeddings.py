@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""User and product vectors from a low-rank factorisation of the purchases.
+
+The predictors of registry.py are counts and ratios of every user, product
+or pair on its own. The user X product matrix M of the prior orders (one
+row per user of the store, one column per product_id, log(1 + times
+bought) in every cell that was bought) also says which users buy alike and
+which products are bought by the same users. A truncated SVD keeps the k
+strongest directions of M:
+
+    M ~ U diag(s) V.T,   users = U sqrt(s),   products = V sqrt(s)
+
+so that the dot product of the vectors of a user and a product is the
+rank-k approximation of their cell, also for the products that the user
+never bought. Embeddings.fit() computes it with the randomized SVD of
+scikit-learn, which multiplies the sparse M by a few dense blocks of k + 10
+columns and never forms M as a dense array: the memory is that of M (one
+value per pair) and of the users x (k + 10) and products x (k + 10) blocks.
+
+registry.py registers the score of every pair (uxp_embedding_score) and the
+first EMBEDDING_DIMS components of the vectors (u_emb_0, ..., p_emb_0, ...),
+with a fitted Embeddings as a parameter:
+
+    embeddings = Embeddings(k=32).fit(store)
+    Plan(['uxp_embedding_score', 'u_emb_0']).run(store, embeddings=embeddings)
+
+    python embeddings.py --source ./input --k 32 64 128
+
+times the factorisation and the scores for every k, with their peak memory
+above the matrix and the share of M that the k components explain.
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.sparse as sp
+
+# Pairs per block of Embeddings.scores(), to bound the vectors gathered at once
+BLOCK_PAIRS = 1 << 18
+
+
+def interaction_matrix(pair_user, product_id, count, n_users, n_products):
+    """The user X product CSR matrix (float32) with log(1 + count) for every pair."""
+    values = np.log1p(np.asarray(count, dtype='float32'))
+    return sp.csr_matrix((values, (pair_user, product_id)), shape=(n_users, n_products))
+
+
+class Embeddings(object):
+    """k-dimensional vectors of the users (by position in the store) and of the products (by product_id)."""
+
+    def __init__(self, k=32, n_iter=4, random_state=0):
+        self.k = k
+        self.n_iter = n_iter
+        self.random_state = random_state
+        self.users = None
+        self.products = None
+        # Share of the squared norm of the matrix that the k components keep
+        self.explained = None
+
+    def fit(self, store):
+        """Factorise the user X product matrix of `store`; return self."""
+        from order_store import UxpPairs
+        pairs = UxpPairs(store)
+        n_products = int(store.product_id.max()) + 1 if store.n_items else 0
+        return self.fit_matrix(interaction_matrix(pairs.user, pairs.product_id, pairs.count,
+                                                  store.n_users, n_products))
+
+    def fit_matrix(self, matrix):
+        """Factorise a sparse user X product `matrix`; return self."""
+        from sklearn.utils.extmath import randomized_svd
+        u, s, vt = randomized_svd(matrix, self.k, n_iter=self.n_iter, random_state=self.random_state)
+        root = np.sqrt(s)
+        self.users = (u * root).astype('float32')
+        self.products = (vt.T * root).astype('float32')
+        total = float(np.dot(matrix.data, matrix.data))
+        self.explained = float((s ** 2).sum()) / total if total else 0.0
+        return self
+
+    def scores(self, pair_user, product_id):
+        """The dot product of the user and product vectors of every pair."""
+        if self.users is None:
+            raise ValueError('call fit(store) first')
+        out = np.empty(len(pair_user), dtype='float32')
+        for lo in range(0, len(pair_user), BLOCK_PAIRS):
+            hi = min(lo + BLOCK_PAIRS, len(pair_user))
+            out[lo:hi] = np.einsum('ij,ij->i', self.users[pair_user[lo:hi]], self.products[product_id[lo:hi]])
+        return out
+
+    def __repr__(self):
+        # The settings only: the orders that it is fitted on are part of the key of the input data
+        return 'Embeddings(k=%d, n_iter=%d, random_state=%r)' % (self.k, self.n_iter, self.random_state)
+
+
+def main(argv=None):
+    from data_loader import load_tables
+    from order_store import OrderStore, UxpPairs
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--source', default='./input', help='directory of CSV files or the Kaggle zip')
+    parser.add_argument('--k', type=int, nargs='+', default=[32, 64, 128], help='numbers of components to try')
+    parser.add_argument('--n-iter', type=int, default=4, help='power iterations of the randomized SVD')
+    opts = parser.parse_args(argv)
+    tables = load_tables(opts.source, cache_dir=None, tables=['orders', 'order_products__prior'])
+    store = OrderStore.from_tables(tables['orders'], tables['order_products__prior'])
+    del tables
+    pairs = UxpPairs(store)
+    matrix = interaction_matrix(pairs.user, pairs.product_id, pairs.count, store.n_users,
+                                int(store.product_id.max()) + 1)
+    size = (matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes) / 1e6
+    print('%d users x %d products, %d pairs (%.0f MB sparse)' % (matrix.shape + (matrix.nnz, size)))
+    # Loaded before the timings start
+    import sklearn.utils.extmath
+    for k in opts.k:
+        tracemalloc.start()
+        start = time.perf_counter()
+        embeddings = Embeddings(k, opts.n_iter).fit_matrix(matrix)
+        fit = time.perf_counter() - start
+        fit_peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        embeddings.scores(pairs.user, pairs.product_id)
+        score = time.perf_counter() - start
+        score_peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+        print('k=%3d: fit %.1f s (peak %.0f MB), scores %.1f s (peak %.0f MB), explains %.1f%% of M'
+              % (k, fit, fit_peak, score, score_peak, 100 * embeddings.explained))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Keep the feature tables on disk, keyed by their inputs and definitions.
+
+The notebook computes user, prd and uxp (chapter 2) and then data_train and
+data_test (chapter 3) in memory, and deletes them as soon as they are merged.
+Any change to the model stage therefore meant computing every feature again.
+A FeatureStore writes the tables once under a key, and later runs with the
+same key load them instead:
+
+    store = FeatureStore('./features')
+    key = store.key(store.input_key(archive, ['orders', 'order_products__prior']),
+                    plan.definition_key(min_purchases=40))
+    tables = store.load_or_build(key, plan.grains, lambda: plan.run(OrderStore.from_op(op), min_purchases=40))
+
+The key is a hash of the input data (input_key() from the zip index or the CSV
+content, frame_key() from a DataFrame in memory) and of the definitions of
+the features (Plan.definition_key()). A new CSV, another parameter or an edit
+of the feature code gives a new key and so a new version of the tables; the
+old versions stay on disk until remove() deletes them.
+
+Every table is stored in its own directory, <root>/<name>/<key>/, as
+uncompressed Feather parts that split the rows into ranges of user_id (or
+product_id) with _meta.json describing the parts. load() memory-maps one
+part at a time and copies it into the columns of the DataFrame it returns,
+so besides that DataFrame only one part is in memory. stats keeps a hit or a miss per table, with the
+megabytes and the seconds, and report() shows them.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+from data_loader import CACHE_VERSION, archive_key, content_key, is_archive
+from schema import schema_key
+
+# Bump this when the way we store a table changes, so old versions are not loaded
+STORE_VERSION = 1
+
+META_FILE = '_meta.json'
+
+# The rows are split into parts by ranges of the first of these columns
+PARTITION_COLUMNS = ('user_id', 'product_id')
+
+# Rows per part, before moving the cut to the next change of the partition column
+ROWS_PER_PART = 1 << 20
+
+
+def frame_key(df):
+    """Return a hash of the columns, types and values of a DataFrame."""
+    sha = hashlib.sha1()
+    for col in df.columns:
+        values = df[col]
+        sha.update(('%s:%s;' % (col, values.dtype)).encode())
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            sha.update(repr(list(values.cat.categories)).encode())
+            values = values.cat.codes
+        sha.update(np.ascontiguousarray(values.values).data)
+    return sha.hexdigest()
+
+
+def _cuts(values, rows_per_part):
+    # Row offsets of the parts: about rows_per_part rows each, never splitting
+    # the rows of one id when the partition column is sorted
+    n = len(values)
+    if not n:
+        return np.array([0, 0])
+    cuts = np.arange(rows_per_part, n, rows_per_part)
+    if (np.diff(values.astype('int64')) >= 0).all():
+        cuts = np.searchsorted(values, values[cuts], side='left')
+    return np.unique(np.concatenate([[0], cuts, [n]]))
+
+
+def _read_parts(folder, meta, columns):
+    # One DataFrame of all the parts, filled part by part: a part is mapped and converted, copied into
+    # its rows of every column and released before the next one
+    files = [os.path.join(folder, p['file']) for p in meta['parts']]
+    if not files:
+        return pd.DataFrame()
+    first = feather.read_table(files[0], columns=columns, memory_map=True).to_pandas()
+    if len(files) == 1:
+        return first
+    if not all(isinstance(dtype, np.dtype) for dtype in first.dtypes):
+        # Categorical or other pandas types: let Arrow concatenate them
+        tables = [feather.read_table(f, columns=columns, memory_map=True) for f in files]
+        return pa.concat_tables(tables).to_pandas()
+    dtypes = first.dtypes
+    del first
+    out = {col: np.empty(meta['rows'], dtype=dtype) for col, dtype in dtypes.items()}
+    start = 0
+    for path in files:
+        part = feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+        for col in out:
+            out[col][start:start + len(part)] = part[col].values
+        start += len(part)
+        del part
+    return pd.DataFrame(out, copy=False)
+
+
+class FeatureStore(object):
+    """Feature tables in `root`, versioned by key; see the module docstring."""
+
+    def __init__(self, root='./features', rows_per_part=ROWS_PER_PART):
+        self.root = root
+        self.rows_per_part = rows_per_part
+        # Hit or miss, MB and seconds of every table loaded or built
+        self.stats = {}
+
+    ########################################
+    ## KEYS
+    ########################################
+    @staticmethod
+    def key(*parts):
+        """Combine several keys (hashes, parameters, version strings) into one."""
+        return hashlib.sha1('\n'.join(str(p) for p in parts).encode()).hexdigest()
+
+    def input_key(self, source, tables):
+        """Key of the content of `tables` in `source` (a directory or the Kaggle archive) and of their schema.
+
+        The zip index gives the CRC of every table, so nothing is read; the
+        hashes of CSV files are remembered in <root>/index.json, as the
+        Feather cache of data_loader.py does.
+        """
+        parts = ['v%d' % CACHE_VERSION]
+        for table in tables:
+            if is_archive(source):
+                digest = archive_key(source, table)
+            else:
+                os.makedirs(self.root, exist_ok=True)
+                digest = content_key(os.path.join(source, table + '.csv'), self.root)
+            parts.append('%s=%s;%s' % (table, digest, schema_key(table)))
+        return self.key(*parts)
+
+    ########################################
+    ## STORE AND LOAD
+    ########################################
+    def path(self, name, key):
+        return os.path.join(self.root, name, '%s-v%d' % (key[:16], STORE_VERSION))
+
+    def has(self, key, names):
+        """True if all the tables `names` are stored under `key`."""
+        return all(os.path.exists(os.path.join(self.path(name, key), META_FILE)) for name in names)
+
+    def versions(self, name):
+        """The metadata of every stored version of table `name`, newest first."""
+        folder = os.path.join(self.root, name)
+        metas = []
+        for entry in os.listdir(folder) if os.path.isdir(folder) else []:
+            try:
+                with open(os.path.join(folder, entry, META_FILE)) as f:
+                    metas.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return sorted(metas, key=lambda m: m['created'], reverse=True)
+
+    def remove(self, name, key):
+        """Delete the version `key` of table `name`."""
+        shutil.rmtree(self.path(name, key), ignore_errors=True)
+
+    def save(self, key, tables):
+        """Write the DataFrames of the dict `tables` under `key`, replacing any stored version with that key."""
+        for name, df in tables.items():
+            start = time.perf_counter()
+            index = [n for n in df.index.names if n is not None]
+            flat = df.reset_index() if index else df.reset_index(drop=True)
+            by = next((c for c in PARTITION_COLUMNS if c in flat.columns), None)
+            cuts = _cuts(flat[by].values if by else np.arange(len(flat)), self.rows_per_part)
+
+            # Write to a temporary directory first, so an interrupted run never leaves a half-written version
+            final = self.path(name, key)
+            tmp = final + '.tmp'
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            parts = []
+            for i, (a, b) in enumerate(zip(cuts[:-1], cuts[1:])):
+                part = 'part-%05d.feather' % i
+                feather.write_feather(flat.iloc[a:b].reset_index(drop=True), os.path.join(tmp, part),
+                                      compression='uncompressed')
+                info = {'file': part, 'rows': int(b - a)}
+                if by and b > a:
+                    info.update(min=int(flat[by].iat[a]), max=int(flat[by].iat[b - 1]))
+                parts.append(info)
+            meta = {'name': name, 'key': key, 'rows': len(flat), 'index': index, 'partition_by': by,
+                    'parts': parts, 'created': time.time()}
+            with open(os.path.join(tmp, META_FILE), 'w') as f:
+                json.dump(meta, f, indent=1)
+            shutil.rmtree(final, ignore_errors=True)
+            os.replace(tmp, final)
+            self._record(name, key, 'miss', final, start)
+
+    def load(self, key, names, columns=None):
+        """Read the tables `names` stored under `key`; return them in a dict.
+
+        `columns` restricts the columns that are read (the index columns are
+        always read). Raises KeyError if a table is not stored.
+        """
+        tables = {}
+        for name in names:
+            start = time.perf_counter()
+            folder = self.path(name, key)
+            try:
+                with open(os.path.join(folder, META_FILE)) as f:
+                    meta = json.load(f)
+            except OSError:
+                raise KeyError('%s is not stored under key %s' % (name, key[:16]))
+            read = None if columns is None else meta['index'] + [c for c in columns if c not in meta['index']]
+            df = _read_parts(folder, meta, read)
+            tables[name] = df.set_index(meta['index']) if meta['index'] else df
+            self._record(name, key, 'hit', folder, start)
+        return tables
+
+    def load_or_build(self, key, names, build):
+        """Load the tables `names` stored under `key`, or call build() and store the dict of DataFrames it returns."""
+        if self.has(key, names):
+            return self.load(key, names)
+        tables = build()
+        self.save(key, tables)
+        return tables
+
+    def _record(self, name, key, status, folder, start):
+        size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+        self.stats[name] = {'status': status, 'key': key[:16], 'MB': size / 1e6,
+                            'seconds': time.perf_counter() - start}
+
+    def report(self):
+        """The hits and misses of the tables loaded or built so far, as a DataFrame."""
+        return pd.DataFrame(self.stats).T
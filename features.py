@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Chapter 2 of the notebook as functions: the user, product and user X product predictors.
+
+Every function takes the op DataFrame (orders merged with
+order_products_prior, see section 1.4) and returns the same DataFrame that
+the notebook builds step by step. They are the in-memory reference that the
+other ways of computing the features (e.g. streaming.py) are checked against.
+"""
+import pandas as pd
+
+from schema import compact
+
+# Number of most recent orders of each user that the "last 5" predictors look at
+LAST_N = 5
+
+# A product needs more than this many purchases to get a p_reorder_ratio
+MIN_PURCHASES = 40
+
+
+def add_order_number_back(op):
+    """Add order_number_back to op: 1 for the last order of each user, 2 for the one before, ..."""
+    op['order_number_back'] = op.groupby('user_id')['order_number'].transform('max') - op.order_number + 1
+    return op
+
+
+def user_features(op):
+    """2.1 User predictors: u_total_orders, u_reordered_ratio and size_last5."""
+    user = op.groupby('user_id')['order_number'].max().to_frame('u_total_orders')
+    user = user.reset_index()
+
+    u_reorder = op.groupby('user_id')['reordered'].mean().to_frame('u_reordered_ratio')
+    u_reorder = u_reorder.reset_index()
+
+    op5 = op[op.order_number_back <= LAST_N]
+    last_five = op5.groupby(['user_id', 'product_id'])[['order_id']].count()
+    last_five.columns = ['times_last5']
+    u_last_five = last_five.groupby('user_id')[['times_last5']].count()
+    u_last_five.columns = ['size_last5']
+
+    user = user.merge(u_reorder, on='user_id', how='left')
+    user = user.merge(u_last_five, on='user_id', how='left')
+    return compact(user)
+
+
+def product_features(op):
+    """2.2 Product predictors: p_total_purchases, p_reorder_ratio, avg_position and p_reorder_last5."""
+    prd = op.groupby('product_id')['order_id'].count().to_frame('p_total_purchases')
+    prd = prd.reset_index()
+
+    p_reorder = op.groupby('product_id').filter(lambda x: x.shape[0] > MIN_PURCHASES)
+    p_reorder = p_reorder.groupby('product_id')[['reordered', 'add_to_cart_order']].mean()
+    p_reorder.columns = ['p_reorder_ratio', 'avg_position']
+    p_reorder = p_reorder.reset_index()
+
+    op5 = op[op.order_number_back <= LAST_N]
+    op5_ratio = op5.groupby('product_id')['reordered'].mean().to_frame('p_reorder_last5')
+    op5_ratio = op5_ratio.reset_index()
+
+    prd = prd.merge(p_reorder, on='product_id', how='left')
+    prd = prd.merge(op5_ratio, on='product_id', how='left')
+    prd['p_reorder_ratio'] = prd['p_reorder_ratio'].fillna(value=0)
+    prd['avg_position'] = prd['avg_position'].fillna(value=0)
+    prd['p_reorder_last5'] = prd['p_reorder_last5'].fillna(value=0)
+    return compact(prd)
+
+
+def uxp_features(op):
+    """2.3 User X product predictors, from uxp_total_bought to uxp_max_days."""
+    uxp = op.groupby(['user_id', 'product_id'])['order_id'].count().to_frame('uxp_total_bought')
+    uxp = uxp.reset_index()
+
+    op5 = op[op.order_number_back <= LAST_N]
+    uxp_last5 = op5.groupby(['user_id', 'product_id'])['order_id'].count().to_frame('uxp_total_bought_last5')
+    uxp_last5 = uxp_last5.reset_index()
+    uxp = uxp.merge(uxp_last5, on=['user_id', 'product_id'], how='left')
+
+    times = op.groupby(['user_id', 'product_id'])[['order_id']].count()
+    times.columns = ['Times_Bought_N']
+    total_orders = op.groupby('user_id')['order_number'].max().to_frame('total_orders')
+    first_order_no = op.groupby(['user_id', 'product_id'])['order_number'].min().to_frame('first_order_number')
+    first_order_no = first_order_no.reset_index()
+    span = pd.merge(total_orders, first_order_no, on='user_id', how='right')
+    span['Order_Range_D'] = span.total_orders - span.first_order_number + 1
+    uxp_ratio = pd.merge(times, span, on=['user_id', 'product_id'], how='left')
+    uxp_ratio['uxp_reorder_ratio'] = uxp_ratio.Times_Bought_N / uxp_ratio.Order_Range_D
+    uxp_ratio = uxp_ratio.drop(['Times_Bought_N', 'total_orders', 'first_order_number', 'Order_Range_D'], axis=1)
+    uxp = uxp.merge(uxp_ratio, on=['user_id', 'product_id'], how='left')
+
+    last_five = op5.groupby(['user_id', 'product_id'])[['order_id']].count()
+    last_five.columns = ['times_last5']
+    uxp = uxp.merge(last_five, on=['user_id', 'product_id'], how='left')
+    uxp = uxp.fillna(0)
+    uxp['last5_ ratio'] = uxp.times_last5 / LAST_N
+
+    # The timing of every user, computed once per user and given to all the pairs of the user
+    days = pd.DataFrame({'max_days_last5': op5.groupby('user_id')['days_since_prior_order'].max(),
+                         'med_days_last5': op5.groupby('user_id')['days_since_prior_order'].median(),
+                         'uxp_max_days': op.groupby('user_id')['days_since_prior_order'].max()})
+    uxp = uxp.merge(days.reset_index(), on='user_id', how='left')
+    uxp = uxp.fillna(0)
+    return compact(uxp)
+
+
+def build_features(orders, order_products_prior):
+    """Merge orders with order_products_prior into op and return the (user, prd, uxp) DataFrames."""
+    op = orders.merge(order_products_prior, on='order_id', how='inner')
+    op = add_order_number_back(op)
+    return user_features(op), product_features(op), uxp_features(op)
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Download the Instacart competition archive once, and resume it if it was interrupted.
+
+The archive comes from a backend: the Kaggle API, or a local directory that
+already holds a copy of it (for CI and computers without network access).
+A manifest next to the archive records its size and SHA-256 after every
+complete download, so the next runs find it there and skip the download.
+A download that was interrupted is kept as <archive>.part and continues from
+where it stopped.
+
+Kaggle credentials are read from the KAGGLE_USERNAME and KAGGLE_KEY
+environment variables, or from ~/.kaggle/kaggle.json as the kaggle package
+does, and only when something has to be downloaded: an archive that matches
+the manifest is used without them. Set INSTACART_MIRROR to a directory to use that directory instead of
+Kaggle.
+"""
+import base64
+import hashlib
+import json
+import os
+import shutil
+import urllib.error
+import urllib.request
+
+COMPETITION = 'instacart-market-basket-analysis'
+ARCHIVE = 'Instacart-Market-Basket-Analysis.zip'
+MANIFEST = 'manifest.json'
+
+KAGGLE_URL = 'https://www.kaggle.com/api/v1/competitions/data/download-all/%s'
+
+BLOCK_SIZE = 1 << 20
+
+
+def sha256(path):
+    """Return the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class LocalDirectoryBackend(object):
+    """Serve the archive from a local directory, e.g. a shared mirror or a CI fixture."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def size(self, name):
+        return os.path.getsize(os.path.join(self.directory, name))
+
+    def open(self, name, offset=0):
+        """Return (stream, offset) with the stream positioned at `offset` bytes."""
+        f = open(os.path.join(self.directory, name), 'rb')
+        f.seek(offset)
+        return f, offset
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class KaggleBackend(object):
+    """Download the competition archive from the Kaggle API, with HTTP range requests."""
+
+    def __init__(self, competition=COMPETITION, username=None, key=None):
+        self.competition = competition
+        self.username = username
+        self.key = key
+        # The size of the archive, from the headers of the last response
+        self._size = None
+
+    def _auth(self):
+        # Read when a request is made, so that a complete archive needs no credentials
+        username, key = self.username, self.key
+        if username is None or key is None:
+            username, key = kaggle_credentials()
+        return base64.b64encode(('%s:%s' % (username, key)).encode()).decode()
+
+    def _signed_url(self):
+        # Kaggle answers with a redirect to a signed storage URL, which must be
+        # requested without the Kaggle credentials
+        request = urllib.request.Request(KAGGLE_URL % self.competition,
+                                         headers={'Authorization': 'Basic ' + self._auth()})
+        opener = urllib.request.build_opener(_NoRedirect)
+        try:
+            response = opener.open(request)
+        except urllib.error.HTTPError as e:
+            if e.code in (301, 302, 303, 307, 308):
+                return e.headers['Location']
+            raise
+        response.close()
+        return response.geturl()
+
+    def size(self, name):
+        """The size that the server gives for the archive, or None if it gives none.
+
+        Known after open(); before, it costs a request for the first byte.
+        """
+        if self._size is None:
+            request = urllib.request.Request(self._signed_url(), headers={'Range': 'bytes=0-0'})
+            with urllib.request.urlopen(request) as response:
+                self._size = _total_size(response)
+        return self._size
+
+    def open(self, name, offset=0):
+        """Return (stream, offset); the offset is 0 when the server ignores the range request."""
+        url = self._signed_url()
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            # 416: the .part file already has every byte (or more), so start again
+            if e.code != 416:
+                raise
+            response = urllib.request.urlopen(urllib.request.Request(url))
+        self._size = _total_size(response)
+        return response, offset if response.status == 206 else 0
+
+
+def _total_size(response):
+    # The whole size is after the '/' of Content-Range in a partial response, else Content-Length
+    if response.status == 206:
+        total = (response.headers.get('Content-Range') or '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+
+def kaggle_credentials():
+    """Return (username, key) from the environment or from ~/.kaggle/kaggle.json."""
+    username, key = os.environ.get('KAGGLE_USERNAME'), os.environ.get('KAGGLE_KEY')
+    if username and key:
+        return username, key
+    config_dir = os.environ.get('KAGGLE_CONFIG_DIR', os.path.join(os.path.expanduser('~'), '.kaggle'))
+    try:
+        with open(os.path.join(config_dir, 'kaggle.json')) as f:
+            config = json.load(f)
+        return config['username'], config['key']
+    except (OSError, ValueError, KeyError):
+        raise RuntimeError('Kaggle credentials not found: set KAGGLE_USERNAME and KAGGLE_KEY, '
+                           'or INSTACART_MIRROR to a directory with %s' % ARCHIVE)
+
+
+def backend_from_env():
+    """Return the LocalDirectoryBackend of $INSTACART_MIRROR if it is set, else a KaggleBackend."""
+    mirror = os.environ.get('INSTACART_MIRROR')
+    if mirror:
+        return LocalDirectoryBackend(mirror)
+    return KaggleBackend()
+
+
+def _read_manifest(dest_dir):
+    try:
+        with open(os.path.join(dest_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_manifest(dest_dir, manifest):
+    tmp = os.path.join(dest_dir, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(dest_dir, MANIFEST))
+
+
+def _record(dest_dir, name, path):
+    st = os.stat(path)
+    manifest = _read_manifest(dest_dir)
+    manifest[name] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': sha256(path)}
+    _write_manifest(dest_dir, manifest)
+
+
+def is_complete(dest_dir, name=ARCHIVE, backend=None):
+    """Return True if `name` in `dest_dir` is a complete copy of the archive.
+
+    The file must match the size and the checksum in the manifest. The
+    checksum is only recomputed when the modification time has changed. A file
+    without a manifest entry is accepted (and recorded) when its size is the
+    size that the backend reports.
+    """
+    path = os.path.join(dest_dir, name)
+    if not os.path.exists(path):
+        return False
+    st = os.stat(path)
+    entry = _read_manifest(dest_dir).get(name)
+    if entry is None:
+        if backend is not None and backend.size(name) == st.st_size:
+            _record(dest_dir, name, path)
+            return True
+        return False
+    if entry['size'] != st.st_size:
+        return False
+    if entry['mtime_ns'] == st.st_mtime_ns:
+        return True
+    if sha256(path) != entry['sha256']:
+        return False
+    _record(dest_dir, name, path)
+    return True
+
+
+def fetch_archive(dest_dir='.', backend=None, name=ARCHIVE):
+    """Make sure that the competition archive is in `dest_dir` and return its path.
+
+    Nothing is downloaded when the archive is already complete. Otherwise the
+    download continues from <archive>.part, if a previous one was interrupted,
+    and it is only kept if it has the size that the backend reports.
+    """
+    path = os.path.join(dest_dir, name)
+    # The manifest alone first: then a complete archive needs no backend, credentials or network
+    if is_complete(dest_dir, name):
+        return path
+    backend = backend or backend_from_env()
+    if name not in _read_manifest(dest_dir) and is_complete(dest_dir, name, backend):
+        return path
+
+    os.makedirs(dest_dir, exist_ok=True)
+    part = path + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    stream, offset = backend.open(name, offset)
+    with stream, open(part, 'r+b' if offset else 'wb') as f:
+        f.seek(offset)
+        f.truncate()
+        shutil.copyfileobj(stream, f, BLOCK_SIZE)
+
+    expected = backend.size(name)
+    if expected is not None and os.path.getsize(part) != expected:
+        raise IOError('incomplete download of %s: %d of %d bytes' % (name, os.path.getsize(part), expected))
+    os.replace(part, path)
+    _record(dest_dir, name, path)
+    return path
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Aisle and department predictors: product_id -> aisle_id -> department_id.
+
+Every product belongs to an aisle and every aisle to a department (the
+products and aisles tables). ProductHierarchy keeps these links as dense
+lookup arrays indexed by id (dense_join.DenseIndex), so the aisle or the
+department of millions of rows is one np.take, without joining the string
+categories of products, aisles and departments into op.
+
+The sums go through the user X product pairs (UxpPairs) rather than the
+rows of op: the purchases of a user in an aisle are the sum of the counts
+of the pairs of the user with a product of that aisle. Each is one
+np.bincount over a combined code, user * n_levels + aisle (or department),
+in blocks of users so that the dense table of a block stays small:
+
+* level_totals(): purchases and reorder rate of every aisle (department),
+* user_level_totals(): the purchases and reorders of the user in the aisle
+  (department) of every pair.
+
+registry.py turns them into uxp predictors (ua_total_bought,
+ua_reorder_ratio, a_reorder_ratio, ... see HIERARCHY_FEATURES there), with
+the hierarchy given as a parameter:
+
+    Plan(HIERARCHY_FEATURES).run(store, hierarchy=ProductHierarchy(products))
+"""
+import hashlib
+
+import numpy as np
+
+from dense_join import DenseIndex
+
+LEVELS = ('aisle', 'department')
+
+# (user, level) cells per block of user_level_totals(), to bound the dense table of a block
+BLOCK_CELLS = 1 << 22
+
+
+class ProductHierarchy(object):
+    """The aisle and the department of every product_id, as arrays indexed by id."""
+
+    def __init__(self, products):
+        index = DenseIndex(products.product_id.values)
+        if not index.unique:
+            raise ValueError('products has duplicate product_id')
+        # -1 for the ids that are not in products
+        known = index.lookup >= 0
+        row = np.maximum(index.lookup, 0)
+        self.aisle_of = np.where(known, products.aisle_id.values.astype('int64')[row], -1)
+        self.department_of = np.where(known, products.department_id.values.astype('int64')[row], -1)
+        self.size = {'aisle': int(self.aisle_of.max()) + 1, 'department': int(self.department_of.max()) + 1}
+
+    def codes(self, product_id, level):
+        """aisle_id or department_id of every product_id; raises KeyError for products it does not know."""
+        lookup = self.aisle_of if level == 'aisle' else self.department_of
+        product_id = np.asarray(product_id, dtype='int64')
+        if len(product_id) and (product_id.max() >= len(lookup) or (lookup[product_id] < 0).any()):
+            raise KeyError('product_id missing from products')
+        return lookup[product_id]
+
+    def __repr__(self):
+        # Stable across runs, so that Plan.definition_key() changes only when the hierarchy does
+        sha = hashlib.sha1(self.aisle_of.tobytes() + self.department_of.tobytes()).hexdigest()
+        return 'ProductHierarchy(%s)' % sha[:16]
+
+
+def level_totals(codes, size, count, reordered):
+    """Purchases and reorder rate per aisle (department), from the `codes`, `count` and `reordered` sums of pairs."""
+    purchases = np.bincount(codes, weights=count, minlength=size)
+    reorders = np.bincount(codes, weights=reordered, minlength=size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return purchases, np.where(purchases > 0, reorders / np.maximum(purchases, 1), np.nan)
+
+
+def _blocks(pair_user, size):
+    # Pair ranges of whole users, with at most BLOCK_CELLS (user, level) cells each
+    users_per_block = max(BLOCK_CELLS // size, 1)
+    n_users = int(pair_user[-1]) + 1 if len(pair_user) else 0
+    first_users = np.arange(0, n_users, users_per_block)
+    bounds = np.append(np.searchsorted(pair_user, first_users), len(pair_user))
+    return zip(first_users, bounds[:-1], bounds[1:])
+
+
+def user_level_totals(pair_user, codes, size, count, reordered):
+    """Purchases and reorders of the user of every pair in the aisle (department) of the pair.
+
+    `pair_user` must be sorted, as UxpPairs.user is.
+    """
+    purchases = np.empty(len(pair_user))
+    reorders = np.empty(len(pair_user))
+    for first, lo, hi in _blocks(pair_user, size):
+        cell = (pair_user[lo:hi] - first) * size + codes[lo:hi]
+        n_cells = (int(pair_user[hi - 1]) - first + 1) * size if hi > lo else 0
+        purchases[lo:hi] = np.bincount(cell, weights=count[lo:hi], minlength=n_cells)[cell]
+        reorders[lo:hi] = np.bincount(cell, weights=reordered[lo:hi], minlength=n_cells)[cell]
+    return purchases, reorders
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""Keep the user, prd and uxp predictors up to date as new orders arrive.
+
+IncrementalFeatures stores the same mergeable aggregates as streaming.py
+(counts, sums, first order numbers, the orders of the last-5 window) and
+updates them with every batch of new orders and their products, instead of
+recomputing chapter 2 over all the prior orders. Only the rows of the users,
+products and user X product pairs that appear in a batch are touched:
+
+* users and products: arrays indexed by user_id and product_id, updated with np.add.at and friends,
+* pairs: arrays sorted by (user_id, product_id). New pairs go into a small
+  sorted delta, which is merged into the main arrays once it holds
+  MERGE_PAIRS pairs, so a batch does not copy all the pairs,
+* the last-5 window: the orders of the last 5 orders of every user and their
+  items, in arrays that are only appended to, and for every user the rows
+  of its orders in `window` slots (by order_number % window). A batch reads
+  the slots of its users only: when new orders push older ones out of the
+  window, their items are subtracted from the last-5 counts of their pairs
+  and products. The rows of the orders that left are dropped when the
+  arrays are full, which happens less often as they grow.
+
+An update therefore costs O(batch) (times log of the pairs for the
+lookups), plus the occasional merge of the delta or of the window arrays,
+instead of O(all the pairs and last-5 items).
+
+With sketches=sketches.SketchAggregates(), every batch also goes into the
+count-min and HyperLogLog sketches of sketches.py, and the orders that enter
+or leave the last-5 window into its histograms of days_since_prior_order.
+
+features() turns the aggregates into (user, prd, uxp), with streaming.finalize(),
+the same DataFrames as features.build_features() over all the orders.
+check_equivalence() replays the last prior orders of every user as batches
+and compares the result with a full recompute, and update_scaling() times
+the same batches on states of more and more users:
+
+    python incremental.py --source ./input --holdout 3
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from dense_join import dense_merge
+from features import LAST_N
+from schema import ID
+from streaming import finalize
+
+# A pair key is (user_id << 32) | product_id, so sorting the keys sorts the pairs by (user_id, product_id)
+KEY_SHIFT = 32
+
+# New pairs wait in a sorted delta of at most this many pairs before they are merged into the main arrays
+MERGE_PAIRS = 1 << 18
+
+ORDER_COLUMNS = ['order_id', 'user_id', 'order_number', 'days_since_prior_order']
+
+
+def pair_key(user_id, product_id):
+    return (np.asarray(user_id).astype('int64') << KEY_SHIFT) | np.asarray(product_id).astype('int64')
+
+
+def _grow(arrays, size, fill):
+    # Enlarge the arrays indexed by id to hold id size - 1, doubling the capacity to amortize the copies
+    old = len(next(iter(arrays.values())))
+    if size <= old:
+        return arrays
+    new = max(size, 2 * old)
+    return {name: np.concatenate([a, np.full((new - old,) + a.shape[1:], fill[name], dtype=a.dtype)])
+            for name, a in arrays.items()}
+
+
+def _empty(dtypes):
+    return {name: np.zeros(0, dtype) for name, dtype in dtypes.items()}
+
+
+def _find(pairs, keys):
+    # Row of every key in sorted pair arrays, and whether it is there
+    rows = np.searchsorted(pairs['key'], keys)
+    found = rows < len(pairs['key'])
+    found[found] = pairs['key'][rows[found]] == keys[found]
+    return rows, found
+
+
+def _ranges(start, length):
+    # start[i], ..., start[i] + length[i] - 1 for every i, one after the other
+    offsets = np.cumsum(length) - length
+    return np.arange(offsets[-1] + length[-1] if len(length) else 0) + np.repeat(start - offsets, length)
+
+
+class IncrementalFeatures(object):
+    """The aggregates behind user, prd and uxp, updated in place by batches of new orders."""
+
+    def __init__(self, window=LAST_N, sketches=None):
+        self.window = window
+        # Optional sketches.SketchAggregates, updated with every batch as well
+        self.sketches = sketches
+        self.users = {'n': np.zeros(0, 'int64'), 'reordered': np.zeros(0, 'int64'),
+                      'max_days': np.zeros(0, 'float32'), 'total_orders': np.zeros(0, 'int64'),
+                      # slots[u, order_number % window]: the row in recent_orders of that order of u, or -1
+                      'slots': np.zeros((0, window), 'int64')}
+        self.products = {'n': np.zeros(0, 'int64'), 'reordered': np.zeros(0, 'int64'),
+                         'add_to_cart_order': np.zeros(0, 'int64'),
+                         'n_last5': np.zeros(0, 'int64'), 'reordered_last5': np.zeros(0, 'int64')}
+        pair_dtypes = dict.fromkeys(['key', 'n', 'first_order_number', 'n_last5'], 'int64')
+        self.pairs = _empty(pair_dtypes)
+        # The pairs that are not in self.pairs yet, sorted by key as well
+        self.new_pairs = _empty(pair_dtypes)
+        # The orders of the last `window` orders of every user, with their items from recent_items[start]
+        # to recent_items[start + n - 1]. Rows are only appended; the ones of the orders that left the
+        # window are dropped when the arrays are full.
+        self.recent_orders = _empty({'user_id': 'int64', 'order_number': 'int64',
+                                     'days_since_prior_order': 'float32', 'n': 'int64', 'start': 'int64'})
+        self.recent_items = _empty({'user_id': 'int64', 'product_id': 'int64', 'reordered': 'int64'})
+        self.n_recent_orders = 0
+        self.n_recent_items = 0
+
+    @classmethod
+    def from_tables(cls, orders, order_products_prior, window=LAST_N, sketches=None):
+        """Build the aggregates of all the prior orders at once (as a first batch)."""
+        state = cls(window, sketches)
+        state.update(orders, order_products_prior)
+        return state
+
+    def _add_to_pairs(self, keys, column, values):
+        # Add values to a column of the existing pairs `keys`, which are in self.pairs or self.new_pairs
+        rows, found = _find(self.pairs, keys)
+        np.add.at(self.pairs[column], rows[found], values[found])
+        rows, _ = _find(self.new_pairs, keys[~found])
+        np.add.at(self.new_pairs[column], rows, values[~found])
+
+    def _merge_pairs(self):
+        # Insert the delta into the main pair arrays, in key order
+        if not len(self.new_pairs['key']):
+            return
+        at = np.searchsorted(self.pairs['key'], self.new_pairs['key'])
+        self.pairs = {name: np.insert(a, at, self.new_pairs[name]) for name, a in self.pairs.items()}
+        self.new_pairs = {name: a[:0] for name, a in self.new_pairs.items()}
+
+    def _window_counts(self, user_id, product_id, reordered, sign):
+        # Add (sign=1) or subtract (sign=-1) items from the last-5 counts of their pairs and products
+        if not len(user_id):
+            return
+        np.add.at(self.products['n_last5'], product_id, sign)
+        np.add.at(self.products['reordered_last5'], product_id, sign * reordered)
+        self._add_to_pairs(pair_key(user_id, product_id), 'n_last5', np.full(len(user_id), sign))
+
+    def _live_orders(self):
+        # Rows of recent_orders that are still in the window, in the order they were added
+        slots = self.users['slots']
+        return np.sort(slots[slots >= 0])
+
+    def _append_recent(self, orders, items):
+        # Append rows to recent_orders and recent_items; when they are full, keep only the live orders
+        # first, in arrays twice as large as needed, so that the copies cost O(1) per row added
+        if self.n_recent_items + len(items['user_id']) > len(self.recent_items['user_id']) or \
+                self.n_recent_orders + len(orders['user_id']) > len(self.recent_orders['user_id']):
+            live = self._live_orders()
+            item_rows = _ranges(self.recent_orders['start'][live], self.recent_orders['n'][live])
+            n_orders, n_items = len(live), len(item_rows)
+            order_room = 2 * (n_orders + len(orders['user_id'])) + 1024
+            item_room = 2 * (n_items + len(items['user_id'])) + 1024
+            recent_orders = {name: np.empty(order_room, a.dtype) for name, a in self.recent_orders.items()}
+            recent_items = {name: np.empty(item_room, a.dtype) for name, a in self.recent_items.items()}
+            for name, a in self.recent_orders.items():
+                recent_orders[name][:n_orders] = a[live]
+            recent_orders['start'][:n_orders] = np.cumsum(recent_orders['n'][:n_orders]) - recent_orders['n'][:n_orders]
+            for name, a in self.recent_items.items():
+                recent_items[name][:n_items] = a[item_rows]
+            slots = self.users['slots']
+            slots[slots >= 0] = np.searchsorted(live, slots[slots >= 0])
+            self.recent_orders, self.recent_items = recent_orders, recent_items
+            self.n_recent_orders, self.n_recent_items = n_orders, n_items
+
+        orders['start'] = orders['start'] + self.n_recent_items
+        a, b = self.n_recent_orders, self.n_recent_orders + len(orders['user_id'])
+        for name, values in orders.items():
+            self.recent_orders[name][a:b] = values
+        self.users['slots'][orders['user_id'], orders['order_number'] % self.window] = np.arange(a, b)
+        a, b = self.n_recent_items, self.n_recent_items + len(items['user_id'])
+        for name, values in items.items():
+            self.recent_items[name][a:b] = values
+        self.n_recent_orders, self.n_recent_items = self.n_recent_orders + len(orders['user_id']), b
+
+    def update(self, orders, order_products):
+        """Add a batch of new orders and their products; return the number of new items.
+
+        As for op, only the orders with products count. Every order of a batch
+        must come after the orders that its user already has.
+        """
+        op = dense_merge(orders[ORDER_COLUMNS], order_products, on='order_id', how='inner')
+        if not len(op):
+            return 0
+        user_id = op.user_id.values.astype('int64')
+        product_id = op.product_id.values.astype('int64')
+        order_number = op.order_number.values.astype('int64')
+        reordered = op.reordered.values.astype('int64')
+        days = op.days_since_prior_order.values
+
+        self.users = _grow(self.users, int(user_id.max()) + 1,
+                           {'n': 0, 'reordered': 0, 'max_days': np.nan, 'total_orders': 0, 'slots': -1})
+        self.products = _grow(self.products, int(product_id.max()) + 1, dict.fromkeys(self.products, 0))
+        old_total = self.users['total_orders'][user_id]
+        if (order_number <= old_total).any():
+            raise ValueError('a batch can only add orders after the ones that the users already have')
+        if self.sketches is not None:
+            self.sketches.update(op)
+
+        # Counts and sums: add the batch
+        np.add.at(self.users['n'], user_id, 1)
+        np.add.at(self.users['reordered'], user_id, reordered)
+        np.fmax.at(self.users['max_days'], user_id, days)
+        np.maximum.at(self.users['total_orders'], user_id, order_number)
+        np.add.at(self.products['n'], product_id, 1)
+        np.add.at(self.products['reordered'], product_id, reordered)
+        np.add.at(self.products['add_to_cart_order'], product_id, op.add_to_cart_order.values.astype('int64'))
+
+        # Pairs: add to the existing ones, in the main arrays or in the delta; the new ones go into the delta
+        keys, inverse = np.unique(pair_key(user_id, product_id), return_inverse=True)
+        count = np.bincount(inverse)
+        first = np.full(len(keys), np.iinfo('int64').max)
+        np.minimum.at(first, inverse, order_number)
+        rows, found = _find(self.pairs, keys)
+        self.pairs['n'][rows[found]] += count[found]
+        keys, count, first = keys[~found], count[~found], first[~found]
+        rows, found = _find(self.new_pairs, keys)
+        self.new_pairs['n'][rows[found]] += count[found]
+        # A pair that already exists was first bought in an earlier order
+        new = ~found
+        values = {'key': keys[new], 'n': count[new], 'first_order_number': first[new], 'n_last5': 0}
+        self.new_pairs = {name: np.insert(a, rows[new], values[name]) for name, a in self.new_pairs.items()}
+        if len(self.new_pairs['key']) > MERGE_PAIRS:
+            self._merge_pairs()
+
+        # The last-5 window of the users of the batch moves to their new last orders: only their slots are read
+        total = self.users['total_orders']
+        slots = self.users['slots'][np.unique(user_id)]
+        in_window = slots[slots >= 0]
+        owner = self.recent_orders['user_id'][in_window]
+        number = self.recent_orders['order_number'][in_window]
+        leaving = number <= total[owner] - self.window
+        self.users['slots'][owner[leaving], number[leaving] % self.window] = -1
+        in_window = in_window[leaving]
+        if self.sketches is not None:
+            self.sketches.update_window(owner[leaving], self.recent_orders['days_since_prior_order'][in_window],
+                                        -self.recent_orders['n'][in_window])
+        items = _ranges(self.recent_orders['start'][in_window], self.recent_orders['n'][in_window])
+        self._window_counts(self.recent_items['user_id'][items], self.recent_items['product_id'][items],
+                            self.recent_items['reordered'][items], -1)
+
+        entering = np.flatnonzero(order_number > total[user_id] - self.window)
+        # The items of an order together, orders by (user_id, order_number)
+        entering = entering[np.argsort(pair_key(user_id[entering], order_number[entering]), kind='stable')]
+        self._window_counts(user_id[entering], product_id[entering], reordered[entering], 1)
+        basket_key = pair_key(user_id[entering], order_number[entering])
+        first_item = np.flatnonzero(np.diff(basket_key, prepend=-1) != 0)
+        baskets = entering[first_item]
+        basket_size = np.diff(np.append(first_item, len(entering)))
+        if self.sketches is not None:
+            self.sketches.update_window(user_id[baskets], days[baskets], basket_size)
+        self._append_recent({'user_id': user_id[baskets], 'order_number': order_number[baskets],
+                             'days_since_prior_order': days[baskets], 'n': basket_size, 'start': first_item},
+                            {'user_id': user_id[entering], 'product_id': product_id[entering],
+                             'reordered': reordered[entering]})
+        return len(op)
+
+    def result(self, name):
+        """The aggregate `name` of streaming.MERGE, as PartialAggregates.result() gives it to finalize()."""
+        if name == 'user':
+            ids = np.flatnonzero(self.users['n'])
+            return pd.DataFrame({col: self.users[col][ids] for col in ('n', 'reordered', 'max_days')},
+                                index=pd.Index(ids.astype(ID), name='user_id'))
+        if name == 'prd':
+            ids = np.flatnonzero(self.products['n'])
+            return pd.DataFrame({col: a[ids] for col, a in self.products.items()},
+                                index=pd.Index(ids.astype(ID), name='product_id'))
+        if name == 'uxp':
+            self._merge_pairs()
+            key = self.pairs['key']
+            user_id = (key >> KEY_SHIFT).astype(ID)
+            product_id = (key & ((1 << KEY_SHIFT) - 1)).astype(ID)
+            index = pd.MultiIndex.from_arrays([user_id, product_id], names=['user_id', 'product_id'])
+            return pd.DataFrame({col: self.pairs[col] for col in ('n', 'first_order_number', 'n_last5')},
+                                index=index)
+        if name == 'days5':
+            live = self._live_orders()
+            recent = {col: a[live] for col, a in self.recent_orders.items()}
+            index = pd.MultiIndex.from_arrays([recent['user_id'].astype(ID), recent['order_number']],
+                                              names=['user_id', 'order_number'])
+            return pd.DataFrame({col: recent[col] for col in ('days_since_prior_order', 'n')}, index=index).sort_index()
+        raise KeyError(name)
+
+    def features(self):
+        """Return (user, prd, uxp), as features.build_features() over all the orders added so far."""
+        return finalize(self)
+
+
+def holdout_batches(orders, order_products_prior, holdout=3, parts=2):
+    """Split the prior orders into a first part and batches of new orders, as if they arrived later.
+
+    The last `holdout` orders (with products) of every user are held out. They
+    come back in `holdout` * `parts` batches: first every user's oldest held
+    out order, split by user into `parts` batches, and so on. Returns
+    (orders, order_products) of the first part and a list of such pairs.
+    """
+    with_products = orders[orders.order_id.isin(order_products_prior.order_id.unique())]
+    back = with_products.groupby('user_id')['order_number'].transform('max') - with_products.order_number + 1
+    held = with_products[back <= holdout]
+    back = back[back <= holdout]
+
+    def products_of(batch):
+        return order_products_prior[order_products_prior.order_id.isin(batch.order_id)]
+
+    first = orders[~orders.order_id.isin(held.order_id)]
+    batches = []
+    for rank in range(holdout, 0, -1):
+        for part in range(parts):
+            batch = held[(back == rank) & (held.user_id % parts == part)]
+            batches.append((batch, products_of(batch)))
+    return (first, products_of(first)), batches
+
+
+def check_equivalence(orders, order_products_prior, holdout=3, parts=2):
+    """Replay the held out orders batch by batch and compare with a full recompute.
+
+    Raises AssertionError if the incremental (user, prd, uxp) differ from the
+    ones of features.build_features(); returns the seconds of the full
+    recompute and the mean seconds of an update.
+    """
+    from features import build_features
+
+    (first_orders, first_products), batches = holdout_batches(orders, order_products_prior, holdout, parts)
+    state = IncrementalFeatures.from_tables(first_orders, first_products)
+    start = time.perf_counter()
+    for batch_orders, batch_products in batches:
+        state.update(batch_orders, batch_products)
+    update_seconds = (time.perf_counter() - start) / max(len(batches), 1)
+    incremental = state.features()
+
+    start = time.perf_counter()
+    full = build_features(orders, order_products_prior)
+    full_seconds = time.perf_counter() - start
+    for name, a, b in zip(('user', 'prd', 'uxp'), full, incremental):
+        pd.testing.assert_frame_equal(a, b, obj=name)
+    return full_seconds, update_seconds
+
+
+def update_scaling(orders, order_products_prior, n_users=2000, holdout=3, shares=(0.125, 0.25, 0.5, 1)):
+    """Time the same batches of new orders on states of more and more users.
+
+    The last `holdout` orders of `n_users` users come back as batches (one per
+    held out order) after the prior orders of a share of the other users.
+    Returns (share, pairs in the state, items per batch, seconds per batch)
+    for every share: the seconds should not grow with the pairs.
+    """
+    users = orders.user_id.drop_duplicates().sample(frac=1, random_state=0).values
+    replayed, others = users[:n_users], users[n_users:]
+    (first_orders, _), batches = holdout_batches(orders[orders.user_id.isin(replayed)], order_products_prior,
+                                                 holdout, parts=1)
+    out = []
+    for share in shares:
+        first = pd.concat([first_orders, orders[orders.user_id.isin(others[:int(share * len(others))])]])
+        state = IncrementalFeatures.from_tables(
+            first, order_products_prior[order_products_prior.order_id.isin(first.order_id)])
+        n_pairs = len(state.pairs['key']) + len(state.new_pairs['key'])
+        start = time.perf_counter()
+        items = sum(state.update(batch_orders, batch_products) for batch_orders, batch_products in batches)
+        seconds = time.perf_counter() - start
+        out.append((share, n_pairs, items / len(batches), seconds / len(batches)))
+    return out
+
+
+def main(argv=None):
+    from data_loader import load_tables
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--source', default='./input', help='directory of CSV files or the Kaggle zip')
+    parser.add_argument('--holdout', type=int, default=3, help='last orders of every user to replay as batches')
+    parser.add_argument('--parts', type=int, default=2, help='batches per held out order')
+    opts = parser.parse_args(argv)
+    tables = load_tables(opts.source, cache_dir=None, tables=['orders', 'order_products__prior'])
+    full, update = check_equivalence(tables['orders'], tables['order_products__prior'], opts.holdout, opts.parts)
+    print('incremental features match the full recompute')
+    print('full recompute %.2f s, update %.2f s per batch' % (full, update))
+    print('the same batches on more and more users:')
+    for share, n_pairs, items, seconds in update_scaling(tables['orders'], tables['order_products__prior'],
+                                                         holdout=opts.holdout):
+        print('  %5.1f%% of the other users, %9d pairs: %.0f items, %.1f ms per batch'
+              % (100 * share, n_pairs, items, 1000 * seconds))
+
+
+if __name__ == '__main__':
+    main()
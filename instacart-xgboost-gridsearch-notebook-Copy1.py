@@ -7,49 +7,54 @@ import pandas as pd
 import gc                         
 gc.enable()                       # Activate 
 
+# Loads the CSV files through an on-disk columnar cache (see data_loader.py)
+from data_loader import load_tables
+# op sorted by user and order, with offset arrays (see order_store.py), and the predictors declared in registry.py
+from order_store import OrderStore
+from registry import HIERARCHY_FEATURES, REGISTRY, Plan
+# The aisle and the department of every product, as lookup arrays (see hierarchy.py)
+from hierarchy import ProductHierarchy
+# How often two products are in the same order, as a sparse matrix (see cooccurrence.py)
+from cooccurrence import ProductAffinity
+# User and product vectors from a truncated SVD of the user X product purchases (see embeddings.py)
+from embeddings import Embeddings
+# Computes the predictors in worker processes, on shards of the users (see sharded.py)
+from sharded import ShardedExecutor
+# Keeps the feature tables on disk, under a hash of the input data and of the feature definitions (see feature_store.py)
+from feature_store import FeatureStore, frame_key
+# data_train and data_test as float32 arrays for XGBoost (see matrix.py)
+from matrix import FeatureMatrix
+# Joins on ids through dense lookup arrays, with the same result as .merge() (see dense_join.py)
+from dense_join import dense_merge
+
 
 # ## 1.2 Load data from the CSV files
 # Instacart provides 6 CSV files, which we have to load into Python. Towards this end, we use the .read_csv() function, which is included in the Pandas package. Reading in data with the .read_csv( ) function returns a DataFrame.
 # 
-# First we connect to the Kaggle API in order to download the zip file with the 6 CSVs. Then we unzip it in a new folder named input, and we unzip all the zip files.
-
-
-# connect to kaggle api and download files (zip)
-from kaggle.api.kaggle_api_extended import KaggleApi
-api = KaggleApi({"username":"charatrypologou","key":"9bab08071e50040cb77728875d96e02c"})
-api.authenticate()
-files = api.competition_download_files("Instacart-Market-Basket-Analysis")
-
-
-# In[ ]:
-
+# First we connect to the Kaggle API in order to download the zip file with the 6 CSVs. The download happens only once: the next runs find the zip file (checked against its size and checksum) and skip it, and an interrupted download continues where it stopped. Your Kaggle credentials are read from the KAGGLE_USERNAME and KAGGLE_KEY environment variables (or from ~/.kaggle/kaggle.json). To run without network access, set INSTACART_MIRROR to a directory that already holds the zip file. The zip file contains one more zip file for each CSV. We do not unzip them: the loader opens the inner zip files inside the downloaded one and reads each CSV directly from there, so no extracted copies are written to disk.
 
-import zipfile
-with zipfile.ZipFile('Instacart-Market-Basket-Analysis.zip', 'r') as zip_ref:
-    zip_ref.extractall('./input')
 
-
-# In[ ]:
-
-
-import os
-working_directory = os.getcwd()+'/input'
-os.chdir(working_directory)
-for file in os.listdir(working_directory):   # get the list of files
-    if zipfile.is_zipfile(file): # if it is a zipfile, extract it
-        with zipfile.ZipFile(file) as item: # treat the file as a zip
-           item.extractall()  # extract it in the working directory
+# connect to kaggle api and download files (zip), unless we already have them (see fetch.py)
+from fetch import fetch_archive
+archive = fetch_archive('.')
 
 
 # In[ ]:
 
 
-orders = pd.read_csv('../input/orders.csv' )
-order_products_train = pd.read_csv('../input/order_products__train.csv')
-order_products_prior = pd.read_csv('../input/order_products__prior.csv')
-products = pd.read_csv('../input/products.csv')
-aisles = pd.read_csv('../input/aisles.csv')
-departments = pd.read_csv('../input/departments.csv')
+# The first run reads each CSV out of the zip file and stores it as a Feather file in ./cache.
+# Later runs memory-map the Feather files, unless the content of a CSV has changed.
+# load_stats keeps where each table came from (zip or cache), the MB read and the seconds it took.
+load_stats = {}
+tables = load_tables(archive, cache_dir='./cache', stats=load_stats)
+orders = tables['orders']
+order_products_train = tables['order_products__train']
+order_products_prior = tables['order_products__prior']
+products = tables['products']
+aisles = tables['aisles']
+departments = tables['departments']
+del tables
+pd.DataFrame(load_stats).T
 
 
 # This step results in the following DataFrames:
@@ -71,6 +76,37 @@ departments = pd.read_csv('../input/departments.csv')
 ###orders = orders.loc[orders.user_id.isin(orders.user_id.drop_duplicates().sample(frac=0.1, random_state=25))] 
 
 
+# The tables that we compute in chapters 2 and 3 (user, prd, uxp, data_train and data_test) are kept on disk in a feature store (./features). Each table is stored under a key: a hash of the input data and of the definitions of the features. A later run with the same data and the same definitions loads the stored tables instead of computing them again, while a change to either gets a new key (and a new version of the tables). The orders are hashed as they are after the cell above, so a 10% sample gets its own key.
+
+# In[ ]:
+
+
+feature_store = FeatureStore('./features')
+# The default predictors, plus the aisle, department, basket and embedding predictors of sections 2.3.4 to 2.3.6
+plan = Plan([name for name, feature in REGISTRY.items() if feature.default] + list(HIERARCHY_FEATURES)
+            + ['uxp_affinity_last5', 'uxp_embedding_score'])
+# Products with 40 purchases or less get no p_reorder_ratio (section 2.2.2.1); the co-occurrence counts of the
+# affinity and the vectors of the embeddings are computed from the prior orders in chapter 2
+params = {'min_purchases': 40, 'hierarchy': ProductHierarchy(products), 'affinity': ProductAffinity(min_count=5),
+          'embeddings': Embeddings(k=32)}
+# user, prd and uxp depend on the orders, order_products_prior and the plan
+features_key = feature_store.key(frame_key(orders), feature_store.input_key(archive, ['order_products__prior']),
+                                 plan.definition_key(**params))
+# data_train and data_test also depend on order_products_train and on chapters 2.4 and 3: change the version when you edit them
+model_key = feature_store.key(features_key, feature_store.input_key(archive, ['order_products__train']), 'chapter-3 v1')
+
+
+# If a previous run has stored data_train and data_test (at the end of chapter 3), you can load them and go straight to section 3.5, to work on the model without computing the features again.
+
+# In[ ]:
+
+
+#### Remove the comments to load data_train and data_test from the feature store, and then continue from section 3.5
+###tables = feature_store.load(model_key, ['data_train', 'data_test'])
+###data_train, data_test = tables['data_train'], tables['data_test']
+###del tables
+
+
 # We now use the .head( ) method in order to visualise the first 10 rows of these tables. Click the Output button below to see the tables.
 
 # In[ ]:
@@ -111,49 +147,61 @@ departments.head()
 
 # ## 1.3 Reshape data
 # We transform the data in order to facilitate their further analysis. First, we convert character variables into categories so we can use them in the creation of the model. In Python, a categorical variable is called category and has a fixed number of different values.
+# 
+# The loader already does this for us: schema.py declares the type of every column, so the character variables (eval_set, product_name, aisle, department) are read as category, and the numeric columns get the smallest type that holds them (e.g. uint8 for order_number). This keeps order_products_prior and op well under the memory limit.
 
 # In[6]:
 
 
-# We convert character variables into category. 
-# In Python, a categorical variable is called category and has a fixed number of different values
-aisles['aisle'] = aisles['aisle'].astype('category')
-departments['department'] = departments['department'].astype('category')
-orders['eval_set'] = orders['eval_set'].astype('category')
-products['product_name'] = products['product_name'].astype('category')
+# Check the types that the loader gave to the orders DataFrame
+orders.dtypes
 
 
 # ## 1.4 Create a DataFrame with the orders and the products that have been purchased on prior orders (op)
-# We create a new DataFrame, named <b>op</b> which combines (merges) the DataFrames <b>orders</b> and <b>order_products_prior</b>. Bear in mind that <b>order_products_prior</b> DataFrame includes only prior orders, so the new DataFrame <b>op</b>  will contain only these observations as well. Towards this end, we use pandas' merge function with how='inner' argument, which returns records that have matching values in both DataFrames. 
+# We create a new DataFrame, named <b>op</b> which combines (merges) the DataFrames <b>orders</b> and <b>order_products_prior</b>. Bear in mind that <b>order_products_prior</b> DataFrame includes only prior orders, so the new DataFrame <b>op</b>  will contain only these observations as well. Towards this end, we use a merge with how='inner' argument, which returns records that have matching values in both DataFrames. 
+# 
+# As all our keys are integer ids, we use dense_merge( ) instead of pandas' merge function: it returns exactly the same DataFrame, but it finds the matching rows by using the ids as positions in an array, instead of building a hash table. We do the same for every merge on a single id below.
 # <img src="https://i.imgur.com/zEK7FpY.jpg" width="400">
 
+# If your computer does not have enough memory for **op** (32M rows), you can compute the user, prd and uxp DataFrames of chapter 2 out of core: order_products_prior is then read in chunks that fit in the given memory budget, and each chunk is reduced to partial counts, sums, minimums and maximums before the next one is read. The result is exactly the same as in chapter 2. Remove the comments of the following cell to do so, and then continue from section 2.4.
+
 # In[ ]:
 
 
-#Merge the orders DF with order_products_prior by their order_id, keep only these rows with order_id that they are appear on both DFs
-op = orders.merge(order_products_prior, on='order_id', how='inner')
-op.head()
+#### Remove the comments to compute the features out of core (see streaming.py)
+###import streaming
+###user, prd, uxp = streaming.build_features(orders, archive, memory_mb=2000)
 
 
-## First approach in one step:
-# Create distinct groups for each user, identify the highest order number in each group, save the new column to a DataFrame
-user = op.groupby('user_id')['order_number'].max().to_frame('u_total_orders')
-user.head()
+# We merge them inside build_features() below, which only runs when the feature store does not have the tables of chapter 2 yet: when it has them, op is not needed and the 32M-row merge is skipped.
+# 
+# We also store op once, sorted by user, order number and add-to-cart order, with two offset arrays: one points to the orders of every user and one to the products of every order (see order_store.py). Any computation per user or per order then runs over a contiguous range of arrays, instead of grouping the 32M rows of op again and again.
+# 
+# All the predictors of this chapter are declared in registry.py, each with the rows it describes (user, product or user X product), the sums, counts, means, ... of op it needs and how it combines them. A **plan** collects the features we ask for (here all of them) and computes every sum, count, ... they need in one pass per kind of row, once, even when several predictors use it. The predictors of the last 5 orders also exist for the last 1, 3, 10 and 20 orders (e.g. size_last10, p_reorder_last3, uxp_total_bought_last20, uxp_last1_ratio); to try them, give the plan a list with the names of the features to compute, as in Plan(['uxp_total_bought', 'uxp_total_bought_last10']). All the windows come out of the same pass. The plan runs on all the cores: the users are split into shards by a hash of their user_id, a worker process computes the user and user X product predictors of each shard, and the counts and sums of the products of all the shards are added up before the product predictors are computed. The result is the same as on one core. The plan runs only if the feature store has no user, prd and uxp tables for features_key yet; otherwise they are loaded from ./features. feature_store.report() tells which one happened (miss or hit). The following sections explain each predictor.
+# 
+# The first user predictor, the total number of orders of each user (u_total_orders), is simply the order number of the last order of each user in the store.
 
-## Second approach in two steps: 
-#1. Save the result as DataFrame with Double brackets --> [[ ]] 
-#user = op.groupby('user_id')[['order_number']].max()
-#2. Rename the label of the column
-#user.columns = ['u_total_orders']
-#user.head()
+# In[ ]:
 
 
-# In[ ]:
+# One worker process per core; ShardedExecutor(1, 1) computes everything in this process
+executor = ShardedExecutor()
 
 
-# Reset the index of the DF so to bring user_id from index to column (pre-requisite for step 2.4)
-user = user.reset_index()
-user.head()
+def build_features():
+    #Merge the orders DF with order_products_prior by their order_id, keep only these rows with order_id that they are appear on both DFs
+    op = dense_merge(orders, order_products_prior, on='order_id', how='inner')
+    store = OrderStore.from_op(op)
+    del op
+    # The co-occurrences and the embeddings come from all the prior orders, before the users are split into shards
+    params['affinity'].fit(store)
+    params['embeddings'].fit(store)
+    return executor.run(plan, store, **params)
+
+
+features = feature_store.load_or_build(features_key, plan.grains, build_features)
+print(plan)
+feature_store.report()
 
 
 # ### 2.1.2 How frequent a customer has reordered products
@@ -169,64 +217,15 @@ user.head()
 # 
 # ![example ratio](https://latex.codecogs.com/gif.latex?\dpi{120}&space;\large&space;&space;mean=&space;\frac{0&plus;1&plus;0&plus;0&plus;1&plus;1}{6}&space;=&space;0,5) 
 # 
-# To create the above ratio we .groupby() order_products_prior by each user and then calculate the mean of reordered.
+# To create the above ratio we sum reordered over all the products of each user in the store and divide by their number, which is the mean of reordered.
 # 
+# Finally, size_last5 is the number of different products that each user bought in the last 5 orders.
 
 # In[ ]:
 
 
-u_reorder = op.groupby('user_id')['reordered'].mean().to_frame('u_reordered_ratio')
-u_reorder = u_reorder.reset_index()
-u_reorder.head()
-
-
-# The new feature will be merged with the user DataFrame (section 2.1.1) which keep all the features based on users. We perform a left join as we want to keep all the users that we have created on the user DataFrame
-# 
-# <img src="https://i.imgur.com/wMmC4hb.jpg" width="400">
-
-# In[ ]:
-#First, we will keep the 5 last orders of all users
-
-#Keep last 5 orders
-op['order_number_back'] = op.groupby('user_id')['order_number'].transform(max) - op.order_number +1 
-op.head()
-
-#Keep last 5 orders
-op5 = op[op.order_number_back <= 5]
-op5.head()
-
-#Last 5 oders of each user and product_id
-last_five = op5.groupby(['user_id','product_id'])[['order_id']].count()
-last_five.columns = ['times_last5']
-last_five.head()
-
-#Size of orders for each user
-u_last_five = last_five.groupby ('user_id')[["times_last5"]].count()
-u_last_five.columns = ['size_last5']
-u_last_five.head()
-
-#Mean of last 5 orders of each customer
-#u_last_five ['mean_size_last5']= u_last_five.size_last5 / 5
-#u_last_five.head()
-
-#Max days of 5 last orders for each user
-#u_last_five ['max_days_5'] = op5.groupby ('user_id') [["days_since_prior_order"]].max()
-#u_last_five.head()
-
-#Mean days of 5 last orders for each user
-#u_last_five ['mean_days_5'] = op5.groupby ('user_id') [["days_since_prior_order"]].mean()
-#u_last_five.head()
-
-#Merge user with u_reorder
-user = user.merge(u_reorder, on='user_id', how='left')
-del u_reorder
-gc.collect()
-user.head()
-
-#Merge user with last_five 
-user = user.merge (u_last_five, on = "user_id" , how ="left")
-del u_last_five
-gc.collect()
+#All the user predictors come from the plan, with the smallest possible types (float32, uint8, ...)
+user = features['user']
 user.head()
 
 
@@ -237,23 +236,7 @@ user.head()
 #
 # ### 2.2.1 Number of purchases for each product
 # We calculate the total number of purchases for each product (from all customers). We create a **prd** DataFrame to store the results.
-
-# In[ ]:
-
-
-# Create distinct groups for each product, count the orders, save the result for each product to a new DataFrame  
-prd = op.groupby('product_id')['order_id'].count().to_frame('p_total_purchases')
-prd.head()
-
-
-# In[ ]:
-
-
-# Reset the index of the DF so to bring product_id rom index to column (pre-requisite for step 2.4)
-prd = prd.reset_index()
-prd.head()
-
-
+#
 # ## 2.2.2 What is the probability for a product to be reordered
 # In this section we want to find the products which have the highest probability of being reordered. Towards this end it is necessary to define the probability as below:
 # <img src="https://latex.codecogs.com/gif.latex?\dpi{150}&space;\large&space;probability\&space;reordered\&space;(product\_id)=&space;\frac{number\&space;of\&space;reorders}{total\&space;number\&space;of\&space;orders\&space;}" title="probability\ reordered\ (product\_id)= \frac{number\ of\ reorders}{total\ number\ of\ orders\ }" />
@@ -262,78 +245,23 @@ prd.head()
 # 
 # <img src="https://latex.codecogs.com/gif.latex?\dpi{150}&space;\large&space;p\_reorder\(product\_id\mathop{==}&space;2&space;)=&space;\frac{12}{90}=&space;0,133" title="\large p\_reorder\(product\_id\mathop{==} 2 )= \frac{12}{90}= 0,133" />
 # 
-# ### 2.2.2.1 Remove products with less than 40 purchases - Filter with .shape[0]
-# Before we proceed to this estimation, we remove all these products that have less than 40 purchases in order the calculation of the aforementioned ratio to be meaningful.
+# ### 2.2.2.1 Remove products with less than 40 purchases
+# Before we proceed to this estimation, we remove all these products that have less than 40 purchases in order the calculation of the aforementioned ratio to be meaningful. Products with 40 purchases or less get a ratio of zero (0). The threshold is the min_purchases argument of plan.run( ).
 # 
-# Using .groupby() we create groups for each product and using .filter( ) we keep only groups with more than 40 rows. Towards this end, we indicate a lambda function.
-
-# In[ ]:
-
-
-# execution time: 25 sec
-# the x on lambda function is a temporary variable which represents each group
-# shape[0] on a DataFrame returns the number of rows
-p_reorder = op.groupby('product_id').filter(lambda x: x.shape[0] >40)
-p_reorder.head()
-
-
-# ### 2.2.2.2 Group products, calculate the mean of reorders
-# 
-# To calculate the reorder probability we will use the aggregation function mean() to the reordered column. In the reorder data frame, the reordered column indicates that a product has been reordered when the value is 1.
-# 
-# The .mean() calculates how many times a product has been reordered, divided by how many times has been ordered in total. 
-# 
-# E.g., for a product that has been ordered 9 times in total, where 4 times has been reordered, the ratio will be:
+# ### 2.2.2.2 Count, sum and mean per product
+# Each product_id is a small integer, so instead of grouping the rows of op (and copying the groups with a .filter( ) and a lambda function, which took 25 sec), we count the purchases, the reorders and the add-to-cart positions of every product with np.bincount over the store. The ratio is the number of reorders divided by the number of purchases, which is the mean of reordered:
 # 
 # ![example ratio](https://latex.codecogs.com/gif.latex?\dpi{120}&space;\large&space;&space;mean=&space;\frac{0&plus;1&plus;0&plus;0&plus;1&plus;1&plus;0&plus;0&plus;1}{9}&space;=&space;0,44) 
 # 
-# We calculate the ratio for each product. The aggregation function is limited to column 'reordered' and it calculates the mean value of each group.
-
-# In[ ]:
-
-p_reorder = p_reorder.groupby('product_id')['reordered'].mean().to_frame('p_reorder_ratio')
-p_reorder = p_reorder.reset_index()
-p_reorder.head()
-
-#Mean position of each product
-p_reorder['avg_position'] = op.groupby ('product_id')[["add_to_cart_order"]].mean()
-p_reorder.head()
-
-#Probability of reordered for each product within last 5 orders of the users
-op5_ratio = op5.groupby ('product_id')["reordered"].mean().to_frame ('p_reorder_last5')
-op5_ratio = op5_ratio.reset_index()
-op5_ratio.head()
-
-# ### 2.2.2.3 Merge the new feature on prd DataFrame
-# The new feature will be merged with the prd DataFrame (section 2.2.1) which keep all the features based on products. We perform a left join as we want to keep all the products that we have created on the prd DataFrame
-# <img src="https://i.imgur.com/dOVWPKb.jpg" width="400">
-
-# In[ ]:
-
-#Merge the prd DataFrame with reorder
-prd = prd.merge(p_reorder, on='product_id', how='left')
-
-#delete the reorder DataFrame
-del p_reorder
-gc.collect()
-prd.head()
-
-#Merge the prd DataFrame with op5
-prd = prd.merge(op5_ratio, on='product_id', how='left')
-gc.collect()
-prd.head()
-
-# #### 2.2.2.4 Fill NaN values
-# As you may notice, there are product with NaN values. This regards the products that have been purchased less than 40 times from all users and were not included in the p_reorder DataFrame. **As we performed a left join with prd DataFrame, all the rows with products that had less than 40 purchases from all users, will get a NaN value.**
+# In the same way we get the mean position of each product in the cart (avg_position), also for the products with more than 40 purchases only, and the probability of reorder for each product within the last 5 orders of the users (p_reorder_last5). Both are arrays indexed by product_id, so every product gets its own values (assigning a Series indexed by product_id to a table with other row numbers would align it on the row numbers instead, and give row k the avg_position of product_id k).
 # 
-# For these products we their NaN value with zero (0):
+# #### 2.2.2.3 Fill NaN values
+# The products that have been purchased less than 40 times from all users, or not in the last 5 orders, have no ratio. For these products we fill the value with zero (0).
 
 # In[ ]:
 
 
-prd['p_reorder_ratio'] = prd['p_reorder_ratio'].fillna(value=0)
-prd['avg_position'] = prd ['avg_position'].fillna(value=0)
-prd['p_reorder_last5'] = prd['p_reorder_last5'].fillna(value=0)
+prd = features['product']
 prd.head()
 
 
@@ -344,38 +272,13 @@ prd.head()
 # - 2.3.1 How many times a user bought a product
 # - 2.3.2 How frequently a customer bought a product after its first purchase
 # - 2.3.3 How many times a customer bought a product on its last 5 orders
+# - 2.3.4 How much a customer buys from the aisle and the department of a product
+# - 2.3.5 How often a product is in the same basket as the last products of a customer
+# - 2.3.6 How well a product fits the taste of a customer
 # 
 # ### 2.3.1 How many times a user bought a product
-# We create different groups that contain all the rows for each combination of user and product. With the aggregation function .count( ) we get how many times each user bought a product. We save the results on new **uxp** DataFrame.
-
-# In[ ]:
-
-
-# Create distinct groups for each combination of user and product, count orders, save the result for each user X product to a new DataFrame 
-uxp = op.groupby(['user_id', 'product_id'])['order_id'].count().to_frame('uxp_total_bought')
-uxp.head()
-
-# In[ ]:
-
-
-# Reset the index of the DF so to bring user_id & product_id rom indices to columns (pre-requisite for step 2.4)
-uxp = uxp.reset_index()
-uxp.head()
-
-#Number of purchases for each product on 5 last orders of users
-uxp_last5 = op5.groupby(['user_id', 'product_id'])['order_id'].count().to_frame('uxp_total_bought_last5')
-uxp_last5.head()
-
-#Reset the index
-uxp_last5 = uxp_last5.reset_index()
-uxp_last5 = uxp_last5.fillna(0)
-uxp_last5.head()
-
-#Merge the results
-uxp = uxp.merge (uxp_last5 , on=['user_id', 'product_id'], how='left')
-uxp.head()
-
-del uxp_last5
+# The plan sorts the rows of the store once by user and product, so the rows of each combination of user and product (the pairs) are listed together. One scan over them gives, for every pair, how many times the user bought the product, its first order number and how many times in the last 5 orders, without any .groupby( ). Times_Bought_N and times_last5 below are these same counts, computed once. We save the results on new **uxp** DataFrame.
+# 
 # ### 2.3.2 How frequently a customer bought a product after its first purchase
 # This ratio is a metric that describes how many times a user bought a product out of how many times she had the chance to a buy it (starting from her first purchase of the product):
 # 
@@ -387,196 +290,25 @@ del uxp_last5
 # To clarify this, we examine the use with user_id:1 and the product with product_id:13032. User 1 has made 10 orders in total.She has bought the product 13032 **for first time in her 2nd order** and she has bought the same product 3 times in total. The user was able to buy the product 9 times (starting from her 2nd order until her last order). As a result, she has bought it 3 out of 9 times, meaning reorder_ratio=3/9= 0,333.
 # 
 # The Order_Range_D variable is created using two supportive variables:
-# * Total_orders = Total number of orders of each user
-# * First_order_number = The order number where the customer bought a product for first time
+# * Total_orders = Total number of orders of each user, the order number of the user's last order in the store
+# * First_order_number = The order number where the customer bought a product for first time, the order number of the first row of the pair in the store
 # 
-# In the next blocks we show how we create:
-# 1. The numerator 'Times_Bought_N'
-# 2. The denumerator 'Order_Range_D' with the use of the supportive variables 'total_orders' & 'first_order_number' 
-# 3. Our final ratio 'uxp_order_ratio'
-
-# ### 2.3.2.1 Calculate the numerator ('Times_Bought_N')
-# 
-# To answer this question we simply .groupby( ) user_id & product_id and we count the instances of order_id for each group.
-
-# In[ ]:
-
-
-times = op.groupby(['user_id', 'product_id'])[['order_id']].count()
-times.columns = ['Times_Bought_N']
-times.head()
-
-
-# ### 2.3.2.2 Calculate the denumerator ('Order_Range_D')
-# To calculate the denumerator, we first calculate the total orders of each user & first order number for each user and every product purchase.
+# ### 2.3.3 How many times a customer bought a product on its last 5 orders
+# times_last5 (and uxp_total_bought_last5) counts the rows of each pair in the orders with order_number_back <= 5, and last5_ ratio divides it by 5. We also add the maximum and the median of days_since_prior_order over the last 5 orders of the user (max_days_last5, med_days_last5) and the maximum over all the user's orders (uxp_max_days). These three are computed once per user and given to every pair of the user, with a lookup by the position of the user in the store (assigning a Series indexed by user_id to uxp would align it on the row numbers of uxp instead, so row i would get the value of user i). Products that the customer did not buy on its last five orders get the value zero (0), so that uxp has no NaN values.
 # 
-# In order to calculate the total number of orders of each cutomer ('total_orders') we .groupby( ) only by the user_id, we keep the column order_number and we get its highest value with the aggregation function .mean()
-
-# In[ ]:
-
-
-total_orders = op.groupby('user_id')['order_number'].max().to_frame('total_orders')
-total_orders.head()
-
-
-# In order to calculate the order number where the user bought a product for first time ('first_order_number') we .groupby( ) by both user_id & product_id and we select the order_number column and we retrieve the .min( ) value.
-
-# In[ ]:
-
-
-first_order_no = op.groupby(['user_id', 'product_id'])['order_number'].min().to_frame('first_order_number')
-first_order_no  = first_order_no.reset_index()
-first_order_no.head()
-
-
-# We merge the first order number with the total_orders DataFrame. As total_orders refers to all users, where first_order_no refers to unique combinations of user & product, we perform a right join:
-# <img src="https://i.imgur.com/bhln0tn.jpg" width="250">
-
-# In[ ]:
-
-
-span = pd.merge(total_orders, first_order_no, on='user_id', how='right')
-span.head()
-
-
-# The denominator ('Order_Range_D') now can be created with simple operations between the columns of span DataFrame:
-
-# In[ ]:
-
-
-# The +1 includes in the difference the first order were the product has been purchased
-span['Order_Range_D'] = span.total_orders - span.first_order_number + 1
-span.head()
-
-
-# ### 2.3.2.3 Create the final ratio "uxp_reorder_ratio"
-# 
-# We merge **times** DataFrame, which contains the numerator, and **span** DataFrame, which contains the denumerator of our desired ratio. **As both variables derived from the combination of users & products, any type of join will keep all the combinations.**
-# 
-# <img src="https://i.imgur.com/h7m1bFh.jpg" width="250">
-
-# In[ ]:
-
-
-uxp_ratio = pd.merge(times, span, on=['user_id', 'product_id'], how='left')
-uxp_ratio.head()
-
-
-# 
-# We divide the Times_Bought_N by the Order_Range_D for each user and product.
-
-# In[ ]:
-
-
-uxp_ratio['uxp_reorder_ratio'] = uxp_ratio.Times_Bought_N / uxp_ratio.Order_Range_D
-uxp_ratio.head()
-
-
-# 
-# We select to keep only the 'user_id', 'product_id' and the final feature 'uxp_reorder_ratio'
-# 
-
-# In[ ]:
-
-
-uxp_ratio = uxp_ratio.drop(['Times_Bought_N', 'total_orders', 'first_order_number', 'Order_Range_D'], axis=1)
-uxp_ratio.head()
-
-
-# In[ ]:
-
-
-#Remove temporary DataFrames
-del [times, first_order_no, span]
-
-#Find one-shot ratio (1)
-#item = op.groupby (['product_id', 'user_id'])[['order_id']].count()
-#item.columns = ['total']
-#item.head()
-
-#Find one-shot ratio (2)
-#item_one = item [item.total==1]
-#item_one.head()
-
-#Find one-shot ratio (3)
-#item_one = item_one.groupby('product_id')[['total']].count()
-#item_one.columns = ['customers_one_shot']        
-#item_one.head()
-
-#item = item.reset_index(1)
-#item.head()
-
-#Find unique customers of each product
-#item_size = item.groupby('product_id')[['user_id']].count()
-#item_size.columns = ['unique_customers']
-#item_size.head()
-
-#Merge the results
-#results = pd.merge (item_one, item_size, on = 'product_id', how = 'right')
-#results['one_shot_ratio'] = results ['customers_one_shot']/results['unique_customers']
-#results.head()
-
-#Merge uxp_ratio with the results
-#uxp_ratio = uxp_ratio.merge (results, on = 'product_id', how = 'left')
-#uxp_ratio.head()
-
-#Fill NaN values
-#uxp_ratio['one_shot_ratio'] = uxp_ratio['one_shot_ratio'].fillna(0)
-#uxp_ratio.head()
-
-#Delete 
-#del [item, item_size, item_one, results]
-#uxp_ratio = uxp_ratio.drop(['customers_one_shot', 'unique_customers'], axis=1)
-#uxp_ratio.head()
-
-# ### 2.3.2.4 Merge the final feature with uxp DataFrame
-# The new feature will be merged with the uxp DataFrame (section 2.3.1) which keep all the features based on combinations of user-products. We perform a left join as we want to keep all the user-products that we have created on the uxp DataFrame
+# ### 2.3.4 How much a customer buys from the aisle and the department of a product
+# Every product belongs to an aisle and every aisle to a department (products table). A customer who often reorders yogurt is likely to reorder a yogurt she bought only once, so we give every pair the purchases of the user in the aisle of the product (ua_total_bought) and the share of them that were reorders (ua_reorder_ratio), the same for the department (ud_total_bought, ud_reorder_ratio), and the reorder rate of the aisle and of the department over all the users (a_reorder_ratio, d_reorder_ratio). We do not merge products into op for this: ProductHierarchy keeps the aisle and the department of every product_id in an array indexed by product_id, and the totals are sums of the pairs of section 2.3.1 per (user, aisle) and (user, department), computed with np.bincount (see hierarchy.py).
 # 
-# <img src="https://i.imgur.com/hPJXBuB.jpg" width="250">
-
-# In[ ]:
-
-uxp = uxp.merge(uxp_ratio, on=['user_id', 'product_id'], how='left')
-del uxp_ratio
-uxp.head()
-
-
-# #### 2.3.3.5 Merge the final feature with uxp DataFrame
-# The new feature will be merged with the uxp DataFrame (section 2.3.1) which keep all the features based on combinations of user-products. We perform a left join as we want to keep all the user-products that we have created on the uxp DataFrame
+# ### 2.3.5 How often a product is in the same basket as the last products of a customer
+# Some products are bought together: pasta and pasta sauce, or chips and salsa. For every product q we take the share of its prior orders that also have product p, P(p | q), and uxp_affinity_last5 is the mean of P(p | q) over the other products q that the customer bought in the last 5 orders. A high value means that the product usually goes into the same baskets as what the customer buys now. The number of orders with both products comes from a sparse order X product matrix B (scipy.sparse), as B.T @ B, computed in blocks of products; pairs of products in fewer than 5 orders together are dropped, so the matrix stays small (see cooccurrence.py).
 # 
-# <img src="https://i.imgur.com/ObfHDPl.jpg" width="400">
+# ### 2.3.6 How well a product fits the taste of a customer
+# The matrix of all users and products, with log(1 + times bought) where a user bought a product, is mostly empty. A truncated SVD approximates it with 32 components: every user and every product gets a vector of 32 numbers, and customers who buy alike get similar vectors, as do products bought by the same customers. uxp_embedding_score is the dot product of the vectors of the user and of the product, the value of the approximated matrix for the pair. The randomized SVD of scikit-learn works on the sparse matrix directly. The components themselves can be added to the plan too (u_emb_0, ..., u_emb_31 and p_emb_0, ..., p_emb_31); we keep the score only, since 64 more columns would take a lot of memory in data_train (see embeddings.py).
 
 # In[ ]:
 
-uxp = uxp.merge(last_five, on=['user_id', 'product_id'], how='left')
 
-#Fill NaN values
-uxp = uxp.fillna(0)
-uxp.head()
-
-#Ratio of last 5 orders of each customer for a product
-uxp ['last5_ ratio']= uxp.times_last5 / 5
-uxp.head()
-
-#Max days of 5 last orders for each product of users
-uxp['max_days_last5'] = op5.groupby('user_id')[["days_since_prior_order"]].max()
-uxp.head()
-
-#Mean days of 5 last orders for each product of users
-uxp['med_days_last5'] = op5.groupby('user_id')[["days_since_prior_order"]].median()
-uxp.head()
-
-#Max days days of orders for each product of users
-uxp['uxp_max_days'] = op.groupby('user_id')[["days_since_prior_order"]].max()
-uxp.head()
-
-# #### 2.3.3.6 Fill NaN values
-# If you check uxp DataFrame you will notice that some rows have NaN values for our new feature. This happens as there might be products that the customer did not buy on its last five orders. For these cases, we turn NaN values into zero (0) with .fillna(0) method.
-
-# In[ ]:
-
-
-uxp = uxp.fillna(0)
+uxp = features['uxp']
 uxp.head()
 
 
@@ -608,7 +340,7 @@ uxp.head()
 
 #Merge uxp features with the user features
 #Store the results on a new DataFrame
-data = uxp.merge(user, on='user_id', how='left')
+data = dense_merge(uxp, user, on='user_id', how='left')
 data.head()
 
 
@@ -624,7 +356,7 @@ data.head()
 
 
 #Merge uxp & user features (the new DataFrame) with prd features
-data = data.merge(prd, on='product_id', how='left')
+data = dense_merge(data, prd, on='product_id', how='left')
 data.head()
 
 
@@ -637,7 +369,7 @@ data.head()
 # In[ ]:
 
 
-del op, user, prd, uxp, last_five, op5, total_orders
+del features, user, prd, uxp
 gc.collect()
 
 
@@ -685,7 +417,7 @@ orders_future.head(10)
 
 
 # bring the info of the future orders to data DF
-data = data.merge(orders_future, on='user_id', how='left')
+data = dense_merge(data, orders_future, on='user_id', how='left')
 data.head(10)
 
 
@@ -731,7 +463,7 @@ data_train.head(15)
 
 
 #Where the previous merge, left a NaN value on reordered column means that the customers they haven't bought the product. We change the value on them to 0.
-data_train['reordered'] = data_train['reordered'].fillna(0)
+data_train['reordered'] = data_train['reordered'].fillna(0).astype('uint8')
 data_train.head(15)
 
 
@@ -793,6 +525,29 @@ data_test = data_test.drop(['eval_set','order_id'], axis=1)
 data_test.head()
 
 
+# ## 3.4 Store the train and test DataFrames
+# data_train and data_test are all that the model needs, so we store them in the feature store, under model_key. The next runs can load them with the optional cell of chapter 1.2 and start from section 3.5.
+
+# In[ ]:
+
+
+feature_store.save(model_key, {'data_train': data_train, 'data_test': data_test})
+feature_store.report()
+
+
+# ## 3.5 Turn the train and test DataFrames into arrays
+# XGBoost works on one float32 array, with a row per observation and a column per predictor. If we give it a DataFrame, it converts it again for every fit and every prediction, and the .drop( ) and the split of chapter 4 copy all the columns before that. So we write each DataFrame once into a **FeatureMatrix**: one float32 array X with the predictors, the user_id and product_id of every row as int32 arrays, the names of the predictors and, for the train data, the response variable reordered (label). The models of chapters 4 and 5 take these arrays as they are.
+
+# In[ ]:
+
+
+train = FeatureMatrix.from_frame(data_train, label='reordered')
+test = FeatureMatrix.from_frame(data_test)
+del data_train, data_test
+gc.collect()
+train.feature_names
+
+
 
 # In[ ]:
 
@@ -806,8 +561,10 @@ from sklearn.model_selection import train_test_split
 ##########################################
 ## SPLIT DF TO: X_train, y_train (axis=1)
 ##########################################
-#X_train, y_train = data_train.drop('reordered', axis=1), data_train.reordered
-X_train, X_val, y_train, y_val = train_test_split(data_train.drop('reordered', axis=1), data_train.reordered, test_size=0.8, random_state=42)
+#X_train, y_train = train.X, train.label
+# The rows that train_test_split(data_train.drop('reordered', axis=1), data_train.reordered, test_size=0.8, random_state=42) would give
+train_rows, val_rows = train.split_rows(test_size=0.8, random_state=42)
+X_train, y_train = train.X[train_rows], train.label[train_rows]
 
 ########################################
 ## SET BOOSTER'S PARAMETERS
@@ -827,6 +584,8 @@ xgbc = xgb.XGBClassifier(objective='binary:logistic', parameters=parameters, num
 ## TRAIN MODEL
 ########################################
 model = xgbc.fit(X_train, y_train)
+# X_train is an array: give the booster the names of the predictors
+model.get_booster().feature_names = train.feature_names
 
 ##################################
 # FEATURE IMPORTANCE - GRAPHICAL
@@ -898,6 +657,7 @@ print("The best parameters are: /n",  gridsearch.best_params_)
 
 # Store the model for prediction (chapter 5)
 model = gridsearch.best_estimator_
+model.get_booster().feature_names = train.feature_names
 
 # Delete X_train , y_train
 del [X_train, y_train]
@@ -938,7 +698,7 @@ model.get_params()
 #model.get_params()
 # # 5. Apply predictive model (predict)
 # The model that we have created is stored in the **model** object.
-# At this step we predict the values for the test data and we store them in a new column in the same DataFrame.
+# At this step we predict the values for the test data (the array test.X) and we store them in a new DataFrame, next to the user_id and product_id of every row.
 # 
 # For better results, we set a custom threshold to 0.21. The best custom threshold can be found through a grid search.
 
@@ -947,7 +707,7 @@ model.get_params()
 
 '''
 # Predict values for test data with our model from chapter 5 - the results are saved as a Python array
-test_pred = model.predict(data_test).astype(int)
+test_pred = model.predict(test.X).astype(int)
 test_pred[0:20] #display the first 20 predictions of the numpy array
 '''
 
@@ -956,25 +716,16 @@ test_pred[0:20] #display the first 20 predictions of the numpy array
 
 
 ## OR set a custom threshold (in this problem, 0.21 yields the best prediction)
-test_pred = (model.predict_proba(data_test)[:,1] >= 0.21).astype(int)
+test_pred = (model.predict_proba(test.X)[:,1] >= 0.21).astype(int)
 test_pred[0:20] #display the first 20 predictions of the numpy array
 
 
 # In[ ]:
 
 
-#Save the prediction (saved in a numpy array) on a new column in the data_test DF
-data_test['prediction'] = test_pred
-data_test.head(10)
-
-
-# In[ ]:
-
-
-# Reset the index
-final = data_test.reset_index()
-# Keep only the required columns to create our submission file (for chapter 6)
-final = final[['product_id', 'user_id', 'prediction']]
+# Save the prediction (saved in a numpy array) next to the product_id and user_id of every test row:
+# the only columns that we need to create our submission file (for chapter 6)
+final = pd.DataFrame({'product_id': test.product_id, 'user_id': test.user_id, 'prediction': test_pred})
 
 gc.collect()
 final.head()
@@ -998,7 +749,7 @@ orders_test.head()
 # In[ ]:
 
 
-final = final.merge(orders_test, on='user_id', how='left')
+final = dense_merge(final, orders_test, on='user_id', how='left')
 final.head()
 
 
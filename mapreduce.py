@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""Build the predictors on several machines that share a filesystem.
+
+The prior orders are written once as user-hash partitions: op (orders
+merged with order_products_prior) split by sharded.shard_of(user_id), one
+Feather file per partition, sorted as in the OrderStore. A job then runs
+the registry plan as map-reduce:
+
+* map: a node takes a partition, builds its OrderStore and computes the
+  mergeable aggregates of the plan (sharded.mergeable): the user and uxp
+  blocks complete, the product counts and sums partial. They are written
+  next to the job as one .npz file per partition.
+* reduce: the driver reads the .npz files of all the partitions, adds up
+  the product partials and applies the formulas (sharded.reduce_shards and
+  Plan.frames), with the same result as Plan.run() on all the orders.
+
+A node is any process that runs `python mapreduce.py node <job directory>`:
+it claims the partitions that no other node has claimed yet (by creating a
+claim file, which only one node can do) until none is left. The nodes need
+nothing but the shared directory, so they may run on other machines; on one
+host, the driver starts them as local processes:
+
+    python mapreduce.py partition --source ./input --root ./partitions --partitions 64
+    python mapreduce.py run --root ./partitions --nodes 4 --check
+
+A partition whose node died is left claimed but unfinished; the driver
+computes those itself after the nodes have stopped.
+"""
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+from pyarrow import feather
+
+import registry
+from order_store import OrderStore
+from sharded import mergeable, reduce_shards, shard_of
+
+META_FILE = '_partitions.json'
+JOB_FILE = 'job.json'
+
+
+def _write_json(path, value):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(value, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def partition_path(root, partition):
+    return os.path.join(root, 'op', 'part-%05d.feather' % partition)
+
+
+########################################
+## PARTITION OP BY USER
+########################################
+def write_partitions(orders, order_products_prior, root, n_partitions):
+    """Write op as `n_partitions` user-hash partitions under `root`; return the rows of every partition."""
+    store = OrderStore.from_tables(orders, order_products_prior)
+    shard = shard_of(store.user_ids, n_partitions)
+    os.makedirs(os.path.join(root, 'op'), exist_ok=True)
+    rows = []
+    for k in range(n_partitions):
+        op = store.take_users(np.flatnonzero(shard == k)).to_op()
+        # The partitions travel over the network: lz4 (the Feather default) rather than uncompressed
+        path = partition_path(root, k)
+        feather.write_feather(op, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        rows.append(len(op))
+    # Every write of the partitions gets a new id, so the jobs of older partitions are not reused
+    _write_json(os.path.join(root, META_FILE), {'partitions': n_partitions, 'rows': rows,
+                                                'users': int(store.n_users), 'id': '%x' % time.time_ns()})
+    return rows
+
+
+def read_partition(root, partition):
+    """The OrderStore of one partition."""
+    return OrderStore.from_op(feather.read_feather(partition_path(root, partition)))
+
+
+def read_all(root):
+    """The OrderStore of all the partitions together."""
+    import pandas as pd
+    n_partitions = _read_json(os.path.join(root, META_FILE))['partitions']
+    return OrderStore.from_op(pd.concat([feather.read_feather(partition_path(root, k)) for k in range(n_partitions)]))
+
+
+########################################
+## JOBS, MAP AND REDUCE
+########################################
+def create_job(root, plan, **params):
+    """Write the job of `plan` under root/jobs/; return its directory.
+
+    A job is named after Plan.definition_key() and the id of the partitions,
+    so the same plan on the same partitions reuses the map outputs of an
+    earlier run. The parameters are written as text, to show them: the
+    driver passes them to run_reduce(), and the nodes do not need them.
+    """
+    key = plan.definition_key(**params)
+    partitions_id = _read_json(os.path.join(root, META_FILE))['id']
+    job = os.path.join(root, 'jobs', hashlib.sha1((key + partitions_id).encode()).hexdigest()[:16])
+    for sub in ('claims', 'map'):
+        os.makedirs(os.path.join(job, sub), exist_ok=True)
+    _write_json(os.path.join(job, JOB_FILE), {'root': os.path.abspath(root),
+                                              'features': [f.name for f in plan.features],
+                                              'params': {k: repr(v) for k, v in params.items()}, 'key': key})
+    return job
+
+
+def _load_job(job):
+    spec = _read_json(os.path.join(job, JOB_FILE))
+    plan = registry.Plan(spec['features'])
+    n_partitions = _read_json(os.path.join(spec['root'], META_FILE))['partitions']
+    return spec, plan, n_partitions
+
+
+def map_output(job, partition):
+    return os.path.join(job, 'map', 'part-%05d.npz' % partition)
+
+
+def run_map(job, partition):
+    """Compute the mergeable aggregates of one partition and write them to its .npz file."""
+    spec, plan, _ = _load_job(job)
+    aggregates = mergeable(plan.needed())
+    store = read_partition(spec['root'], partition)
+    values = registry.aggregate(store, aggregates) if store.n_users else {}
+    # The arrays are named after the position of their aggregate in mergeable(), which every node computes alike
+    arrays = {'a%03d' % i: values[a] for i, a in enumerate(aggregates) if a in values}
+    path = map_output(job, partition)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(path + '.tmp', path)
+
+
+def _claim(job, partition):
+    # Creating the claim file succeeds for one node only, also over a shared filesystem
+    try:
+        os.close(os.open(os.path.join(job, 'claims', 'part-%05d' % partition), os.O_CREAT | os.O_EXCL))
+        return True
+    except FileExistsError:
+        return False
+
+
+def run_node(job):
+    """Run the map tasks of `job` that no other node has claimed; return the partitions done here."""
+    _, _, n_partitions = _load_job(job)
+    done = []
+    for k in range(n_partitions):
+        if not os.path.exists(map_output(job, k)) and _claim(job, k):
+            run_map(job, k)
+            done.append(k)
+    return done
+
+
+def run_reduce(job, **params):
+    """Merge the map outputs of all the partitions; return the frames of the plan with `params`, as Plan.run()."""
+    _, plan, n_partitions = _load_job(job)
+    aggregates = mergeable(plan.needed())
+    partials = []
+    for k in range(n_partitions):
+        with np.load(map_output(job, k)) as arrays:
+            partials.append({aggregates[int(name[1:])]: arrays[name] for name in arrays.files})
+    return plan.frames(reduce_shards(partials, plan.needed()), **params)
+
+
+def run_job(root, plan, nodes=2, **params):
+    """Run `plan` over the partitions in `root` with `nodes` local node processes; return its frames.
+
+    Also returns the seconds of the map phase and of the reduce phase.
+    """
+    job = create_job(root, plan, **params)
+    start = time.perf_counter()
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'node', job]) for _ in range(nodes)]
+    for proc in procs:
+        proc.wait()
+    _, _, n_partitions = _load_job(job)
+    missing = [k for k in range(n_partitions) if not os.path.exists(map_output(job, k))]
+    if missing:
+        print('computing %d partitions that no node finished: %s' % (len(missing), missing))
+        for k in missing:
+            run_map(job, k)
+    middle = time.perf_counter()
+    frames = run_reduce(job, **params)
+    return frames, {'map': middle - start, 'reduce': time.perf_counter() - middle}
+
+
+def main(argv=None):
+    from data_loader import load_tables
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    part = sub.add_parser('partition', help='write op as user-hash partitions')
+    part.add_argument('--source', default='./input', help='directory of CSV files or the Kaggle zip')
+    part.add_argument('--root', default='./partitions', help='shared directory of the partitions and jobs')
+    part.add_argument('--partitions', type=int, default=64)
+    run = sub.add_parser('run', help='run the default plan with local node processes, then reduce')
+    run.add_argument('--root', default='./partitions')
+    run.add_argument('--source', default='./input', help='directory or zip with the products table (with --all)')
+    run.add_argument('--nodes', type=int, default=os.cpu_count() or 1)
+    run.add_argument('--all', action='store_true', help='every registered feature, not only the defaults')
+    run.add_argument('--check', action='store_true', help='compare with Plan.run() over all the partitions')
+    node = sub.add_parser('node', help='run the map tasks of a job that are not claimed yet')
+    node.add_argument('job', help='job directory, created by run')
+    opts = parser.parse_args(argv)
+
+    if opts.command == 'partition':
+        tables = load_tables(opts.source, cache_dir=None, tables=['orders', 'order_products__prior'])
+        rows = write_partitions(tables['orders'], tables['order_products__prior'], opts.root, opts.partitions)
+        print('%d partitions, %d to %d rows' % (len(rows), min(rows), max(rows)))
+    elif opts.command == 'node':
+        print('node %d: partitions %s' % (os.getpid(), run_node(opts.job)))
+    else:
+        plan = registry.Plan(list(registry.REGISTRY) if opts.all else None)
+        params = {}
+        if opts.all:
+            from cooccurrence import ProductAffinity
+            from embeddings import Embeddings
+            from hierarchy import ProductHierarchy
+            products = load_tables(opts.source, cache_dir=None, tables=['products'])['products']
+            params['hierarchy'] = ProductHierarchy(products)
+            # The co-occurrences and the factorisation span the orders of all the users: the driver computes
+            # them before the job
+            store = read_all(opts.root)
+            params['affinity'] = ProductAffinity().fit(store)
+            params['embeddings'] = Embeddings().fit(store)
+            del store
+        frames, seconds = run_job(opts.root, plan, opts.nodes, **params)
+        print('%d nodes: map %.2f s, reduce %.2f s' % (opts.nodes, seconds['map'], seconds['reduce']))
+        if opts.check:
+            import pandas as pd
+            expected = plan.run(read_all(opts.root), **params)
+            for grain in expected:
+                pd.testing.assert_frame_equal(expected[grain], frames[grain], obj=grain)
+            print('same features as Plan.run() over all the partitions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""data_train and data_test as one float32 array each, for XGBoost.
+
+data_train and data_test are DataFrames with a (user_id, product_id)
+MultiIndex and columns of several types (uint8, uint16, float32). Chapters 4
+and 5 copied all of them several times: .drop('reordered'), the .iloc of
+train_test_split, and XGBoost itself, which turns a DataFrame into one
+float32 array for fit and again for predict_proba.
+
+A FeatureMatrix holds the same table as:
+
+* X: one C-contiguous float32 array (rows x features), the layout that
+  XGBoost reads as it is,
+* user_id and product_id: int32 arrays with the keys of the rows,
+* feature_names: the names of the columns of X,
+* label: reordered as uint8 (data_train only).
+
+from_frame() writes every column once into X, so the matrix is the only
+copy; split_rows() gives the rows of train_test_split, to take only the rows
+that the model uses. save() writes the arrays as .npy files, and load()
+memory-maps them.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+KEYS = ('user_id', 'product_id')
+
+
+class FeatureMatrix(object):
+    """The features of a model table as a float32 array, with int32 keys and the feature names."""
+
+    def __init__(self, X, user_id, product_id, feature_names, label=None):
+        self.X = X
+        self.user_id = user_id
+        self.product_id = product_id
+        self.feature_names = list(feature_names)
+        self.label = label
+
+    @classmethod
+    def from_frame(cls, df, label=None):
+        """Build the matrix of `df`, whose keys are columns or index levels; `label` is the response column."""
+        names = [c for c in df.columns if c != label and c not in KEYS]
+        X = np.empty((len(df), len(names)), dtype='float32')
+        for j, name in enumerate(names):
+            X[:, j] = df[name].values
+        keys = [df.index.get_level_values(k) if k in df.index.names else df[k] for k in KEYS]
+        return cls(X, *[np.asarray(k, dtype='int32') for k in keys], feature_names=names,
+                   label=None if label is None else df[label].values.astype('uint8'))
+
+    def __len__(self):
+        return len(self.X)
+
+    def split_rows(self, test_size, random_state=None):
+        """The (train, test) row numbers that train_test_split gives for this table with the same arguments."""
+        from sklearn.model_selection import train_test_split
+        return train_test_split(np.arange(len(self)), test_size=test_size, random_state=random_state)
+
+    def frame(self, rows=slice(None)):
+        """The `rows` as a DataFrame indexed by (user_id, product_id), e.g. to look at them with .head()."""
+        index = pd.MultiIndex.from_arrays([self.user_id[rows], self.product_id[rows]], names=list(KEYS))
+        df = pd.DataFrame(self.X[rows], columns=self.feature_names, index=index)
+        if self.label is not None:
+            df['reordered'] = self.label[rows]
+        return df
+
+    def save(self, path):
+        """Write the arrays to the directory `path`, one .npy file each."""
+        os.makedirs(path, exist_ok=True)
+        arrays = {'X': self.X, 'user_id': self.user_id, 'product_id': self.product_id}
+        if self.label is not None:
+            arrays['label'] = self.label
+        for name, a in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), a)
+        with open(os.path.join(path, 'feature_names.json'), 'w') as f:
+            json.dump(self.feature_names, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Read a matrix written by save(), memory-mapping the arrays unless mmap=False."""
+        mode = 'r' if mmap else None
+
+        def read(name):
+            file = os.path.join(path, name + '.npy')
+            return np.load(file, mmap_mode=mode) if os.path.exists(file) else None
+        with open(os.path.join(path, 'feature_names.json')) as f:
+            names = json.load(f)
+        return cls(read('X'), read('user_id'), read('product_id'), names, label=read('label'))
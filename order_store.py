@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""The prior orders (op) stored once, sorted, with offset arrays (CSR layout).
+
+The rows of op are sorted by (user_id, order_number, add_to_cart_order) and
+kept as NumPy arrays. Two offset arrays give the structure:
+
+* user_offsets: the orders of user u are orders[user_offsets[u]:user_offsets[u + 1]],
+* order_offsets: the products of order j are items[order_offsets[j]:order_offsets[j + 1]].
+
+Users and orders are numbered 0, 1, ... in sorted order, and their ids are
+kept in user_ids and order_id. Any slice or reduction per user or per order
+is then a contiguous range of the arrays (np.add.reduceat and friends), with
+no hashing; registry.py computes the predictors of chapter 2 from these arrays.
+"""
+import numpy as np
+import pandas as pd
+
+from dense_join import dense_merge
+from features import LAST_N
+
+
+def segment_starts(lengths):
+    """Return the start offset of every segment, given the segment lengths."""
+    return np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype('int64')
+
+
+def concat_ranges(starts, ends):
+    """Positions of the ranges [starts[i], ends[i]), one after the other, as one array."""
+    lengths = ends - starts
+    offsets = segment_starts(lengths)
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+
+def segment_median(values, segment, n_segments):
+    """Median of `values` per segment id (0 .. n_segments - 1), ignoring NaN, like pandas' median.
+
+    Segments without values get NaN.
+    """
+    keep = ~np.isnan(values)
+    values, segment = values[keep], segment[keep]
+    order = np.lexsort((values, segment))
+    values = values[order].astype('float64')
+    counts = np.bincount(segment, minlength=n_segments)
+    starts = segment_starts(counts)
+    median = np.full(n_segments, np.nan)
+    has = counts > 0
+    low = values[starts[has] + (counts[has] - 1) // 2]
+    high = values[starts[has] + counts[has] // 2]
+    median[has] = (low + high) / 2
+    return median
+
+
+def segment_reduce(values, starts, ends, how='sum'):
+    """Reduce `values` over the contiguous, non-empty segments values[starts[i]:ends[i]].
+
+    `how` is 'sum' (in int64 for integers and booleans), 'min', 'max' (both
+    ignoring NaN), 'first' or 'last'.
+    """
+    if how == 'sum':
+        if values.dtype.kind in 'iub':
+            values = values.astype('int64')
+        return np.add.reduceat(values, starts)
+    if how == 'min':
+        return np.fmin.reduceat(values, starts)
+    if how == 'max':
+        return np.fmax.reduceat(values, starts)
+    if how == 'first':
+        return values[starts]
+    if how == 'last':
+        return values[ends - 1]
+    raise ValueError('unknown reduction: %r' % how)
+
+
+def suffix_starts(back, starts, ends, windows):
+    """Start of the window suffix of every segment, for every window: an array (len(windows), n_segments).
+
+    `back` must not increase inside a segment (e.g. order_number_back of
+    items in order), so the items with back <= w are a suffix of the segment,
+    values[result[j, s]:ends[s]] for windows[j] (empty when result = ends).
+    The suffixes of all the windows come out of one scan: each window takes
+    the positions where the window of the items drops.
+    """
+    windows = np.asarray(windows)
+    k = len(windows)
+    # Smallest window of every item (k: outside all of them), as it goes down along each segment
+    bucket = np.searchsorted(np.sort(windows), back, side='left')
+    previous = np.empty_like(bucket)
+    previous[1:] = bucket[:-1]
+    previous[starts] = k
+    drop = np.flatnonzero(bucket < previous)
+    # The first item of a segment with bucket <= j, for j from bucket[i] to previous[i] - 1
+    segment = np.searchsorted(starts, drop, side='right') - 1
+    span = previous[drop] - bucket[drop]
+    rows = np.repeat(bucket[drop], span) + (np.arange(span.sum()) - np.repeat(np.cumsum(span) - span, span))
+    result = np.tile(ends, (k, 1))
+    result[rows, np.repeat(segment, span)] = np.repeat(drop, span)
+    # Back to the order of `windows`
+    return result[np.argsort(np.argsort(windows))]
+
+
+class OrderStore(object):
+    """op sorted by (user_id, order_number, add_to_cart_order), with user -> orders -> items offsets."""
+
+    def __init__(self, user_ids, user_offsets, order_id, order_number, days_since_prior_order,
+                 order_offsets, product_id, add_to_cart_order, reordered):
+        # One entry per user
+        self.user_ids = user_ids
+        self.user_offsets = user_offsets
+        # One entry per order
+        self.order_id = order_id
+        self.order_number = order_number
+        self.days_since_prior_order = days_since_prior_order
+        self.order_offsets = order_offsets
+        # One entry per product of an order (item)
+        self.product_id = product_id
+        self.add_to_cart_order = add_to_cart_order
+        self.reordered = reordered
+
+    @classmethod
+    def from_op(cls, op):
+        """Build the store from op (orders merged with order_products_prior)."""
+        sort = np.lexsort((op.add_to_cart_order.values, op.order_number.values, op.user_id.values))
+        user_id = op.user_id.values[sort]
+        order_id = op.order_id.values[sort]
+
+        # An order starts where the order_id changes, a user where the user_id changes
+        new_order = np.ones(len(sort), dtype=bool)
+        new_order[1:] = order_id[1:] != order_id[:-1]
+        order_start = np.flatnonzero(new_order)
+        new_user = np.ones(len(order_start), dtype=bool)
+        new_user[1:] = user_id[order_start[1:]] != user_id[order_start[:-1]]
+        user_start = np.flatnonzero(new_user)
+
+        return cls(user_ids=user_id[order_start[user_start]],
+                   user_offsets=np.append(user_start, len(order_start)),
+                   order_id=order_id[order_start],
+                   order_number=op.order_number.values[sort][order_start],
+                   days_since_prior_order=op.days_since_prior_order.values[sort][order_start],
+                   order_offsets=np.append(order_start, len(sort)),
+                   product_id=op.product_id.values[sort],
+                   add_to_cart_order=op.add_to_cart_order.values[sort],
+                   reordered=op.reordered.values[sort])
+
+    @classmethod
+    def from_tables(cls, orders, order_products_prior):
+        """Build the store from the orders and order_products_prior DataFrames."""
+        return cls.from_op(dense_merge(orders, order_products_prior, on='order_id', how='inner'))
+
+    @property
+    def n_users(self):
+        return len(self.user_ids)
+
+    @property
+    def n_orders(self):
+        return len(self.order_id)
+
+    @property
+    def n_items(self):
+        return len(self.product_id)
+
+    def orders_of(self, u):
+        """Slice of the order arrays with the orders of user number `u`."""
+        return slice(self.user_offsets[u], self.user_offsets[u + 1])
+
+    def items_of(self, u):
+        """Slice of the item arrays with all the products that user number `u` bought."""
+        return slice(self.order_offsets[self.user_offsets[u]], self.order_offsets[self.user_offsets[u + 1]])
+
+    def items_of_order(self, j):
+        """Slice of the item arrays with the products of order number `j`."""
+        return slice(self.order_offsets[j], self.order_offsets[j + 1])
+
+    def item_offsets(self):
+        """Offsets of the items of every user: user u has items[item_offsets[u]:item_offsets[u + 1]]."""
+        return self.order_offsets[self.user_offsets]
+
+    def order_user(self):
+        """User number of every order."""
+        return np.repeat(np.arange(self.n_users), np.diff(self.user_offsets))
+
+    def item_order(self):
+        """Order number (position in the order arrays) of every item."""
+        return np.repeat(np.arange(self.n_orders), np.diff(self.order_offsets))
+
+    def item_user(self):
+        """User number of every item."""
+        return np.repeat(np.arange(self.n_users), np.diff(self.item_offsets()))
+
+    def total_orders(self):
+        """The highest order_number of every user (u_total_orders)."""
+        return self.order_number[self.user_offsets[1:] - 1]
+
+    def order_number_back(self):
+        """order_number_back of every order: 1 for the last order of its user, 2 for the one before, ..."""
+        total = np.repeat(self.total_orders(), np.diff(self.user_offsets))
+        return total - self.order_number + 1
+
+    def last_n_orders(self, n=LAST_N):
+        """Boolean mask of the orders with order_number_back <= n."""
+        return self.order_number_back() <= n
+
+    def take_users(self, users):
+        """A store with the users number `users` (sorted) and all their orders and items."""
+        users = np.asarray(users, dtype='int64')
+        orders = concat_ranges(self.user_offsets[users], self.user_offsets[users + 1])
+        items = concat_ranges(self.order_offsets[orders], self.order_offsets[orders + 1])
+        n_orders = np.diff(self.user_offsets)[users]
+        n_items = np.diff(self.order_offsets)[orders]
+        return OrderStore(user_ids=self.user_ids[users],
+                          user_offsets=np.concatenate([[0], np.cumsum(n_orders)]),
+                          order_id=self.order_id[orders],
+                          order_number=self.order_number[orders],
+                          days_since_prior_order=self.days_since_prior_order[orders],
+                          order_offsets=np.concatenate([[0], np.cumsum(n_items)]),
+                          product_id=self.product_id[items],
+                          add_to_cart_order=self.add_to_cart_order[items],
+                          reordered=self.reordered[items])
+
+    def to_op(self):
+        """Return op as a DataFrame, sorted by (user_id, order_number, add_to_cart_order)."""
+        item_order = self.item_order()
+        return pd.DataFrame({'order_id': self.order_id[item_order],
+                             'user_id': np.repeat(self.user_ids, np.diff(self.item_offsets())),
+                             'order_number': self.order_number[item_order],
+                             'days_since_prior_order': self.days_since_prior_order[item_order],
+                             'product_id': self.product_id,
+                             'add_to_cart_order': self.add_to_cart_order,
+                             'reordered': self.reordered})
+
+
+class UxpPairs(object):
+    """The user X product pairs of a store, as contiguous segments of the items.
+
+    The items are sorted once by (user, product); a stable sort keeps the
+    items of every pair in (order_number, add_to_cart_order) order. Every
+    statistic of the pairs is then one reduction over the same sorted arrays
+    (see reduce()), without any grouping.
+    """
+
+    def __init__(self, store):
+        item_user = store.item_user()
+        key = item_user.astype('int64') * (int(store.product_id.max()) + 1) + store.product_id
+        self.sort = np.argsort(key, kind='stable')
+        key = key[self.sort]
+        new_pair = np.ones(len(key), dtype=bool)
+        new_pair[1:] = key[1:] != key[:-1]
+        self.starts = np.flatnonzero(new_pair)
+        self.ends = np.append(self.starts[1:], len(key))
+
+        first_item = self.sort[self.starts]
+        self.user = item_user[first_item]
+        self.product_id = store.product_id[first_item]
+        self.count = self.ends - self.starts
+
+    def __len__(self):
+        return len(self.starts)
+
+    def item_pair(self):
+        """Pair number of every item of the store."""
+        out = np.empty(len(self.sort), dtype='int64')
+        out[self.sort] = np.repeat(np.arange(len(self)), self.count)
+        return out
+
+    def reduce(self, values, how='sum'):
+        """Reduce item-level `values` per pair, with a segment_reduce() `how`."""
+        return segment_reduce(values[self.sort], self.starts, self.ends, how)
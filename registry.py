@@ -0,0 +1,606 @@
+# -*- coding: utf-8 -*-
+"""The predictors of chapter 2, declared once and computed from the OrderStore.
+
+Every feature declares its grain (user, product or uxp), its inputs and a
+formula. An input is an aggregate of the rows of op, written as
+
+    [grain/]how[:column][@window]
+
+e.g. 'count', 'sum:reordered@5' (over the last 5 orders of each user) or
+'user/max:order_number' (an aggregate of another grain). how is one of
+count, sum, mean, min, max, first, last and median; 'key:<column>' gives the
+keys of the grain (user_id, product_id, or user, the position of the user in
+the store), 'seq:<name>' a result of the sequence kernels of sequences.py
+(e.g. 'seq:days_since_last' per pair, which needs Numba), and
+'decay:orders@h' or 'decay:days@h' the reorder ratio of decay.py with a
+half-life of h orders or days.
+
+A Plan takes the features that a model asks for, collects the aggregates that
+they need and runs one pass per grain: the rows are laid out once per grain
+(by user in the store, by product with np.bincount, by pair with UxpPairs)
+and every aggregate is a single reduction of that layout. An aggregate that
+several features use (u_total_orders and the Total_orders of
+uxp_reorder_ratio, uxp_total_bought_last5 and times_last5, ...) is computed
+once, and a new feature only adds reductions to an existing pass. The counts,
+sums and means of all the windows of a pass (@1, @3, @5, ...) come out of
+one scan of order_number_back, with no copy of the rows per window.
+
+Plan() computes the predictors of the notebook. The variants over the other
+WINDOWS (size_last10, p_reorder_last1, uxp_total_bought_last20, ...) are
+registered too, and computed when a model asks for them by name.
+
+    plan = Plan(['u_reordered_ratio', 'uxp_reorder_ratio'])
+    frames = plan.run(store)          # {'user': ..., 'uxp': ...}
+
+run() is aggregate() (the passes) followed by Plan.frames() (the formulas),
+so the aggregates can also come from elsewhere, e.g. merged from shards of
+the users by sharded.py.
+"""
+from collections import namedtuple
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from features import LAST_N, MIN_PURCHASES
+import decay
+from hierarchy import level_totals, user_level_totals
+from order_store import UxpPairs, segment_median, segment_reduce, suffix_starts
+from schema import compact
+
+GRAINS = ('user', 'product', 'uxp')
+KEYS = {'user': ['user_id'], 'product': ['product_id'], 'uxp': ['user_id', 'product_id']}
+HOWS = ('count', 'sum', 'mean', 'min', 'max', 'first', 'last', 'median', 'key', 'seq', 'decay')
+
+# Columns of op that the store keeps per item, and per order
+ITEM_COLUMNS = ('product_id', 'add_to_cart_order', 'reordered')
+ORDER_COLUMNS = ('order_number', 'days_since_prior_order')
+
+# Default values of the parameters of the formulas; the aisle and department features need a hierarchy,
+# uxp_affinity_last5 a fitted ProductAffinity and the embedding features fitted Embeddings
+PARAMS = {'min_purchases': MIN_PURCHASES, 'hierarchy': None, 'affinity': None, 'embeddings': None}
+
+# The last-N windows of the recency predictors
+WINDOWS = (1, 3, 5, 10, 20)
+
+# The half-lives of the decayed reorder ratios, in orders and in days
+HALF_LIVES = {'orders': (2, 5, 10), 'days': (7, 30, 90)}
+
+# The components of the user and product vectors that are registered as u_emb_<j> and p_emb_<j>
+EMBEDDING_DIMS = 32
+
+# The modules whose code computes the features, part of Plan.definition_key()
+SOURCES = ('registry.py', 'order_store.py', 'decay.py', 'sequences.py', 'hierarchy.py', 'cooccurrence.py',
+           'embeddings.py', 'features.py', 'schema.py')
+
+Aggregate = namedtuple('Aggregate', ['grain', 'how', 'column', 'window'])
+
+
+def parse_input(text, grain):
+    """Parse '[grain/]how[:column][@window]' into an Aggregate; the grain defaults to `grain`."""
+    if '/' in text:
+        grain, text = text.split('/', 1)
+    window = None
+    if '@' in text:
+        text, window = text.split('@', 1)
+        window = int(window)
+    how, _, column = text.partition(':')
+    if grain not in GRAINS or how not in HOWS:
+        raise ValueError('bad feature input: %r' % text)
+    if (how == 'count') != (column == ''):
+        raise ValueError('count takes no column, the other aggregates need one: %r' % text)
+    if how == 'decay' and (column not in ('orders', 'days') or window is None):
+        raise ValueError('decay needs orders or days and a half-life: %r' % text)
+    if how not in ('key', 'seq', 'decay') and column and column not in ITEM_COLUMNS + ORDER_COLUMNS:
+        raise ValueError('unknown column: %r' % column)
+    return Aggregate(grain, how, column or None, window)
+
+
+class Feature(object):
+    """A predictor: its name, grain, inputs (aggregates) and the formula that combines them.
+
+    The formula gets one array per input, in order, plus the parameters named
+    in `params` as keyword arguments, and returns one value per row of the grain.
+    """
+
+    def __init__(self, name, grain, inputs, formula, params=(), default=True):
+        if grain not in GRAINS:
+            raise ValueError('unknown grain: %r' % grain)
+        self.name = name
+        self.grain = grain
+        self.inputs = [parse_input(text, grain) for text in inputs]
+        self.formula = formula
+        self.params = tuple(params)
+        # Computed by Plan() without a list of features
+        self.default = default
+
+    def compute(self, values, params):
+        return self.formula(*[values[a] for a in self.inputs], **{p: params[p] for p in self.params})
+
+    def __repr__(self):
+        return 'Feature(%r, %r)' % (self.name, self.grain)
+
+
+REGISTRY = {}
+
+
+def register(name, grain, inputs, formula, params=(), default=True):
+    """Add a feature to the registry; the columns of a grain come out in the order of registration."""
+    if name in REGISTRY:
+        raise ValueError('feature already registered: %r' % name)
+    REGISTRY[name] = Feature(name, grain, inputs, formula, params, default)
+    return REGISTRY[name]
+
+
+def features_of(grain, default=True):
+    """Names of the registered features of `grain` (only the default ones, unless default=False)."""
+    return [name for name, feature in REGISTRY.items()
+            if feature.grain == grain and (feature.default or not default)]
+
+
+########################################
+## PASSES: ONE LAYOUT PER GRAIN
+########################################
+class _Items(object):
+    # The columns of the store at the grain of the items (rows of op), built once per run
+    def __init__(self, store):
+        self.store = store
+        self.item_order = store.item_order()
+        self._columns = {}
+        self._windows = {}
+        self.sequences = {}
+
+    def column(self, name):
+        if name not in self._columns:
+            if name in ITEM_COLUMNS:
+                self._columns[name] = getattr(self.store, name)
+            else:
+                self._columns[name] = getattr(self.store, name)[self.item_order]
+        return self._columns[name]
+
+    def back(self):
+        # order_number_back of every item
+        if 'back' not in self._columns:
+            self._columns['back'] = self.store.order_number_back()[self.item_order]
+        return self._columns['back']
+
+    def window(self, n):
+        # Items in the last n orders of their user
+        if n not in self._windows:
+            self._windows[n] = self.store.last_n_orders(n)[self.item_order]
+        return self._windows[n]
+
+
+def _masked(values, mask, how):
+    # Values outside the window do not count: 0 in sums, NaN in min, max and median
+    if mask is None:
+        return values
+    if how == 'sum':
+        return np.where(mask, values, 0)
+    if how in ('min', 'max', 'median'):
+        return np.where(mask, values.astype('float64'), np.nan)
+    raise ValueError('%s has no window' % how)
+
+
+def _mean(total, count):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+
+def _cumsum(values):
+    # Running sum with a leading 0, so the sum of values[i:j] is c[j] - c[i]
+    if values.dtype.kind in 'iub':
+        values = values.astype('int64')
+    return np.concatenate([np.zeros(1, dtype=values.dtype), np.cumsum(values)])
+
+
+def _segments(items, aggregates, starts, ends, segment, n, sort=None):
+    # One pass over items laid out in contiguous segments (users or pairs), in order inside every segment
+    def values(column):
+        v = items.column(column)
+        return v if sort is None else v[sort]
+
+    def mask(window):
+        if window is None:
+            return None
+        return items.window(window) if sort is None else items.window(window)[sort]
+
+    # The counts, sums and means of all the windows: the items of a window are a suffix of every segment
+    windowed = [a for a in aggregates if a.window is not None and a.how in ('count', 'sum', 'mean')]
+    windows = sorted(set(a.window for a in windowed))
+    if windows:
+        back = items.back() if sort is None else items.back()[sort]
+        suffix = dict(zip(windows, suffix_starts(back, starts, ends, windows)))
+        sums = {}
+
+    out = {}
+    for a in aggregates:
+        if a in windowed:
+            first = suffix[a.window]
+            count = ends - first
+            if a.how == 'count':
+                out[a] = count
+                continue
+            if a.column not in sums:
+                sums[a.column] = _cumsum(values(a.column))
+            total = sums[a.column][ends] - sums[a.column][first]
+            out[a] = total if a.how == 'sum' else _mean(total, count)
+        elif a.how == 'count':
+            out[a] = ends - starts
+        elif a.how == 'mean':
+            out[a] = _mean(segment_reduce(values(a.column), starts, ends), ends - starts)
+        elif a.how == 'median':
+            out[a] = segment_median(_masked(values(a.column), mask(a.window), 'median'), segment, n)
+        else:
+            out[a] = segment_reduce(_masked(values(a.column), mask(a.window), a.how), starts, ends, a.how)
+    return out
+
+
+def _sequences(store, items, grain, pairs=None):
+    # The sequence kernels, once per run and grain; Numba is only needed when a plan asks for them
+    import sequences
+    if grain not in items.sequences:
+        items.sequences[grain] = (sequences.user_sequences(store) if grain == 'user'
+                                  else sequences.pair_sequences(store, pairs))
+    return items.sequences[grain]
+
+
+def _decay(aggregates, ratios):
+    # All the half-lives of each kind of age in one call: one column of the result per half-life
+    out = {}
+    for by in ('orders', 'days'):
+        wanted = [a for a in aggregates if a.how == 'decay' and a.column == by]
+        if wanted:
+            values = ratios(by, [a.window for a in wanted])
+            out.update((a, values[:, j]) for j, a in enumerate(wanted))
+    return out
+
+
+def _user_pass(store, items, aggregates):
+    out = {}
+    starts = store.item_offsets()[:-1]
+    ends = store.item_offsets()[1:]
+    by_items = []
+    for a in aggregates:
+        if a.how == 'key':
+            out[a] = store.user_ids if a.column == 'user_id' else np.arange(store.n_users)
+        elif a.how == 'seq':
+            out[a] = _sequences(store, items, 'user')[a.column]
+        elif a.how == 'decay':
+            continue  # all the half-lives together, below
+        elif a.column in ORDER_COLUMNS and a.how in ('min', 'max', 'first', 'last'):
+            # These do not depend on how many items an order has: reduce the orders of every user instead
+            values = getattr(store, a.column)
+            if a.window is not None:
+                values = _masked(values, store.last_n_orders(a.window), a.how)
+            out[a] = segment_reduce(values, store.user_offsets[:-1], store.user_offsets[1:], a.how)
+        else:
+            by_items.append(a)
+    out.update(_decay(aggregates, lambda by, half_lives: decay.user_ratios(store, by, half_lives)))
+    if by_items:
+        segment = store.item_user() if any(a.how == 'median' for a in by_items) else None
+        out.update(_segments(items, by_items, starts, ends, segment, store.n_users))
+    return out
+
+
+def _uxp_pass(store, items, aggregates):
+    pairs = UxpPairs(store)
+    keys = {'user_id': store.user_ids[pairs.user], 'product_id': pairs.product_id, 'user': pairs.user}
+    out = {a: keys[a.column] for a in aggregates if a.how == 'key'}
+    out.update((a, _sequences(store, items, 'uxp', pairs)[a.column]) for a in aggregates if a.how == 'seq')
+    out.update(_decay(aggregates, lambda by, half_lives: decay.pair_ratios(store, pairs, by, half_lives)))
+    rest = [a for a in aggregates if a.how not in ('key', 'seq', 'decay')]
+    segment = np.repeat(np.arange(len(pairs)), pairs.count) if any(a.how == 'median' for a in rest) else None
+    out.update(_segments(items, rest, pairs.starts, pairs.ends, segment, len(pairs), sort=pairs.sort))
+    return out
+
+
+def _product_pass(store, items, aggregates):
+    # product_id is a small integer: every aggregate is a np.bincount, kept for the products that were bought
+    size = int(store.product_id.max()) + 1 if store.n_items else 0
+    product_id = store.product_id
+    count = np.bincount(product_id, minlength=size)
+    bought = np.flatnonzero(count)
+
+    # All the windows in one bincount per column: every item goes to its smallest window, and the sum of a
+    # window is the running sum over the windows up to it
+    windows = sorted(set(a.window for a in aggregates if a.window is not None))
+    if windows:
+        cell = product_id.astype('int64') * (len(windows) + 1) + np.searchsorted(windows, items.back(), side='left')
+    sums = {}
+
+    def bincount(column, window):
+        weights = None if column is None else items.column(column)
+        if window is None:
+            return count if column is None else np.bincount(product_id, weights=weights, minlength=size)
+        if column not in sums:
+            per_window = np.bincount(cell, weights=weights, minlength=size * (len(windows) + 1))
+            sums[column] = np.cumsum(per_window.reshape(size, len(windows) + 1), axis=1)
+        return sums[column][:, windows.index(window)]
+
+    out = {}
+    for a in aggregates:
+        if a.how == 'key':
+            out[a] = bought.astype(product_id.dtype)
+        elif a.how == 'count':
+            out[a] = bincount(None, a.window)[bought]
+        elif a.how == 'sum':
+            out[a] = bincount(a.column, a.window)[bought]
+        elif a.how == 'mean':
+            out[a] = _mean(bincount(a.column, a.window), bincount(None, a.window))[bought]
+        else:
+            raise ValueError('the product pass only counts, sums and averages: %r' % (a,))
+    return out
+
+
+PASSES = {'user': _user_pass, 'product': _product_pass, 'uxp': _uxp_pass}
+
+
+class Plan(object):
+    """The features to compute, and the aggregates that they need grouped into one pass per grain."""
+
+    def __init__(self, features=None):
+        names = [n for n, f in REGISTRY.items() if f.default] if features is None else list(features)
+        unknown = [name for name in names if name not in REGISTRY]
+        if unknown:
+            raise ValueError('unknown features: %s' % unknown)
+        self.features = [REGISTRY[name] for name in REGISTRY if name in names]
+        self.grains = [g for g in GRAINS if any(f.grain == g for f in self.features)]
+        needed = set()
+        for grain in self.grains:
+            needed.update(Aggregate(grain, 'key', key, None) for key in KEYS[grain])
+        for f in self.features:
+            needed.update(f.inputs)
+        self.passes = {g: sorted((a for a in needed if a.grain == g), key=str) for g in GRAINS}
+
+    def __repr__(self):
+        lines = ['Plan of %d features' % len(self.features)]
+        for grain in GRAINS:
+            if self.passes[grain]:
+                lines.append('  %s pass: %s' % (grain, ', '.join(_label(a) for a in self.passes[grain])))
+        return '\n'.join(lines)
+
+    def definition_key(self, **params):
+        """Hash of the features of the plan, their inputs and parameters, and of the code in SOURCES.
+
+        Two plans with the same key compute the same tables from the same
+        store; feature_store.py keys the stored tables with it.
+        """
+        params = dict(PARAMS, **params)
+        sha = hashlib.sha1()
+        for f in self.features:
+            spec = (f.name, f.grain, [tuple(a) for a in f.inputs], [(p, params[p]) for p in f.params])
+            sha.update(repr(spec).encode())
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in SOURCES:
+            with open(os.path.join(here, name), 'rb') as f:
+                sha.update(f.read())
+        return sha.hexdigest()
+
+    def needed(self):
+        """All the aggregates of the plan, pass after pass."""
+        return [a for grain in GRAINS for a in self.passes[grain]]
+
+    def run(self, store, **params):
+        """Compute the features from `store`; return one DataFrame per grain, with its keys first."""
+        return self.frames(aggregate(store, self.needed()), **params)
+
+    def frames(self, values, **params):
+        """Apply the formulas to `values`, the {Aggregate: array} of aggregate(); return one DataFrame per grain."""
+        params = dict(PARAMS, **params)
+        frames = {}
+        for grain in self.grains:
+            frame = pd.DataFrame({key: values[Aggregate(grain, 'key', key, None)] for key in KEYS[grain]})
+            for f in self.features:
+                if f.grain == grain:
+                    frame[f.name] = f.compute(values, params)
+            # Rows without a value (e.g. no purchase in the last 5 orders) get zero, as in the notebook
+            frames[grain] = compact(frame.fillna(0))
+        return frames
+
+
+def aggregate(store, aggregates):
+    """Compute `aggregates` from `store` in one pass per grain; return them as {Aggregate: array}."""
+    items = _Items(store)
+    values = {}
+    for grain in GRAINS:
+        wanted = [a for a in aggregates if a.grain == grain]
+        if wanted:
+            values.update(PASSES[grain](store, items, wanted))
+    return values
+
+
+def _label(a):
+    text = a.how + (':' + a.column if a.column else '')
+    return text + ('@%d' % a.window if a.window is not None else '')
+
+
+########################################
+## THE PREDICTORS OF CHAPTER 2
+########################################
+LAST = '@%d' % LAST_N
+
+
+def _identity(values):
+    return values
+
+
+def _missing_if_zero(n):
+    # Pairs that were not bought in the last 5 orders are NaN (and then 0), as after the notebook's left merge
+    return np.where(n > 0, n, np.nan)
+
+
+def _of_user(values, pair_user):
+    # A value per user, gathered for every pair of the user by its position in the store
+    return values[pair_user]
+
+
+def _size_last(n_last, pair_user, user_ids):
+    # Number of different products of every user in the window
+    return np.bincount(pair_user[n_last > 0], minlength=len(user_ids))
+
+
+def _share_of(window):
+    # Times bought in the window, per order of the window
+    return lambda n: n / window
+
+
+def _if_supported(count, mean, min_purchases):
+    # The mean of the products with more than min_purchases purchases, NaN for the others
+    return np.where(count > min_purchases, mean, np.nan)
+
+
+def _uxp_reorder_ratio(count, first_order_number, total_orders, pair_user):
+    # Times_Bought_N / Order_Range_D, with Order_Range_D from the first order of the pair to the user's last
+    order_range = total_orders[pair_user].astype('int64') - first_order_number + 1
+    return count / order_range
+
+
+# 2.1 User predictors
+register('u_total_orders', 'user', ['max:order_number'], _identity)
+register('u_reordered_ratio', 'user', ['mean:reordered'], _identity)
+register('size_last5', 'user', ['uxp/count' + LAST, 'uxp/key:user', 'key:user_id'], _size_last)
+
+# 2.2 Product predictors
+register('p_total_purchases', 'product', ['count'], _identity)
+register('p_reorder_ratio', 'product', ['count', 'mean:reordered'], _if_supported, params=['min_purchases'])
+register('avg_position', 'product', ['count', 'mean:add_to_cart_order'], _if_supported, params=['min_purchases'])
+register('p_reorder_last5', 'product', ['mean:reordered' + LAST], _identity)
+
+# 2.3 User X product predictors
+register('uxp_total_bought', 'uxp', ['count'], _identity)
+register('uxp_total_bought_last5', 'uxp', ['count' + LAST], _missing_if_zero)
+register('uxp_reorder_ratio', 'uxp', ['count', 'first:order_number', 'user/max:order_number', 'key:user'],
+         _uxp_reorder_ratio)
+register('times_last5', 'uxp', ['count' + LAST], _missing_if_zero)
+register('last5_ ratio', 'uxp', ['count' + LAST], _share_of(LAST_N))
+register('max_days_last5', 'uxp', ['user/max:days_since_prior_order' + LAST, 'key:user'], _of_user)
+register('med_days_last5', 'uxp', ['user/median:days_since_prior_order' + LAST, 'key:user'], _of_user)
+register('uxp_max_days', 'uxp', ['user/max:days_since_prior_order', 'key:user'], _of_user)
+
+
+def register_windows(windows=WINDOWS):
+    """Register the recency predictors of every last-N window, besides the ones of the last 5 orders above."""
+    for n in windows:
+        if n == LAST_N:
+            continue
+        last = '@%d' % n
+        register('size_last%d' % n, 'user', ['uxp/count' + last, 'uxp/key:user', 'key:user_id'], _size_last,
+                 default=False)
+        register('p_reorder_last%d' % n, 'product', ['mean:reordered' + last], _identity, default=False)
+        register('uxp_total_bought_last%d' % n, 'uxp', ['count' + last], _missing_if_zero, default=False)
+        register('uxp_last%d_ratio' % n, 'uxp', ['count' + last], _share_of(n), default=False)
+
+
+register_windows()
+
+
+# Timing along the history of every user (sequences.py, with Numba)
+register('u_total_days', 'user', ['seq:total_days'], _identity, default=False)
+register('uxp_days_since_last', 'uxp', ['seq:days_since_last'], _identity, default=False)
+register('uxp_orders_since_last', 'uxp', ['seq:orders_since_last'], _identity, default=False)
+register('uxp_interval_mean', 'uxp', ['seq:interval_mean'], _identity, default=False)
+register('uxp_interval_std', 'uxp', ['seq:interval_std'], _identity, default=False)
+
+
+def register_half_lives(half_lives=HALF_LIVES):
+    """Register the decayed u_reordered_ratio and uxp_reorder_ratio of every half-life."""
+    for by, values in sorted(half_lives.items()):
+        for h in values:
+            decayed = ['decay:%s@%d' % (by, h)]
+            register('u_reordered_ratio_hl%d_%s' % (h, by), 'user', decayed, _identity, default=False)
+            register('uxp_reorder_ratio_hl%d_%s' % (h, by), 'uxp', decayed, _identity, default=False)
+
+
+register_half_lives()
+
+
+# Aisles and departments (hierarchy.py), from the pairs of every user
+def _check_hierarchy(hierarchy):
+    if hierarchy is None:
+        raise ValueError('the aisle and department features need run(store, hierarchy=ProductHierarchy(products))')
+
+
+def _user_level(level, ratio):
+    # The purchases (or the reorder ratio) of the user of every pair in the aisle / department of its product
+    def formula(count, reordered, pair_user, product_id, hierarchy):
+        _check_hierarchy(hierarchy)
+        purchases, reorders = user_level_totals(pair_user, hierarchy.codes(product_id, level), hierarchy.size[level],
+                                                count.astype('float64'), reordered.astype('float64'))
+        return reorders / purchases if ratio else purchases.astype('int64')
+    return formula
+
+
+def _level_rate(level):
+    # The reorder rate of the aisle / department of every pair, over all the users
+    def formula(count, reordered, product_id, hierarchy):
+        _check_hierarchy(hierarchy)
+        codes = hierarchy.codes(product_id, level)
+        _, rate = level_totals(codes, hierarchy.size[level], count.astype('float64'), reordered.astype('float64'))
+        return rate[codes]
+    return formula
+
+
+HIERARCHY_FEATURES = ('ua_total_bought', 'ua_reorder_ratio', 'a_reorder_ratio',
+                      'ud_total_bought', 'ud_reorder_ratio', 'd_reorder_ratio')
+
+
+def register_hierarchy():
+    """Register HIERARCHY_FEATURES; a plan with them runs with hierarchy=ProductHierarchy(products)."""
+    pair = ['count', 'sum:reordered', 'key:user', 'key:product_id']
+    for level, prefix in (('aisle', 'a'), ('department', 'd')):
+        register('u%s_total_bought' % prefix, 'uxp', pair, _user_level(level, False), params=['hierarchy'],
+                 default=False)
+        register('u%s_reorder_ratio' % prefix, 'uxp', pair, _user_level(level, True), params=['hierarchy'],
+                 default=False)
+        register('%s_reorder_ratio' % prefix, 'uxp', ['count', 'sum:reordered', 'key:product_id'],
+                 _level_rate(level), params=['hierarchy'], default=False)
+
+
+register_hierarchy()
+
+
+# Basket affinity (cooccurrence.py): the products bought with the recent products of the user
+def _affinity(n_last, pair_user, product_id, affinity):
+    if affinity is None or affinity.matrix is None:
+        raise ValueError('uxp_affinity_last5 needs run(store, affinity=ProductAffinity().fit(store))')
+    return affinity.scores(pair_user, product_id, n_last > 0)
+
+
+register('uxp_affinity_last5', 'uxp', ['count' + LAST, 'key:user', 'key:product_id'], _affinity,
+         params=['affinity'], default=False)
+
+
+# User and product vectors of a low-rank factorisation of the purchases (embeddings.py)
+def _check_embeddings(embeddings):
+    if embeddings is None or embeddings.users is None:
+        raise ValueError('the embedding features need run(store, embeddings=Embeddings(k).fit(store))')
+
+
+def _embedding_score(pair_user, product_id, embeddings):
+    _check_embeddings(embeddings)
+    return embeddings.scores(pair_user, product_id)
+
+
+def _component(side, j):
+    # Component j of the vectors of the users (by position) or of the products (by product_id)
+    def formula(key, embeddings):
+        _check_embeddings(embeddings)
+        vectors = getattr(embeddings, side)
+        return vectors[key, j] if j < vectors.shape[1] else np.full(len(key), np.nan)
+    return formula
+
+
+def register_embeddings(dims=EMBEDDING_DIMS):
+    """Register uxp_embedding_score and the first `dims` components of the user and product vectors."""
+    register('uxp_embedding_score', 'uxp', ['key:user', 'key:product_id'], _embedding_score,
+             params=['embeddings'], default=False)
+    for j in range(dims):
+        register('u_emb_%d' % j, 'user', ['key:user'], _component('users', j), params=['embeddings'], default=False)
+    for j in range(dims):
+        register('p_emb_%d' % j, 'product', ['key:product_id'], _component('products', j), params=['embeddings'],
+                 default=False)
+
+
+register_embeddings()
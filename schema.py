@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Column types of the Instacart tables.
+
+pandas infers int64/float64 for every numeric column, which makes
+order_products__prior (32M rows) and the op DataFrame several times bigger
+than they need to be. Here we declare the narrowest type that holds every
+value of each column, so that the whole pipeline fits in 16 GB of memory.
+"""
+import numpy as np
+import pandas as pd
+
+# Identifiers: order_id < 3.5M, user_id < 210K, product_id < 50K in the Kaggle data
+ID = 'uint32'
+
+DTYPES = {
+    'orders': {
+        'order_id': ID,
+        'user_id': ID,
+        'eval_set': 'category',
+        'order_number': 'uint8',            # at most 100 orders per user
+        'order_dow': 'uint8',
+        'order_hour_of_day': 'uint8',
+        'days_since_prior_order': 'float32',  # NaN on the first order of every user
+    },
+    'order_products__prior': {
+        'order_id': ID,
+        'product_id': ID,
+        'add_to_cart_order': 'uint8',       # at most 145 products in a basket
+        'reordered': 'uint8',
+    },
+    'order_products__train': {
+        'order_id': ID,
+        'product_id': ID,
+        'add_to_cart_order': 'uint8',
+        'reordered': 'uint8',
+    },
+    'products': {
+        'product_id': ID,
+        'product_name': 'category',
+        'aisle_id': 'uint16',
+        'department_id': 'uint16',
+    },
+    'aisles': {
+        'aisle_id': 'uint16',
+        'aisle': 'category',
+    },
+    'departments': {
+        'department_id': 'uint16',
+        'department': 'category',
+    },
+}
+
+
+def schema_key(table):
+    """Return a string that changes whenever the schema of `table` changes (used by the cache)."""
+    return ','.join('%s:%s' % item for item in sorted(DTYPES[table].items()))
+
+
+def compact(df):
+    """Shrink the numeric columns of a feature DataFrame in place and return it.
+
+    Floats become float32 (XGBoost works in float32 anyway) and integers become
+    the smallest unsigned type that holds them. Columns with negative values are
+    downcast as signed integers. Identifier columns (*_id) keep the schema type,
+    so that joins always compare the same types.
+    """
+    for col in df.columns:
+        if col.endswith('_id'):
+            continue
+        kind = df[col].dtype.kind
+        if kind == 'f' and df[col].dtype != np.float32:
+            df[col] = df[col].astype('float32')
+        elif kind in 'iu':
+            signed = kind == 'i' and len(df) > 0 and df[col].min() < 0
+            df[col] = pd.to_numeric(df[col], downcast='integer' if signed else 'unsigned')
+    return df
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Timing of the purchases along the history of every user, with Numba.
+
+The predictors of registry.py are reductions: a count, a sum or a maximum
+per user, product or pair. Some questions need the orders in sequence
+instead: how many days passed between two purchases of the same product, or
+since the last one. The kernels here walk the history of every user once,
+order after order, in the layout of the OrderStore, and give:
+
+* cumulative_days: the days from the first order of its user, for every order,
+* per pair (UxpPairs): days_since_last and orders_since_last, from the last
+  purchase of the product to the last order of the user, and interval_mean
+  and interval_std, the mean and the standard deviation of the days between
+  two purchases of the product (NaN if bought once, or twice for the std).
+"""
+import numba
+import numpy as np
+
+PAIR_SEQUENCES = ('days_since_last', 'orders_since_last', 'interval_mean', 'interval_std')
+USER_SEQUENCES = ('total_days',)
+
+
+@numba.njit(nogil=True, cache=True)
+def _cumulative_days(user_offsets, days):
+    out = np.empty(len(days))
+    for u in range(len(user_offsets) - 1):
+        total = 0.0
+        for j in range(user_offsets[u], user_offsets[u + 1]):
+            # days_since_prior_order is NaN on the first order
+            if not np.isnan(days[j]):
+                total += days[j]
+            out[j] = total
+    return out
+
+
+@numba.njit(nogil=True, cache=True)
+def _walk_pairs(user_offsets, order_offsets, order_number, cum_days, item_pair, pair_offsets):
+    n_pairs = pair_offsets[-1]
+    last_days = np.zeros(n_pairs)
+    last_order = np.full(n_pairs, -1)
+    n = np.zeros(n_pairs, np.int64)
+    mean = np.zeros(n_pairs)
+    m2 = np.zeros(n_pairs)
+    days_since = np.empty(n_pairs)
+    orders_since = np.empty(n_pairs, np.int64)
+    for u in range(len(user_offsets) - 1):
+        for j in range(user_offsets[u], user_offsets[u + 1]):
+            for i in range(order_offsets[j], order_offsets[j + 1]):
+                p = item_pair[i]
+                if last_order[p] >= 0:
+                    # Welford's update of the mean and of the sum of squares of the intervals
+                    interval = cum_days[j] - last_days[p]
+                    n[p] += 1
+                    delta = interval - mean[p]
+                    mean[p] += delta / n[p]
+                    m2[p] += delta * (interval - mean[p])
+                last_days[p] = cum_days[j]
+                last_order[p] = j
+        last = user_offsets[u + 1] - 1
+        for p in range(pair_offsets[u], pair_offsets[u + 1]):
+            days_since[p] = cum_days[last] - last_days[p]
+            orders_since[p] = order_number[last] - order_number[last_order[p]]
+
+    interval_mean = np.full(n_pairs, np.nan)
+    interval_std = np.full(n_pairs, np.nan)
+    for p in range(n_pairs):
+        if n[p] > 0:
+            interval_mean[p] = mean[p]
+        if n[p] > 1:
+            # The sample standard deviation, as pandas' .std()
+            interval_std[p] = np.sqrt(m2[p] / (n[p] - 1))
+    return days_since, orders_since, interval_mean, interval_std
+
+
+def cumulative_days(store):
+    """Days from the first order of its user to every order of the store."""
+    return _cumulative_days(store.user_offsets, store.days_since_prior_order.astype('float64'))
+
+
+def user_sequences(store):
+    """Return {'total_days': ...}, the days from the first to the last order of every user."""
+    return {'total_days': cumulative_days(store)[store.user_offsets[1:] - 1]}
+
+
+def pair_sequences(store, pairs):
+    """Return the PAIR_SEQUENCES of every pair of `pairs` (UxpPairs of `store`), as a dict of arrays."""
+    # The pairs are sorted by user: those of user u are pair_offsets[u]:pair_offsets[u + 1]
+    pair_offsets = np.searchsorted(pairs.user, np.arange(store.n_users + 1))
+    values = _walk_pairs(store.user_offsets, store.order_offsets, store.order_number.astype('int64'),
+                         cumulative_days(store), pairs.item_pair(), pair_offsets)
+    return dict(zip(PAIR_SEQUENCES, values))
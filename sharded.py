@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""Compute the predictors of registry.py on several cores, sharded by user_id.
+
+Every user goes to one of N shards, by a hash of its user_id split into N
+equal ranges, and all the orders, items and pairs of a user go with it.
+
+* map: a worker process takes the users of its shard out of the OrderStore
+  (OrderStore.take_users) and runs the passes of the plan over them
+  (registry.aggregate). The user and uxp aggregates of a shard are final,
+  since no user spans two shards. The product aggregates are partial: the
+  counts and sums of the products over the users of the shard, with every
+  mean replaced by its sum and its count.
+* reduce: the user and uxp arrays of the shards are concatenated and put back
+  in user_id order, and the product counts and sums of the shards are added
+  up per product_id (np.bincount), before the means are divided out. The
+  formulas of the features then run once over the merged aggregates
+  (Plan.frames), so the result is the same as Plan.run() on one core.
+
+Where the platform has fork, the workers share the arrays of the store with
+the parent process instead of receiving a copy.
+
+    python sharded.py --source ./input --workers 1 2 4 8
+"""
+import argparse
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import registry
+from registry import Aggregate
+
+# Multiplier of the user_id hash (Knuth's multiplicative hash)
+HASH_MULTIPLIER = 2654435761
+
+
+def shard_of(user_ids, n_shards):
+    """Shard (0 .. n_shards - 1) of every user_id: its 32-bit hash, split into n_shards equal ranges."""
+    hashed = (np.asarray(user_ids).astype('uint64') * np.uint64(HASH_MULTIPLIER)) & np.uint64(0xFFFFFFFF)
+    return ((hashed * np.uint64(n_shards)) >> np.uint64(32)).astype('int64')
+
+
+def _key(grain, column):
+    return Aggregate(grain, 'key', column, None)
+
+
+def mergeable(aggregates):
+    """The aggregates that a shard computes for `aggregates`: product means become sums and counts, plus the keys."""
+    out = set()
+    for a in aggregates:
+        if a.grain == 'product' and a.how == 'mean':
+            out.update([a._replace(how='sum'), a._replace(how='count', column=None)])
+        else:
+            out.add(a)
+    out.add(_key('user', 'user_id'))
+    if any(a.grain == 'uxp' for a in aggregates):
+        out.add(_key('uxp', 'user_id'))
+    if any(a.grain == 'product' for a in aggregates):
+        out.update([_key('product', 'product_id'), Aggregate('product', 'count', None, None)])
+    return sorted(out, key=str)
+
+
+def map_shard(store, shard, n_shards, aggregates):
+    """The `aggregates` (from mergeable()) of the users of `shard`, as {Aggregate: array}; {} if it has none."""
+    users = np.flatnonzero(shard_of(store.user_ids, n_shards) == shard)
+    if not len(users):
+        return {}
+    return registry.aggregate(store.take_users(users), aggregates)
+
+
+def reduce_shards(partials, aggregates):
+    """Merge the map_shard() results into the values of `aggregates`, as registry.aggregate() over all the users."""
+    partials = [p for p in partials if p]
+
+    def concat(a):
+        return np.concatenate([p[a] for p in partials])
+
+    values = {}
+    # Users: back in user_id order; 'key:user' is the position of the user among all of them
+    user_ids = concat(_key('user', 'user_id'))
+    order = np.argsort(user_ids, kind='stable')
+    user_ids = user_ids[order]
+    for a in aggregates:
+        if a.grain == 'user':
+            values[a] = np.arange(len(user_ids)) if a == _key('user', 'user') else concat(a)[order]
+
+    # Pairs: the pairs of a user are in product_id order inside its shard, so a stable sort by user_id is enough
+    if any(a.grain == 'uxp' for a in aggregates):
+        pair_user_ids = concat(_key('uxp', 'user_id'))
+        order = np.argsort(pair_user_ids, kind='stable')
+        for a in aggregates:
+            if a.grain == 'uxp':
+                if a == _key('uxp', 'user'):
+                    values[a] = np.searchsorted(user_ids, pair_user_ids[order])
+                else:
+                    values[a] = concat(a)[order]
+
+    # Products: add up the counts and sums of the shards
+    if any(a.grain == 'product' for a in aggregates):
+        product_id = concat(_key('product', 'product_id'))
+        size = int(product_id.max()) + 1 if len(product_id) else 0
+
+        def total(a):
+            merged = np.bincount(product_id, weights=concat(a), minlength=size)
+            return merged.astype('int64') if a.how == 'count' else merged
+
+        count = total(Aggregate('product', 'count', None, None))
+        bought = np.flatnonzero(count)
+        for a in aggregates:
+            if a.grain != 'product':
+                continue
+            if a.how == 'key':
+                values[a] = bought.astype(product_id.dtype)
+            elif a.how == 'mean':
+                n = total(a._replace(how='count', column=None))
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    values[a] = np.where(n > 0, total(a._replace(how='sum')) / np.maximum(n, 1), np.nan)[bought]
+            else:
+                values[a] = total(a)[bought]
+    return values
+
+
+########################################
+## THE EXECUTOR
+########################################
+_worker_store = None
+
+
+def _init_worker(store):
+    global _worker_store
+    _worker_store = store
+
+
+def _map_in_worker(shard, n_shards, aggregates):
+    return map_shard(_worker_store, shard, n_shards, aggregates)
+
+
+class ShardedExecutor(object):
+    """Run a registry Plan over `shards` shards of users, in `workers` processes (default: one per core)."""
+
+    def __init__(self, workers=None, shards=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.shards = shards or self.workers
+        # Wall time of the last run, in seconds, per phase
+        self.seconds = {}
+
+    def run(self, plan, store, **params):
+        """Return plan.run(store, **params), computed shard by shard."""
+        if self.shards == 1:
+            return plan.run(store, **params)
+        aggregates = mergeable(plan.needed())
+        start = time.perf_counter()
+        if self.workers == 1:
+            partials = [map_shard(store, k, self.shards, aggregates) for k in range(self.shards)]
+        else:
+            ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else None
+            with ProcessPoolExecutor(self.workers, mp_context=ctx, initializer=_init_worker,
+                                     initargs=(store,)) as pool:
+                partials = list(pool.map(_map_in_worker, range(self.shards), [self.shards] * self.shards,
+                                         [aggregates] * self.shards))
+        middle = time.perf_counter()
+        values = reduce_shards(partials, plan.needed())
+        frames = plan.frames(values, **params)
+        self.seconds = {'map': middle - start, 'reduce': time.perf_counter() - middle}
+        return frames
+
+
+def check_equivalence(plan, store, workers=None, shards=None, **params):
+    """Compare the sharded run with plan.run(); raise AssertionError if they differ.
+
+    Returns the seconds of plan.run() and of the sharded run.
+    """
+    start = time.perf_counter()
+    expected = plan.run(store, **params)
+    single = time.perf_counter() - start
+    executor = ShardedExecutor(workers, shards)
+    start = time.perf_counter()
+    result = executor.run(plan, store, **params)
+    sharded = time.perf_counter() - start
+    for grain in expected:
+        pd.testing.assert_frame_equal(expected[grain], result[grain], obj=grain)
+    return single, sharded
+
+
+def main(argv=None):
+    from cooccurrence import ProductAffinity
+    from data_loader import load_tables
+    from embeddings import Embeddings
+    from hierarchy import ProductHierarchy
+    from order_store import OrderStore
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--source', default='./input', help='directory of CSV files or the Kaggle zip')
+    parser.add_argument('--workers', type=int, nargs='+', default=[os.cpu_count() or 1],
+                        help='numbers of worker processes to try')
+    parser.add_argument('--shards', type=int, default=None, help='shards per run (default: one per worker)')
+    parser.add_argument('--all', action='store_true', help='every registered feature, not only the defaults')
+    opts = parser.parse_args(argv)
+    tables = load_tables(opts.source, cache_dir=None, tables=['orders', 'order_products__prior', 'products'])
+    store = OrderStore.from_tables(tables['orders'], tables['order_products__prior'])
+    plan = registry.Plan(list(registry.REGISTRY) if opts.all else None)
+    params = {}
+    if opts.all:
+        params = {'hierarchy': ProductHierarchy(tables['products']), 'affinity': ProductAffinity().fit(store),
+                  'embeddings': Embeddings().fit(store)}
+    for workers in opts.workers:
+        single, sharded = check_equivalence(plan, store, workers, opts.shards or max(workers, 2), **params)
+        print('%2d workers: sharded %.2f s, one core %.2f s, speed-up %.2f (same features)'
+              % (workers, sharded, single, single / sharded))
+
+
+if __name__ == '__main__':
+    main()
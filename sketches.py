@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""Sketches of product popularity, distinct products and days per user, in bounded memory.
+
+The exact aggregates of streaming.py and incremental.py keep a row for every
+product, every user X product pair and every order of the last-5 window.
+SketchAggregates keeps fixed-size sketches instead, which can be updated
+chunk by chunk and merged across shards or processes:
+
+* CountMinSketch for p_total_purchases: depth rows of width counters, each
+  row hashing the product_id to one counter. The estimate is the smallest
+  of the depth counters, and it is never below the true count. With
+  width >= e / eps and depth >= ln(1 / delta), it is above the true count
+  by more than eps * N (N = all the items counted) with probability at most
+  delta. The sketch takes width x depth x 8 bytes, whatever the number of
+  products. Sketches merge by adding their counters, if they have the same
+  shape and seed.
+* HyperLogLogs for the number of distinct products of every user: 2^p
+  one-byte registers per user. Every product_id is hashed to one register,
+  and the register keeps the longest run of leading zero bits among the
+  hashes it saw. The estimate has a relative standard error of
+  1.04 / sqrt(2^p) (6.5% for p = 8). Below 2.5 x 2^p products, linear
+  counting of the empty registers is used, which is much more precise. A
+  user takes 2^p bytes, however many products it buys, and sketches merge
+  by the maximum of their registers.
+* Histograms for the quantiles of days_since_prior_order per user: one
+  counter per day for every user. days_since_prior_order is a whole number
+  of days from 0 to 30, so 31 counters give its median and its maximum
+  exactly, as for med_days_last5 and max_days_last5, with every order
+  counted once per product. A value above the last bin would count in the
+  last bin, and a fractional value in the nearest day, so then the error is
+  at most half a day. On such a small domain this does better than a
+  t-digest or KLL sketch: it is exact, it takes 124 bytes per user, and
+  merging is an addition.
+
+All the hashes are seeded, so two sketches built with the same seed merge
+into the sketch of all their rows. streaming.build_features(...,
+sketches=SketchAggregates()) updates them with every chunk of
+order_products_prior. IncrementalFeatures(sketches=SketchAggregates())
+updates them with every batch: the histograms get the orders that enter the
+last-5 window and lose the ones that leave it (update_window()), and the
+window itself is kept exactly, since it never holds more than 5 orders per
+user.
+
+    python sketches.py --source ./input
+
+compares the sketches with the exact groupbys: errors against the bounds
+above, memory and time, and that the sketches of two shards of the users
+merge into the sketch of all of them.
+"""
+import argparse
+import math
+import time
+
+import numpy as np
+import pandas as pd
+
+from features import LAST_N
+from schema import ID
+
+# days_since_prior_order is 0 .. 30
+DAYS = 31
+
+# Defaults: counts within 0.01% of all the items with probability 99.9%, and 6.5% for the distinct products
+CM_EPS = 1e-4
+CM_DELTA = 1e-3
+HLL_P = 8
+
+_GOLDEN = 0x9E3779B97F4A7C15
+
+
+def _hash(values, seed):
+    # 64-bit hash of integers (the splitmix64 finaliser), different for every seed; uint64 arithmetic wraps
+    x = np.asarray(values).astype('uint64') + np.uint64((seed * _GOLDEN) & 0xFFFFFFFFFFFFFFFF)
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return x
+
+
+def _grow(table, rows):
+    # Enlarge a table indexed by id to hold id rows - 1, doubling the capacity to amortize the copies
+    if rows <= len(table):
+        return table
+    extra = np.zeros((max(rows, 2 * len(table)) - len(table),) + table.shape[1:], dtype=table.dtype)
+    return np.concatenate([table, extra])
+
+
+def _check_same(a, b, names):
+    if any(getattr(a, n) != getattr(b, n) for n in names):
+        raise ValueError('only sketches with the same %s merge' % ', '.join(names))
+
+
+########################################
+## COUNT-MIN
+########################################
+class CountMinSketch(object):
+    """Approximate counts of integer keys, never below the true ones; see the module docstring for the bound."""
+
+    def __init__(self, eps=CM_EPS, delta=CM_DELTA, seed=0):
+        self.eps = eps
+        self.delta = delta
+        self.seed = seed
+        # A power of two, so that a counter is a mask of the hash
+        self.width = 1 << int(math.ceil(math.log2(math.e / eps)))
+        self.depth = int(math.ceil(math.log(1 / delta)))
+        self.table = np.zeros((self.depth, self.width), dtype='int64')
+        # N, the sum of all the counts added
+        self.total = 0
+
+    def _columns(self, keys, row):
+        return (_hash(keys, self.seed + row) & np.uint64(self.width - 1)).astype('int64')
+
+    def update(self, keys, counts=None):
+        """Add `counts` (default 1 each) to `keys`; negative counts remove them again."""
+        keys = np.asarray(keys)
+        weights = None if counts is None else np.asarray(counts, dtype='float64')
+        for row in range(self.depth):
+            added = np.bincount(self._columns(keys, row), weights=weights, minlength=self.width)
+            self.table[row] += added.astype('int64')
+        self.total += len(keys) if counts is None else int(np.sum(counts))
+
+    def query(self, keys):
+        """The estimated count of every key."""
+        keys = np.asarray(keys)
+        estimate = np.full(len(keys), np.iinfo('int64').max)
+        for row in range(self.depth):
+            np.minimum(estimate, self.table[row][self._columns(keys, row)], out=estimate)
+        return estimate
+
+    def merge(self, other):
+        """Add the counts of `other`, a sketch with the same eps, delta and seed; return self."""
+        _check_same(self, other, ('width', 'depth', 'seed'))
+        self.table += other.table
+        self.total += other.total
+        return self
+
+    @property
+    def error_bound(self):
+        """eps * N: the most that an estimate exceeds its count by, with probability 1 - delta."""
+        return self.eps * self.total
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+
+########################################
+## HYPERLOGLOG
+########################################
+class HyperLogLogs(object):
+    """The approximate number of distinct items of every key (e.g. the products of every user_id)."""
+
+    def __init__(self, p=HLL_P, seed=0):
+        self.p = p
+        self.m = 1 << p
+        self.seed = seed
+        self.registers = np.zeros((0, self.m), dtype='uint8')
+
+    def update(self, keys, items):
+        """Add the `items` of `keys` (two integer arrays of the same length)."""
+        keys = np.asarray(keys).astype('int64')
+        if not len(keys):
+            return
+        self.registers = _grow(self.registers, int(keys.max()) + 1)
+        h = _hash(items, self.seed)
+        register = (h >> np.uint64(64 - self.p)).astype('int64')
+        # Rank: the leading zeros of the other 64 - p bits, plus one; the float64 logs are exact on 32-bit halves
+        rest = h << np.uint64(self.p)
+        high = (rest >> np.uint64(32)).astype('float64')
+        low = (rest & np.uint64(0xFFFFFFFF)).astype('float64')
+        with np.errstate(divide='ignore'):
+            zeros = np.where(high > 0, 31 - np.floor(np.log2(high)),
+                             np.where(low > 0, 63 - np.floor(np.log2(low)), 64))
+        rank = (np.minimum(zeros, 64 - self.p) + 1).astype('uint8')
+        np.maximum.at(self.registers.reshape(-1), keys * self.m + register, rank)
+
+    def estimate(self, keys=None):
+        """The estimated number of distinct items of `keys` (default: every key up to the largest seen)."""
+        registers = self.registers if keys is None else self.registers[np.asarray(keys).astype('int64')]
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.exp2(-registers.astype('float64')).sum(axis=1)
+        empty = (registers == 0).sum(axis=1)
+        with np.errstate(divide='ignore'):
+            linear = m * np.log(m / np.maximum(empty, 1))
+        return np.where((raw <= 2.5 * m) & (empty > 0), linear, raw)
+
+    def merge(self, other):
+        """Take the registers of `other`, with the same p and seed, into these; return self."""
+        _check_same(self, other, ('p', 'seed'))
+        rows = max(len(self.registers), len(other.registers))
+        self.registers = _grow(self.registers, rows)[:rows]
+        np.maximum(self.registers[:len(other.registers)], other.registers, out=self.registers[:len(other.registers)])
+        return self
+
+    @property
+    def relative_error(self):
+        """The relative standard error of an estimate, 1.04 / sqrt(2^p)."""
+        return 1.04 / math.sqrt(self.m)
+
+    @property
+    def nbytes(self):
+        return self.registers.nbytes
+
+
+########################################
+## HISTOGRAMS OF WHOLE DAYS
+########################################
+class Histograms(object):
+    """The counts of every value 0 .. bins - 1 per key, for exact quantiles of small integers."""
+
+    def __init__(self, bins=DAYS):
+        self.bins = bins
+        self.counts = np.zeros((0, bins), dtype='int32')
+
+    def update(self, keys, values, counts=None):
+        """Add `values` (NaN skipped) of `keys`, each `counts` times (default once); negative counts remove."""
+        values = np.asarray(values, dtype='float64')
+        keep = ~np.isnan(values)
+        keys = np.asarray(keys).astype('int64')[keep]
+        if not len(keys):
+            return
+        self.counts = _grow(self.counts, int(keys.max()) + 1)
+        cell = keys * self.bins + np.clip(np.rint(values[keep]), 0, self.bins - 1).astype('int64')
+        weights = 1 if counts is None else np.asarray(counts).astype('int32')[keep]
+        # Only the cells of the keys given: the cost does not depend on the number of keys kept
+        np.add.at(self.counts.reshape(-1), cell, weights)
+
+    def _rank(self, cum, rank):
+        # The value of 0-based rank `rank` of every row: the first bin whose running count exceeds it
+        return (cum <= rank[:, None]).sum(axis=1).astype('float64')
+
+    def quantile(self, q, keys=None):
+        """The value at rank floor(q * (n - 1)) of every key; NaN for the keys without values."""
+        counts = self.counts if keys is None else self.counts[np.asarray(keys).astype('int64')]
+        cum = np.cumsum(counts, axis=1)
+        total = cum[:, -1]
+        out = self._rank(cum, np.floor(q * np.maximum(total - 1, 0)).astype('int64'))
+        return np.where(total > 0, out, np.nan)
+
+    def median(self, keys=None):
+        """The median of every key, the mean of the two middle values for an even count, as pandas gives it."""
+        counts = self.counts if keys is None else self.counts[np.asarray(keys).astype('int64')]
+        cum = np.cumsum(counts, axis=1)
+        total = cum[:, -1]
+        low = self._rank(cum, (total - 1) // 2)
+        high = self._rank(cum, total // 2)
+        return np.where(total > 0, (low + high) / 2, np.nan)
+
+    def max(self, keys=None):
+        """The largest value of every key; NaN for the keys without values."""
+        counts = self.counts if keys is None else self.counts[np.asarray(keys).astype('int64')]
+        seen = counts > 0
+        last = self.bins - 1 - np.argmax(seen[:, ::-1], axis=1)
+        return np.where(seen.any(axis=1), last, np.nan)
+
+    def merge(self, other):
+        """Add the counts of `other`, with the same bins; return self."""
+        _check_same(self, other, ('bins',))
+        self.counts = _grow(self.counts, len(other.counts))
+        self.counts[:len(other.counts)] += other.counts
+        return self
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes
+
+
+########################################
+## THE SKETCH AGGREGATES OF OP
+########################################
+class SketchAggregates(object):
+    """p_total_purchases, the distinct products and the last-5 days of every user, from sketches of op."""
+
+    def __init__(self, eps=CM_EPS, delta=CM_DELTA, p=HLL_P, window=LAST_N, seed=0):
+        self.window = window
+        self.products = CountMinSketch(eps, delta, seed)
+        self.distinct = HyperLogLogs(p, seed)
+        self.days = Histograms(DAYS)
+
+    def update(self, op):
+        """Add a chunk of op; the days of the last-5 window need its order_number_back column."""
+        self.products.update(op.product_id.values)
+        self.distinct.update(op.user_id.values, op.product_id.values)
+        if 'order_number_back' in op:
+            last = op.order_number_back.values <= self.window
+            self.days.update(op.user_id.values[last], op.days_since_prior_order.values[last])
+
+    def update_window(self, user_id, days_since_prior_order, n):
+        """Add orders to the last-5 window of their users, with n > 0 products, or take them out with -n."""
+        self.days.update(user_id, days_since_prior_order, n)
+
+    def merge(self, other):
+        """Add the sketches of `other` (e.g. of another shard of the users); return self."""
+        self.products.merge(other.products)
+        self.distinct.merge(other.distinct)
+        self.days.merge(other.days)
+        return self
+
+    @property
+    def nbytes(self):
+        return self.products.nbytes + self.distinct.nbytes + self.days.nbytes
+
+    def user(self):
+        """One row per user seen: u_distinct_products, max_days_last5 and med_days_last5."""
+        user_ids = np.flatnonzero(self.distinct.registers.any(axis=1))
+        days = self.days.counts
+        inside = user_ids < len(days)
+        max_days = np.full(len(user_ids), np.nan)
+        med_days = np.full(len(user_ids), np.nan)
+        max_days[inside] = self.days.max(user_ids[inside])
+        med_days[inside] = self.days.median(user_ids[inside])
+        return pd.DataFrame({'user_id': user_ids.astype(ID),
+                             'u_distinct_products': np.rint(self.distinct.estimate(user_ids)).astype('int64'),
+                             'max_days_last5': max_days, 'med_days_last5': med_days})
+
+    def prd(self, product_ids):
+        """p_total_purchases of `product_ids` (the sketch cannot list the products it has seen)."""
+        product_ids = np.asarray(product_ids)
+        return pd.DataFrame({'product_id': product_ids.astype(ID),
+                             'p_total_purchases': self.products.query(product_ids)})
+
+
+########################################
+## BENCHMARK AGAINST THE EXACT GROUPBYS
+########################################
+def compare(op, sketches):
+    """Errors of `sketches` against the exact groupbys of `op` (with order_number_back), as a dict."""
+    counts = op.groupby('product_id').size()
+    estimate = sketches.prd(counts.index.values).p_total_purchases.values
+    over = estimate - counts.values
+    distinct = op.groupby('user_id').product_id.nunique()
+    user = sketches.user().set_index('user_id').reindex(distinct.index)
+    relative = np.abs(user.u_distinct_products.values - distinct.values) / distinct.values
+    last = op[op.order_number_back <= sketches.window].groupby('user_id').days_since_prior_order
+    days = pd.DataFrame({'max': last.max(), 'median': last.median()}).reindex(distinct.index)
+    return {'count_under': int((over < 0).sum()), 'count_over_max': int(over.max()),
+            'count_over_mean': float(over.mean()), 'count_bound': sketches.products.error_bound,
+            'count_within_bound': float((over <= sketches.products.error_bound).mean()),
+            'distinct_error_mean': float(relative.mean()), 'distinct_error_max': float(relative.max()),
+            'distinct_error_std': float(np.sqrt((relative ** 2).mean())),
+            'distinct_bound': sketches.distinct.relative_error,
+            'max_days_diff': float(np.nanmax(np.abs(user.max_days_last5.values - days['max'].values))),
+            'med_days_diff': float(np.nanmax(np.abs(user.med_days_last5.values - days['median'].values)))}
+
+
+def main(argv=None):
+    from data_loader import load_tables
+    from dense_join import dense_merge
+    from sharded import shard_of
+    from streaming import build_features, prior_orders
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--source', default='./input', help='directory of CSV files or the Kaggle zip')
+    parser.add_argument('--eps', type=float, default=CM_EPS)
+    parser.add_argument('--delta', type=float, default=CM_DELTA)
+    parser.add_argument('--p', type=int, default=HLL_P, help='HyperLogLog registers per user: 2^p')
+    parser.add_argument('--memory', type=int, default=1000, help='memory budget of the chunks, in MB')
+    opts = parser.parse_args(argv)
+    options = {'eps': opts.eps, 'delta': opts.delta, 'p': opts.p}
+
+    tables = load_tables(opts.source, cache_dir=None, tables=['orders', 'order_products__prior'])
+    orders = tables['orders']
+    start = time.perf_counter()
+    build_features(orders, opts.source, opts.memory)
+    stream_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    sketches = SketchAggregates(**options)
+    build_features(orders, opts.source, opts.memory, sketches=sketches)
+    sketch_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    op = dense_merge(tables['order_products__prior'], prior_orders(orders, opts.source, 1 << 22),
+                     on='order_id', how='inner')
+    errors = compare(op, sketches)
+    exact_seconds = time.perf_counter() - start
+    pairs = op.groupby(['user_id', 'product_id']).ngroups
+    last = op[op.order_number_back <= LAST_N].groupby(['user_id', 'order_number']).ngroups
+    # The exact state: a count per product, a (user_id, product_id) key per pair, (user, order, days, n) per order
+    exact_mb = (op.product_id.max() + 1) * 8 / 1e6 + pairs * 8 / 1e6 + last * 20 / 1e6
+
+    print('%d items, %d products, %d users, %d pairs' % (len(op), op.product_id.nunique(), op.user_id.nunique(),
+                                                         pairs))
+    print('count-min %dx%d: never under (%d under), over by %.1f on average and %d at most; bound eps*N = %.0f, '
+          'met by %.2f%% of the products' % (sketches.products.depth, sketches.products.width,
+                                             errors['count_under'], errors['count_over_mean'],
+                                             errors['count_over_max'], errors['count_bound'],
+                                             100 * errors['count_within_bound']))
+    print('hyperloglog 2^%d registers: distinct products off by %.2f%% on average (rms %.2f%%, max %.1f%%); '
+          'bound %.1f%% rms' % (opts.p, 100 * errors['distinct_error_mean'], 100 * errors['distinct_error_std'],
+                                100 * errors['distinct_error_max'], 100 * errors['distinct_bound']))
+    print('day histograms: max_days_last5 off by %g, med_days_last5 off by %g at most'
+          % (errors['max_days_diff'], errors['med_days_diff']))
+    print('memory: sketches %.1f MB (count-min %.1f, hyperloglog %.1f, histograms %.1f), exact state %.1f MB'
+          % (sketches.nbytes / 1e6, sketches.products.nbytes / 1e6, sketches.distinct.nbytes / 1e6,
+             sketches.days.nbytes / 1e6, exact_mb))
+    print('time: streaming.build_features %.2f s, with the sketches %.2f s; exact groupbys in memory %.2f s'
+          % (stream_seconds, sketch_seconds, exact_seconds))
+
+    # Two shards of the users, sketched apart and merged, give the sketch of all the users
+    shard = shard_of(op.user_id.values, 2)
+    parts = [SketchAggregates(**options) for _ in range(2)]
+    for k, part in enumerate(parts):
+        part.update(op[shard == k])
+    merged = parts[0].merge(parts[1])
+    whole = SketchAggregates(**options)
+    whole.update(op)
+    pd.testing.assert_frame_equal(merged.user(), whole.user())
+    assert (merged.products.table == whole.products.table).all()
+    print('the sketches of 2 shards merge into the sketch of all the users')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""Out-of-core computation of the user, prd and uxp DataFrames.
+
+features.build_features() needs op, the 32M-row merge of orders with
+order_products_prior, in memory. Here order_products_prior is read in chunks
+instead. Every chunk is joined with orders and reduced to partial aggregates
+(counts, sums, min/max and the orders of the last-5 window). Partial
+aggregates can be merged with each other, and are folded together whenever
+the pending ones outgrow the memory budget. At the end they are turned into
+the same user, prd and uxp DataFrames as the in-memory path, value for value.
+
+The memory budget bounds the chunks and the pending partial aggregates. The
+folded aggregates themselves grow with the result (one row per user X product
+pair), like the uxp DataFrame does.
+"""
+import numpy as np
+import pandas as pd
+
+from data_loader import open_csv
+from dense_join import dense_merge
+from features import LAST_N, MIN_PURCHASES
+from schema import DTYPES, compact
+
+# Rough working memory per row of a chunk: the parsed columns, the join with
+# orders and the groupby temporaries
+BYTES_PER_ROW = 100
+
+# How every partial aggregate is merged with another one, per grouping key
+MERGE = {
+    'user': (['user_id'], {'n': 'sum', 'reordered': 'sum', 'max_days': 'max'}),
+    'prd': (['product_id'], {'n': 'sum', 'reordered': 'sum', 'add_to_cart_order': 'sum',
+                             'n_last5': 'sum', 'reordered_last5': 'sum'}),
+    'uxp': (['user_id', 'product_id'], {'n': 'sum', 'first_order_number': 'min', 'n_last5': 'sum'}),
+    # The orders of the last-5 window, with their basket size, for the max and median of days_since_prior_order
+    'days5': (['user_id', 'order_number'], {'days_since_prior_order': 'first', 'n': 'sum'}),
+}
+
+
+def chunk_rows(memory_mb):
+    """Return how many rows of order_products_prior to read at a time for a budget of `memory_mb`."""
+    # Half of the budget for the chunk, half for the pending partial aggregates
+    return max(10000, int(memory_mb * 1e6 / 2 / BYTES_PER_ROW))
+
+
+def read_chunks(source, rows, usecols=None):
+    """Yield order_products_prior from `source` (directory or Kaggle archive) in chunks of `rows` rows."""
+    dtype = DTYPES['order_products__prior']
+    if usecols is not None:
+        dtype = {col: dtype[col] for col in usecols}
+    with open_csv(source, 'order_products__prior') as f:
+        for chunk in pd.read_csv(f, dtype=dtype, usecols=usecols, chunksize=rows):
+            yield chunk
+
+
+def prior_orders(orders, source, rows):
+    """Return the orders that appear in order_products_prior, with their order_number_back.
+
+    op keeps only the orders that have products, and order_number_back counts
+    back from the last of them, so a first pass over the order_id column finds
+    out which orders these are.
+    """
+    has_products = np.zeros(int(orders.order_id.max()) + 1, dtype=bool)
+    for chunk in read_chunks(source, rows, usecols=['order_id']):
+        ids = chunk.order_id.values
+        has_products[ids[ids < len(has_products)]] = True
+
+    op_orders = orders.loc[has_products[orders.order_id.values],
+                           ['order_id', 'user_id', 'order_number', 'days_since_prior_order']]
+    op_orders = op_orders.copy()
+    op_orders['order_number_back'] = (op_orders.groupby('user_id')['order_number'].transform('max')
+                                      - op_orders.order_number + 1)
+    return op_orders
+
+
+class PartialAggregates(object):
+    """Mergeable partial aggregates of op for the user, prd and uxp DataFrames."""
+
+    def __init__(self):
+        self.parts = {name: [] for name in MERGE}
+        self.pending_rows = 0
+
+    def update(self, op):
+        """Add the partial aggregates of a chunk of op (with order_number_back)."""
+        op = op.assign(last5=(op.order_number_back <= LAST_N).astype('uint8'))
+        op['reordered_last5'] = op.reordered * op.last5
+        parts = {
+            'user': op.groupby('user_id').agg(n=('order_id', 'size'), reordered=('reordered', 'sum'),
+                                              max_days=('days_since_prior_order', 'max')),
+            'prd': op.groupby('product_id').agg(n=('order_id', 'size'), reordered=('reordered', 'sum'),
+                                                add_to_cart_order=('add_to_cart_order', 'sum'),
+                                                n_last5=('last5', 'sum'),
+                                                reordered_last5=('reordered_last5', 'sum')),
+            'uxp': op.groupby(['user_id', 'product_id']).agg(n=('order_id', 'size'),
+                                                            first_order_number=('order_number', 'min'),
+                                                            n_last5=('last5', 'sum')),
+            'days5': op[op.last5 == 1].groupby(['user_id', 'order_number']).agg(
+                days_since_prior_order=('days_since_prior_order', 'first'), n=('order_id', 'size')),
+        }
+        for name, part in parts.items():
+            self.parts[name].append(part)
+            self.pending_rows += len(part)
+
+    def merge(self, other):
+        """Add the partial aggregates of another PartialAggregates (e.g. from another process)."""
+        for name in MERGE:
+            self.parts[name].extend(other.parts[name])
+            self.pending_rows += sum(len(part) for part in other.parts[name])
+
+    def fold(self):
+        """Combine the pending partial aggregates into one DataFrame per grouping key."""
+        for name, (keys, how) in MERGE.items():
+            if len(self.parts[name]) > 1:
+                self.parts[name] = [pd.concat(self.parts[name]).groupby(level=keys).agg(how)]
+        self.pending_rows = 0
+
+    def result(self, name):
+        """Return the folded aggregate `name`, sorted by its keys."""
+        self.fold()
+        keys, how = MERGE[name]
+        if not self.parts[name]:
+            return pd.DataFrame(columns=keys + list(how)).set_index(keys)
+        return self.parts[name][0].sort_index()
+
+
+def _weighted_median(days5):
+    # Median per user of days_since_prior_order, where every order counts once per product in its basket
+    days5 = days5.dropna(subset=['days_since_prior_order']).reset_index()
+    days5 = days5.sort_values(['user_id', 'days_since_prior_order'], kind='mergesort')
+    user_ids, start = np.unique(days5.user_id.values, return_index=True)
+    cum = np.cumsum(days5.n.values.astype('int64'))
+    before = np.concatenate([[0], cum])[start]
+    total = np.append(before[1:], cum[-1] if len(cum) else 0) - before
+    values = days5.days_since_prior_order.values.astype('float64')
+    # The element with 0-based rank k of a user is the first row whose running count exceeds before + k
+    low = values[np.searchsorted(cum, before + (total - 1) // 2, side='right')]
+    high = values[np.searchsorted(cum, before + total // 2, side='right')]
+    return pd.Series((low + high) / 2, index=pd.Index(user_ids, name='user_id'))
+
+
+def finalize(agg):
+    """Turn folded PartialAggregates into the (user, prd, uxp) DataFrames of features.build_features()."""
+    u = agg.result('user')
+    p = agg.result('prd')
+    x = agg.result('uxp')
+    days5 = agg.result('days5')
+    total_orders = days5.reset_index().groupby('user_id')['order_number'].max()
+
+    # 2.1 User predictors
+    user = total_orders.to_frame('u_total_orders').reset_index()
+    user['u_reordered_ratio'] = (u.reordered / u.n).values
+    user['size_last5'] = (x.n_last5 > 0).groupby(level='user_id').sum().values
+    user = compact(user)
+
+    # 2.2 Product predictors
+    prd = p.n.to_frame('p_total_purchases').reset_index()
+    supported = p[p.n > MIN_PURCHASES]
+    p_reorder = pd.DataFrame({'p_reorder_ratio': supported.reordered / supported.n,
+                              'avg_position': supported.add_to_cart_order / supported.n}).reset_index()
+    op5_ratio = (p.reordered_last5 / p.n_last5)[p.n_last5 > 0].to_frame('p_reorder_last5').reset_index()
+    prd = prd.merge(p_reorder, on='product_id', how='left')
+    prd = prd.merge(op5_ratio, on='product_id', how='left')
+    prd = prd.fillna(0)
+    prd = compact(prd)
+
+    # 2.3 User X product predictors
+    uxp = x.n.to_frame('uxp_total_bought').reset_index()
+    # Pairs that were not bought in the last 5 orders are NaN (and then 0), as after the notebook's left merge
+    last5 = x.n_last5.where(x.n_last5 > 0).values
+    uxp['uxp_total_bought_last5'] = last5
+    span = total_orders.reindex(x.index.get_level_values('user_id')).values - x.first_order_number.values + 1
+    uxp['uxp_reorder_ratio'] = x.n.values / span
+    uxp['times_last5'] = last5
+    uxp = uxp.fillna(0)
+    uxp['last5_ ratio'] = uxp.times_last5 / LAST_N
+    # The timing of every user, once per user, gathered for the pairs of the user
+    days = pd.DataFrame({'max_days_last5': days5.days_since_prior_order.groupby(level='user_id').max(),
+                         'med_days_last5': _weighted_median(days5), 'uxp_max_days': u.max_days})
+    uxp = dense_merge(uxp, days.rename_axis('user_id').reset_index(), on='user_id', how='left')
+    uxp = uxp.fillna(0)
+    uxp = compact(uxp)
+    return user, prd, uxp
+
+
+def build_features(orders, source, memory_mb=1000, sketches=None):
+    """Compute (user, prd, uxp) reading order_products_prior from `source` in chunks.
+
+    `source` is the directory with the CSV files or the Kaggle archive, as in
+    data_loader.load_tables(). `memory_mb` bounds the size of the chunks and of
+    the pending partial aggregates. With sketches=sketches.SketchAggregates(),
+    every joined chunk also goes into the sketches.
+    """
+    rows = chunk_rows(memory_mb)
+    op_orders = prior_orders(orders, source, rows)
+    agg = PartialAggregates()
+    for chunk in read_chunks(source, rows):
+        op = chunk.merge(op_orders, on='order_id', how='inner')
+        agg.update(op)
+        if sketches is not None:
+            sketches.update(op)
+        if agg.pending_rows > rows:
+            agg.fold()
+    return finalize(agg)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Generate synthetic Instacart data, to benchmark the pipeline at any volume.
+
+The six CSV files have the same columns and types as the ones from Kaggle,
+so they feed the notebook unchanged, either as a directory or packed like the
+Kaggle archive (one inner zip per CSV). The distributions follow the real
+data roughly:
+
+* every user has 4 to 100 orders (the last one is train or test), most of them few,
+* days_since_prior_order is around a habit of each user, capped at 30, and NaN on the first order,
+* basket sizes vary per user around a mean of about 11 products,
+* product popularity has a long tail (Zipf),
+* every user shops mostly from a personal repertoire of products, which
+  gives a reorder rate of 55-70% (lower with more products).
+
+Users are generated in batches and appended to the CSV files, so the memory
+needed does not grow with the number of users.
+
+    python synthetic.py --users 206209 --products 49688 --out ./synthetic --zip
+"""
+import argparse
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from data_loader import TABLES
+
+N_AISLES = 134
+N_DEPARTMENTS = 21
+
+# Share of the last orders that are train orders (the rest are test orders), as on Kaggle
+TRAIN_SHARE = 0.64
+
+
+def _catalog(n_products, rng):
+    # products, aisles and departments; every aisle belongs to one department
+    aisle_department = rng.integers(1, N_DEPARTMENTS + 1, N_AISLES)
+    aisle_department[:N_DEPARTMENTS] = np.arange(1, N_DEPARTMENTS + 1)
+    aisle_id = rng.integers(1, N_AISLES + 1, n_products)
+    products = pd.DataFrame({'product_id': np.arange(1, n_products + 1),
+                             'product_name': ['Product %d' % i for i in range(1, n_products + 1)],
+                             'aisle_id': aisle_id,
+                             'department_id': aisle_department[aisle_id - 1]})
+    aisles = pd.DataFrame({'aisle_id': np.arange(1, N_AISLES + 1),
+                           'aisle': ['aisle %d' % i for i in range(1, N_AISLES + 1)]})
+    departments = pd.DataFrame({'department_id': np.arange(1, N_DEPARTMENTS + 1),
+                                'department': ['department %d' % i for i in range(1, N_DEPARTMENTS + 1)]})
+    return products, aisles, departments
+
+
+def _popularity(n_products, rng, exponent=0.8):
+    # Zipf-like weights over a random order of the products
+    weights = 1.0 / np.arange(1, n_products + 1) ** exponent
+    return rng.permutation(weights / weights.sum())
+
+
+def _segments(lengths):
+    # Start offset of every segment and the position of every element inside its segment
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    within = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+    return starts, within
+
+
+def _users(first_user, n_users, first_order, popularity, rng):
+    """Return (orders, order_products_prior, order_products_train) for one batch of users."""
+    # Orders per user: 4 to 100, geometric-like with a mean of about 16
+    n_orders = np.clip(3 + rng.geometric(1 / 14.0, n_users), 4, 100)
+    user_id = np.repeat(np.arange(first_user, first_user + n_users), n_orders)
+    _, within = _segments(n_orders)
+    order_number = within + 1
+    last = order_number == np.repeat(n_orders, n_orders)
+    eval_set = np.where(last, np.where(rng.random(n_users) < TRAIN_SHARE, 'train', 'test')[user_id - first_user],
+                        'prior')
+
+    # Every user has a usual gap between orders and a usual time of the day
+    habit = rng.gamma(2.0, 6.0, n_users)[user_id - first_user]
+    days = np.minimum(np.round(rng.gamma(3.0, habit / 3.0)), 30).astype('float32')
+    days[order_number == 1] = np.nan
+    hour = np.clip(np.round(rng.normal(13.5, 3.5, n_users)[user_id - first_user] + rng.normal(0, 2, len(user_id))),
+                   0, 23)
+    orders = pd.DataFrame({'order_id': np.arange(first_order, first_order + len(user_id)),
+                           'user_id': user_id,
+                           'eval_set': eval_set,
+                           'order_number': order_number,
+                           'order_dow': rng.integers(0, 7, len(user_id)),
+                           'order_hour_of_day': hour.astype(int),
+                           'days_since_prior_order': days})
+
+    # Basket sizes around a mean per user; the test orders have no products
+    mean_size = rng.lognormal(np.log(11.0), 0.5, n_users)
+    size = np.clip(rng.poisson(mean_size[user_id - first_user]), 1, 145)
+    size[eval_set == 'test'] = 0
+
+    # A repertoire of products per user, of about 1.5 baskets
+    repertoire = np.maximum(1, np.round(mean_size * 1.5)).astype(int)
+    rep_start, _ = _segments(repertoire)
+    rep_products = rng.choice(len(popularity), repertoire.sum(), p=popularity) + 1
+
+    item_order = np.repeat(np.arange(len(user_id)), size)
+    item_user = user_id[item_order] - first_user
+    from_repertoire = rng.random(len(item_order)) < 0.65
+    pick = rep_start[item_user] + (rng.random(len(item_order)) * repertoire[item_user]).astype(int)
+    product_id = np.where(from_repertoire, rep_products[pick],
+                          rng.choice(len(popularity), len(item_order), p=popularity) + 1)
+
+    items = pd.DataFrame({'order_id': orders.order_id.values[item_order],
+                          'product_id': product_id,
+                          'user_id': item_user,
+                          'order_number': order_number[item_order]})
+    # A product appears once per basket; reordered means the user bought it in an earlier order
+    items = items.drop_duplicates(['order_id', 'product_id'])
+    items['add_to_cart_order'] = items.groupby('order_id').cumcount() + 1
+    first_time = ~items.sort_values('order_number', kind='mergesort').duplicated(['user_id', 'product_id'])
+    items['reordered'] = (~first_time.reindex(items.index)).astype(int)
+
+    prior = orders.order_id.values[eval_set == 'prior']
+    columns = ['order_id', 'product_id', 'add_to_cart_order', 'reordered']
+    is_prior = np.isin(items.order_id.values, prior)
+    return orders, items.loc[is_prior, columns], items.loc[~is_prior, columns]
+
+
+def _pack(out_dir):
+    # The layout of the Kaggle archive: one inner <table>.csv.zip per CSV file
+    archive = os.path.join(out_dir, 'Instacart-Market-Basket-Analysis.zip')
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as outer:
+        for table in TABLES:
+            inner = os.path.join(out_dir, table + '.csv.zip')
+            with zipfile.ZipFile(inner, 'w', zipfile.ZIP_DEFLATED) as z:
+                z.write(os.path.join(out_dir, table + '.csv'), table + '.csv')
+            outer.write(inner, table + '.csv.zip')
+            os.remove(inner)
+    return archive
+
+
+def generate(out_dir, n_users=10000, n_products=5000, seed=0, batch_users=50000, archive=False):
+    """Write the six Instacart CSV files for `n_users` users and `n_products` products to `out_dir`.
+
+    With archive=True the files are also packed like the Kaggle archive, and
+    the path of the archive is returned; otherwise `out_dir` is returned.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    products, aisles, departments = _catalog(n_products, rng)
+    popularity = _popularity(n_products, rng)
+    for name, df in (('products', products), ('aisles', aisles), ('departments', departments)):
+        df.to_csv(os.path.join(out_dir, name + '.csv'), index=False)
+
+    paths = [os.path.join(out_dir, name + '.csv')
+             for name in ('orders', 'order_products__prior', 'order_products__train')]
+    next_order = 1
+    for first_user in range(1, n_users + 1, batch_users):
+        batch = min(batch_users, n_users - first_user + 1)
+        frames = _users(first_user, batch, next_order, popularity, rng)
+        next_order += len(frames[0])
+        for path, df in zip(paths, frames):
+            df.to_csv(path, index=False, mode='w' if first_user == 1 else 'a', header=first_user == 1)
+
+    return _pack(out_dir) if archive else out_dir
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-users', type=int, default=50000)
+    parser.add_argument('--out', default='./synthetic')
+    parser.add_argument('--zip', action='store_true', help='also pack the CSV files like the Kaggle archive')
+    opts = parser.parse_args(argv)
+    print(generate(opts.out, opts.users, opts.products, opts.seed, opts.batch_users, opts.zip))
+
+
+if __name__ == '__main__':
+    main()